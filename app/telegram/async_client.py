@@ -0,0 +1,75 @@
+import asyncio
+from typing import Dict, Optional, Sequence
+
+from app.telegram.client import TDLibClient, UpdateHandler
+from app.telegram.scheduler import RequestScheduler
+from app.telegram.store import EntityStore
+
+
+class AsyncTDLibClient:
+    """
+    asyncio front-end for TDLibClient.
+
+    Responses are still drained from td_receive by the receiver thread of TDLibClient; their futures are
+    bridged into the event loop with ``asyncio.wrap_future``, so awaiting a response never blocks the loop.
+    """
+
+    def __init__(self, td_client: TDLibClient):
+        """
+        Initialize the AsyncTDLibClient.
+
+        :param td_client: An authorized TDLibClient whose receiver thread resolves the requests.
+        """
+        self.td_client = td_client
+
+    @classmethod
+    async def create(cls, api_id: str, api_hash: str) -> "AsyncTDLibClient":
+        """
+        Create and authorize a TDLibClient without blocking the event loop.
+
+        :param api_id: The Telegram API ID.
+        :param api_hash: The Telegram API hash.
+        :return: An AsyncTDLibClient wrapping the authorized client.
+        """
+        loop = asyncio.get_running_loop()
+        td_client = await loop.run_in_executor(None, TDLibClient, api_id, api_hash)
+        return cls(td_client)
+
+    @property
+    def scheduler(self) -> RequestScheduler:
+        return self.td_client.scheduler
+
+    @property
+    def store(self) -> EntityStore:
+        return self.td_client.store
+
+    def send_request(self, query: Dict) -> "asyncio.Future[Dict]":
+        """
+        Send a query and return an awaitable resolved with its response.
+
+        :param query: The query to send.
+        :return: An asyncio future resolved with the response event (which may be an ``error`` event).
+        """
+        return asyncio.wrap_future(self.td_client.send_request(query))
+
+    def add_update_handler(
+        self, update_type: str, handler: UpdateHandler, markers: Optional[Sequence[str]] = None
+    ) -> None:
+        """
+        Register a handler for update events. Handlers run on the receiver thread.
+
+        :param update_type: The @type of the events, e.g. "updateUser".
+        :param handler: The callable receiving the event.
+        :param markers: Strings of which an event must contain one to be decoded, see
+            TDLibClient.add_update_handler.
+        """
+        self.td_client.add_update_handler(update_type, handler, markers)
+
+    def remove_update_handler(self, update_type: str, handler: UpdateHandler) -> None:
+        """
+        Unregister a handler previously added with add_update_handler.
+
+        :param update_type: The @type the handler was registered for.
+        :param handler: The handler to remove.
+        """
+        self.td_client.remove_update_handler(update_type, handler)
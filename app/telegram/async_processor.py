@@ -0,0 +1,595 @@
+import asyncio
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Set, Union
+
+from loguru import logger
+
+from app.telegram.async_client import AsyncTDLibClient
+from app.telegram.cache import SQLiteCache
+from app.telegram.membership import CoMembershipMatrix
+from app.telegram.metrics import LOCAL_RESPONSES
+from app.telegram.processor import (
+    ChatMemberService,
+    ProgressCallback,
+    SupergroupMemberPager,
+    build_common_groups_request,
+    build_member_count_request,
+    fingerprint_member_count,
+    fingerprint_user_ids,
+    format_user_name,
+    select_local_common_chats_counts,
+    select_member_user_ids,
+)
+from app.telegram.results import CommonChatsResult, CommonChatsRow, MemberList
+from app.telegram.search import ChatIndex
+from app.telegram.store import EntityStore
+
+
+class AsyncChatMemberService:
+    """
+    Coroutine counterpart of ChatMemberService.
+
+    Every lookup is awaited instead of blocking a thread, so many analyses and per-member lookups can run
+    concurrently in one event loop; the cache, which blocks on SQLite, is read and written in worker threads.
+    Paging, fingerprints and the extraction of members are the I/O-free helpers of the processor module,
+    shared with ChatMemberService.
+    """
+
+    REQUEST_TIMEOUT = ChatMemberService.REQUEST_TIMEOUT
+    MAX_COUNT_CHATS_RESPONSE = ChatMemberService.MAX_COUNT_CHATS_RESPONSE
+    DEFAULT_CONCURRENCY = ChatMemberService.DEFAULT_CONCURRENCY
+    MAX_MEMBERS_OFFSET = ChatMemberService.MAX_MEMBERS_OFFSET
+    MEMBER_SEARCH_QUERIES = ChatMemberService.MEMBER_SEARCH_QUERIES
+    MAX_MEMBER_SEARCH_REQUESTS = ChatMemberService.MAX_MEMBER_SEARCH_REQUESTS
+
+    def __init__(
+        self,
+        td_client: AsyncTDLibClient,
+        my_user_id: Optional[int] = None,
+        cache: Optional[SQLiteCache] = None,
+        store: Optional[EntityStore] = None,
+    ):
+        """
+        Initialize the AsyncChatMemberService. Use ``create`` to also resolve the current user's ID.
+
+        :param td_client: An instance of AsyncTDLibClient for sending requests.
+        :param my_user_id: The user ID of the current authenticated user.
+        :param cache: Optional persistent cache for chats, users and common groups.
+        :param store: Store of entities pushed by TDLib updates, the store of td_client if omitted.
+        """
+        self.td_client = td_client
+        self._my_user_id = my_user_id
+        self.cache = cache
+        self.store = store if store is not None else td_client.store
+        self.chat_index = ChatIndex()
+        self.co_membership: Optional[CoMembershipMatrix] = None
+        # Members Telegram did not list in the last complete listing of a chat, by chat ID
+        self.unlisted_member_counts: Dict[int, int] = {}
+        td_client.add_update_handler("updateChatTitle", self._on_chat_title)
+
+    def _on_chat_title(self, update: Dict[str, Any]) -> None:
+        # Called on the receiver thread: renamed chats are found by their new title
+        self.chat_index.rename(update["chat_id"], update["title"])
+
+    @classmethod
+    async def create(cls, td_client: AsyncTDLibClient, cache: Optional[SQLiteCache] = None) -> "AsyncChatMemberService":
+        """
+        Create the service and retrieve the current user's ID.
+
+        :param td_client: An instance of AsyncTDLibClient for sending requests.
+        :param cache: Optional persistent cache for chats, users and common groups.
+        :return: The initialized service.
+        """
+        service = cls(td_client, cache=cache)
+        service._my_user_id = await service.get_my_user_id()
+        return service
+
+    async def get_my_user_id(self) -> Optional[int]:
+        """
+        Retrieve the current user's ID.
+
+        :return: The user ID of the current authenticated user, or None if failed.
+        """
+        event = await self._send_and_wait_for_response({"@type": "getMe"}, success_condition="user")
+        if event is None:
+            logger.error("Failed to retrieve current user info.")
+            return None
+        return event.get("id")
+
+    async def get_user_id_by_username(self, username: str) -> Optional[int]:
+        """
+        Retrieve the user ID of a given username.
+
+        :param username: The username to retrieve the user ID for.
+        :return: The user ID of the user with the given username, or None if not found.
+        """
+        event = await self._send_and_wait_for_response(
+            {"@type": "searchPublicChat", "username": username}, success_condition="chat"
+        )
+        if event is None:
+            logger.error(f"Failed to retrieve user ID for username: {username}")
+            return None
+        return event.get("id")
+
+    async def _send_and_wait_for_response(
+        self, request_data: Dict[str, Any], success_condition: Union[str, List[str], Callable[[Dict[str, Any]], bool]]
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Sends a request and awaits a response that meets the success_condition.
+
+        :param request_data: The request data to be sent through td_client.
+        :param success_condition: Can be a string (@type), a list of @types, or a callable that checks the event.
+        :return: The event dictionary if the condition is met, None otherwise.
+        """
+        return (await self._send_and_wait_for_responses([request_data], success_condition))[0]
+
+    async def _send_and_wait_for_responses(
+        self,
+        requests: List[Dict[str, Any]],
+        success_condition: Union[str, List[str], Callable[[Dict[str, Any]], bool]],
+    ) -> List[Optional[Dict[str, Any]]]:
+        """
+        Sends all requests at once and awaits every response.
+
+        :param requests: The requests to be sent through td_client.
+        :param success_condition: Can be a string (@type), a list of @types, or a callable that checks the event.
+        :return: The response events in the order of the requests, with None for failed requests.
+        """
+        condition = ChatMemberService._build_condition(success_condition)
+        events = await asyncio.gather(*(self._send_request(request_data) for request_data in requests))
+
+        results: List[Optional[Dict[str, Any]]] = []
+        for request_data, event in zip(requests, events):
+            if event is None:
+                logger.error(f"Timed out waiting for {request_data['@type']} response")
+                results.append(None)
+            elif event.get("@type") == "error":
+                logger.error(f"Error in {request_data['@type']}: {event.get('message')}")
+                results.append(None)
+            elif condition(event):
+                results.append(event)
+            else:
+                logger.error(f"Unexpected response to {request_data['@type']}: {event.get('@type')}")
+                results.append(None)
+        return results
+
+    async def _send_request(self, request_data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """
+        Send a request and await its response, answering it from the entity store or the cache when possible.
+
+        :param request_data: The request data to be sent through td_client.
+        :return: The response event, or None on timeout.
+        """
+        known = self.store.get_response(request_data)
+        source = "store"
+        if known is None and self.cache is not None:
+            known = await asyncio.to_thread(self.cache.get_response, request_data)
+            source = "cache"
+        if known is not None:
+            LOCAL_RESPONSES.inc(source=source, method=request_data["@type"])
+            return known
+
+        event = await self._wait_for_result(self.td_client.send_request(request_data), request_data["@type"])
+        if event is not None and self.cache is not None:
+            await asyncio.to_thread(self.cache.store_response, request_data, event)
+        return event
+
+    async def _wait_for_result(self, future: "asyncio.Future[Dict[str, Any]]", method: str) -> Optional[Dict[str, Any]]:
+        """
+        Await a response, extending the deadline while the method is paused by a FLOOD_WAIT.
+
+        :param future: The future returned by td_client.send_request.
+        :param method: The @type of the request.
+        :return: The response event, or None on timeout.
+        """
+        timeout: float = self.REQUEST_TIMEOUT
+        while True:
+            try:
+                return await asyncio.wait_for(asyncio.shield(future), timeout)
+            except TimeoutError:
+                delay = self.td_client.scheduler.get_delay(method)
+                if delay <= 0:
+                    future.cancel()
+                    return None
+                timeout = delay + self.REQUEST_TIMEOUT
+
+    async def get_chat_id_by_username(self, username: str) -> Optional[int]:
+        """
+        Retrieve the chat ID for a given username.
+
+        :param username: The username of the public chat.
+        :return: The chat ID if found, None otherwise.
+        """
+        event = await self._send_and_wait_for_response(
+            {"@type": "searchPublicChat", "username": username}, success_condition="chat"
+        )
+        if event is not None:
+            return event["id"]
+        return None
+
+    async def get_chat_info_by_id(self, chat_id: int) -> Optional[Dict[str, Any]]:
+        """
+        Retrieve chat information by its ID.
+
+        :param chat_id: The ID of the chat.
+        :return: A dictionary with chat information if found, None otherwise.
+        """
+        return await self._send_and_wait_for_response(
+            {"@type": "getChat", "chat_id": chat_id}, success_condition="chat"
+        )
+
+    async def get_chats(self) -> Optional[List[Dict[str, Any]]]:
+        """
+        Retrieve a list of all group chats.
+
+        :return: A list of dictionaries, each containing chat ID and title, or None if no chats are found.
+        """
+        chats: List[Dict[str, Any]] = []
+        async for page in self.iter_chat_pages():
+            chats.extend(page)
+        return chats
+
+    async def iter_chat_pages(
+        self, page_size: int = ChatMemberService.CHATS_PAGE_SIZE
+    ) -> AsyncIterator[List[Dict[str, Any]]]:
+        """
+        Load the main chat list page by page and yield the group chats of every page as soon as it arrives.
+        Every page is also added to chat_index.
+
+        :param page_size: The number of chats to request per page.
+        :return: An async iterator over lists of dictionaries, each containing chat ID and title.
+        """
+        yielded: Set[int] = set()
+        request_data = {"@type": "loadChats", "chat_list": {"@type": "chatListMain"}, "limit": page_size}
+        complete = False
+        while True:
+            page = ChatMemberService._take_new_group_chats(self.store, yielded)
+            if page:
+                self.chat_index.add(page)
+                yield page
+            if complete:
+                return
+
+            event = await self._wait_for_result(self.td_client.send_request(request_data), request_data["@type"])
+            if event is None:
+                logger.error("Timed out loading chats")
+                return
+            if event["@type"] == "error":
+                if event.get("code") != 404:
+                    logger.error(f"Error in loadChats: {event.get('message')}")
+                    return
+                complete = True
+
+    async def get_chat_members(self, chat_id: int) -> Optional[MemberList]:
+        """
+        Retrieve all user members from a basic group, supergroup or channel.
+
+        :param chat_id: The ID of the group chat.
+        :return: The user IDs and statuses of the members, or None if unable to retrieve members.
+        """
+        member_pages = await self.iter_chat_members(chat_id)
+        if member_pages is None:
+            return None
+        members = MemberList()
+        async for page in member_pages:
+            members.extend(page)
+        return members
+
+    async def iter_chat_members(
+        self, chat_id: int, page_size: int = ChatMemberService.MEMBERS_PAGE_SIZE
+    ) -> Optional[AsyncIterator[List[Dict[str, Any]]]]:
+        """
+        Retrieve the members of a chat page by page; supergroups and channels are paged lazily, and the members
+        past the listing limit of Telegram are searched by name, see ChatMemberService.iter_chat_members.
+
+        :param chat_id: The ID of the group chat.
+        :param page_size: The number of members per getSupergroupMembers request.
+        :return: An async iterator over lists of member objects, or None if the chat or its first page
+            is unavailable.
+        """
+        chat_info = await self.get_chat_info_by_id(chat_id)
+        if chat_info is None:
+            return None
+
+        chat_type = chat_info["type"]
+        if chat_type["@type"] == "chatTypeBasicGroup":
+            full_info = await self._send_and_wait_for_response(
+                {"@type": "getBasicGroupFullInfo", "basic_group_id": chat_type["basic_group_id"]},
+                success_condition="basicGroupFullInfo",
+            )
+            if full_info is None:
+                return None
+            return self._iter_pages([full_info["members"]])
+
+        if chat_type["@type"] == "chatTypeSupergroup":
+            pager = SupergroupMemberPager(
+                chat_type["supergroup_id"],
+                page_size,
+                self.MAX_MEMBERS_OFFSET,
+                self.MEMBER_SEARCH_QUERIES,
+                self.MAX_MEMBER_SEARCH_REQUESTS,
+            )
+            first_page = await self._send_and_wait_for_response(pager.next_request(), success_condition="chatMembers")
+            if first_page is None:
+                return None
+            return self._iter_supergroup_member_pages(chat_id, pager, pager.feed(first_page))
+
+        logger.error(f"Chat {chat_id} of type {chat_type['@type']} has no members to list.")
+        return None
+
+    @staticmethod
+    async def _iter_pages(pages: List[List[Dict[str, Any]]]) -> AsyncIterator[List[Dict[str, Any]]]:
+        for page in pages:
+            yield page
+
+    async def _iter_supergroup_member_pages(
+        self, chat_id: int, pager: SupergroupMemberPager, members: List[Dict[str, Any]]
+    ) -> AsyncIterator[List[Dict[str, Any]]]:
+        """
+        Yield the members of the already received first page, then request and yield the following pages.
+
+        :param chat_id: The ID of the supergroup chat.
+        :param pager: The pager the first page was fed to.
+        :param members: The members of the first page.
+        :return: An async iterator over lists of member objects.
+        """
+        if members:
+            yield members
+        while (request := pager.next_request()) is not None:
+            members = pager.feed(await self._send_and_wait_for_response(request, success_condition="chatMembers"))
+            if members:
+                yield members
+        pager.record_unlisted(self.unlisted_member_counts, chat_id)
+
+    async def get_common_groups_with_user(self, user_id: int) -> Optional[Dict[str, Any]]:
+        """
+        Retrieve all common groups with a specified user.
+
+        :param user_id: The user ID for which to find common groups.
+        :return: A dictionary containing common group IDs or None if the operation fails.
+        """
+        response = await self._send_and_wait_for_response(
+            build_common_groups_request(user_id, self.MAX_COUNT_CHATS_RESPONSE), success_condition="chats"
+        )
+        if response is None:
+            logger.error("Failed to get common groups")
+            return None
+        return response
+
+    async def get_name_by_user_id(self, user_id: int) -> Optional[str]:
+        """
+        Retrieve the username of a user by their ID.
+
+        :param user_id: The ID of the user.
+        :return: The username if found, None otherwise.
+        """
+        user = await self._send_and_wait_for_response(
+            {"@type": "getUser", "user_id": user_id}, success_condition="user"
+        )
+        if user is None:
+            return None
+        return format_user_name(user)
+
+    async def get_users_common_chats_count_for_chat(
+        self,
+        chat_id: int,
+        concurrency: int = DEFAULT_CONCURRENCY,
+        progress_callback: Optional[ProgressCallback] = None,
+        skip_user_ids: Optional[Set[int]] = None,
+    ) -> Optional[CommonChatsResult]:
+        """
+        For each user in the specified chat, find how many common group chats are shared.
+
+        :param chat_id: The ID of the group chat.
+        :param concurrency: The maximum number of members whose lookups are in flight at the same time.
+        :param progress_callback: Called after each member with (done, total, user_id, error).
+        :param skip_user_ids: Members left out of the result, e.g. those analyzed by an interrupted run.
+        :return: The user IDs, names and counts of the members, or None on failure.
+        """
+        rows = await self.iter_users_common_chats_count_for_chat(chat_id, concurrency, progress_callback, skip_user_ids)
+        if rows is None:
+            return None
+        result = CommonChatsResult()
+        async for row in rows:
+            result.append(row)
+        return result
+
+    async def iter_users_common_chats_count_for_chat(
+        self,
+        chat_id: int,
+        concurrency: int = DEFAULT_CONCURRENCY,
+        progress_callback: Optional[ProgressCallback] = None,
+        skip_user_ids: Optional[Set[int]] = None,
+    ) -> Optional[AsyncIterator[CommonChatsRow]]:
+        """
+        Streaming variant of get_users_common_chats_count_for_chat that yields each result row as soon as
+        the lookups of its member complete. Members are streamed page by page and ``concurrency`` workers
+        look them up concurrently. Chats in a loaded co-membership matrix are answered from the matrix without
+        any getGroupsInCommon request.
+
+        :param chat_id: The ID of the group chat.
+        :param concurrency: The maximum number of members whose lookups are in flight at the same time.
+        :param progress_callback: Called after each member with (done, total, user_id, error); total is the
+            member count reported by Telegram, less the skipped members.
+        :param skip_user_ids: Members that are not looked up and left out of the result.
+        :return: An async iterator over result rows, or None if the members of the chat cannot be retrieved.
+        """
+        skip_user_ids = skip_user_ids or set()
+        if self.co_membership is not None and chat_id in self.co_membership:
+            return self._iter_local_common_chats_counts(
+                self.co_membership, chat_id, concurrency, progress_callback, skip_user_ids
+            )
+
+        member_pages = await self.iter_chat_members(chat_id)
+        if member_pages is None:
+            logger.error("Failed to get chat members.")
+            return None
+
+        total = max((await self.get_chat_member_count(chat_id) or 0) - len(skip_user_ids), 0)
+        return self._iter_common_chats_counts(member_pages, total, concurrency, progress_callback, skip_user_ids)
+
+    async def load_co_membership_matrix(
+        self, progress_callback: Optional[ProgressCallback] = None
+    ) -> CoMembershipMatrix:
+        """
+        Load the members of all group chats once and keep them as a co-membership matrix, see
+        ChatMemberService.load_co_membership_matrix.
+
+        :param progress_callback: Called after each chat with (done, total, chat_id, error).
+        :return: The loaded CoMembershipMatrix, also stored as co_membership.
+        """
+        chats = await self.get_chats() or []
+        members: Dict[int, List[int]] = {}
+        for done, chat in enumerate(chats, start=1):
+            member_pages = await self.iter_chat_members(chat["id"])
+            error = None
+            if member_pages is None:
+                error = "members unavailable"
+                logger.warning(f"Skipping chat {chat['id']} in the co-membership matrix: {error}")
+            else:
+                members[chat["id"]] = [user_id async for user_id in self.iter_member_user_ids(member_pages, set())]
+            if progress_callback is not None:
+                progress_callback(done, len(chats), chat["id"], error)
+
+        self.co_membership = CoMembershipMatrix.from_member_lists(members)
+        logger.info(f"Loaded co-membership matrix of {self.co_membership.shape[0]} users in {len(members)} chats")
+        return self.co_membership
+
+    async def _iter_local_common_chats_counts(
+        self,
+        matrix: CoMembershipMatrix,
+        chat_id: int,
+        concurrency: int,
+        progress_callback: Optional[ProgressCallback],
+        skip_user_ids: Set[int],
+    ) -> AsyncIterator[CommonChatsRow]:
+        """
+        Yield the result rows of a chat from the co-membership matrix; only the names are requested, in batches.
+
+        :param matrix: The loaded co-membership matrix containing the chat.
+        :param chat_id: The ID of the group chat.
+        :param concurrency: The number of getUser requests sent at once.
+        :param progress_callback: Called after each user with (done, total, user_id, error).
+        :param skip_user_ids: Members left out of the result.
+        :return: An async iterator over result rows in member order.
+        """
+        user_ids, counts = select_local_common_chats_counts(matrix, chat_id, skip_user_ids)
+        total = len(user_ids)
+        for start in range(0, total, concurrency):
+            batch = user_ids[start : start + concurrency].tolist()
+            users = await self._send_and_wait_for_responses(
+                [{"@type": "getUser", "user_id": user_id} for user_id in batch], success_condition="user"
+            )
+            for offset, (user_id, count, user) in enumerate(zip(batch, counts[start : start + concurrency], users)):
+                if progress_callback is not None:
+                    progress_callback(start + offset + 1, total, user_id, None)
+                name = format_user_name(user) if user is not None else None
+                yield CommonChatsRow(user_id, name, int(count))
+
+    async def iter_member_user_ids(
+        self, member_pages: AsyncIterator[List[Dict[str, Any]]], skip_user_ids: Set[int]
+    ) -> AsyncIterator[int]:
+        """
+        Extract the user IDs of the members, skipping non-user senders, the current user and skip_user_ids.
+
+        :param member_pages: Pages of chatMember objects of a chat.
+        :param skip_user_ids: Members to leave out.
+        :return: An async iterator over the user IDs to analyze.
+        """
+        async for members in member_pages:
+            for user_id in select_member_user_ids(members, self._my_user_id, skip_user_ids):
+                yield user_id
+
+    async def _iter_common_chats_counts(
+        self,
+        member_pages: AsyncIterator[List[Dict[str, Any]]],
+        total: int,
+        concurrency: int,
+        progress_callback: Optional[ProgressCallback],
+        skip_user_ids: Set[int],
+    ) -> AsyncIterator[CommonChatsRow]:
+        """
+        Look up the common groups and names of the members with ``concurrency`` workers.
+
+        :param member_pages: Pages of chatMember objects.
+        :param total: The expected number of members, passed to progress_callback.
+        :param concurrency: The number of workers.
+        :param progress_callback: Called after each member with (done, total, user_id, error).
+        :param skip_user_ids: Members that are not looked up.
+        :return: An async iterator over result rows in completion order.
+        """
+        user_ids = self.iter_member_user_ids(member_pages, skip_user_ids)
+        user_ids_lock = asyncio.Lock()
+        rows: "asyncio.Queue[Optional[CommonChatsRow]]" = asyncio.Queue()
+        done = 0
+
+        async def next_user_id() -> Optional[int]:
+            async with user_ids_lock:
+                return await anext(user_ids, None)
+
+        async def worker() -> None:
+            nonlocal done
+            while (user_id := await next_user_id()) is not None:
+                common_groups_response, name = await asyncio.gather(
+                    self.get_common_groups_with_user(user_id), self.get_name_by_user_id(user_id)
+                )
+                done += 1
+                error = None
+                if common_groups_response is None:
+                    error = "getGroupsInCommon failed"
+                    logger.error(f"Failed to get common groups for user_id: {user_id}: {error}")
+                else:
+                    rows.put_nowait(CommonChatsRow(user_id, name, len(common_groups_response.get("chat_ids", []))))
+                if progress_callback is not None:
+                    progress_callback(done, total, user_id, error)
+
+        async def run_workers() -> None:
+            try:
+                await asyncio.gather(*(worker() for _ in range(concurrency)))
+            finally:
+                rows.put_nowait(None)
+
+        workers = asyncio.create_task(run_workers())
+        try:
+            while (row := await rows.get()) is not None:
+                yield row
+            await workers
+        finally:
+            workers.cancel()
+
+    async def get_chat_member_count(self, chat_id: int) -> Optional[int]:
+        """
+        Retrieve the number of members of a chat as reported by Telegram.
+
+        :param chat_id: The ID of the group chat.
+        :return: The member count, or None if it is unknown.
+        """
+        chat_info = await self.get_chat_info_by_id(chat_id)
+        if chat_info is None:
+            return None
+        request = build_member_count_request(chat_info)
+        if request is None:
+            return None
+        group = await self._send_and_wait_for_response(*request)
+        if group is None:
+            return None
+        return group.get("member_count")
+
+    async def get_members_fingerprint(self, chat_id: int) -> Optional[str]:
+        """
+        Fingerprint the member set of a chat, see ChatMemberService.get_members_fingerprint.
+
+        :param chat_id: The ID of the group chat.
+        :return: The fingerprint, or None if the members or the member count are unavailable.
+        """
+        if self.co_membership is not None and chat_id in self.co_membership:
+            return fingerprint_user_ids(self.co_membership.get_members(chat_id))
+        chat_info = await self.get_chat_info_by_id(chat_id)
+        if chat_info is None:
+            return None
+        if chat_info["type"]["@type"] != "chatTypeBasicGroup":
+            member_count = await self.get_chat_member_count(chat_id)
+            return fingerprint_member_count(member_count) if member_count is not None else None
+        members = await self.get_chat_members(chat_id)
+        if members is None:
+            return None
+        return fingerprint_user_ids(members.user_ids)
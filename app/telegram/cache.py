@@ -0,0 +1,207 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Optional, Sequence, Tuple
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Requests whose responses are cached: @type -> (entity kind, fields making up the entity key)
+CACHEABLE_REQUESTS: Dict[str, Tuple[str, Sequence[str]]] = {
+    "getChat": ("chat", ("chat_id",)),
+    "getUser": ("user", ("user_id",)),
+    # Another page of the common groups is another response
+    "getGroupsInCommon": ("common_groups", ("user_id", "offset_chat_id", "limit")),
+}
+
+
+class SQLiteCache:
+    """
+    Persistent cache of TDLib entities with a TTL per entity kind and least-recently-used eviction.
+
+    Access times are buffered in memory and written in batches, before every eviction and every
+    ACCESS_FLUSH_SIZE hits, so a hit does not commit a write; the access times lost when the process exits only
+    make eviction less exact.
+    """
+
+    DEFAULT_PATH = os.getenv("CACHE_PATH", "cache.sqlite3")
+    DEFAULT_TTLS = {
+        "chat": 24 * 60 * 60,
+        "user": 24 * 60 * 60,
+        "common_groups": 60 * 60,
+    }
+    DEFAULT_MAX_ENTRIES = 200000
+    EVICTION_INTERVAL = 1000
+    ACCESS_FLUSH_SIZE = 1000
+
+    def __init__(
+        self,
+        path: str = DEFAULT_PATH,
+        ttls: Optional[Dict[str, float]] = None,
+        max_entries: int = DEFAULT_MAX_ENTRIES,
+    ):
+        """
+        Initialize the SQLiteCache.
+
+        :param path: Path to the SQLite database file, ":memory:" for a cache that is not persisted.
+        :param ttls: Time to live in seconds per entity kind, merged over DEFAULT_TTLS.
+        :param max_entries: The number of entries above which the least recently used ones are evicted.
+        """
+        self.ttls = {**self.DEFAULT_TTLS, **(ttls or {})}
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._writes = 0
+        # Access times of the hits not written yet, by (kind, key)
+        self._accessed: Dict[Tuple[str, str], float] = {}
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS entries (
+                kind TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value TEXT NOT NULL,
+                expires_at REAL NOT NULL,
+                accessed_at REAL NOT NULL,
+                PRIMARY KEY (kind, key)
+            )
+            """
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS entries_accessed_at ON entries (accessed_at)")
+        self._connection.commit()
+
+    def get(self, kind: str, key: Any) -> Optional[Any]:
+        """
+        Retrieve a cached value.
+
+        :param kind: The entity kind, e.g. "user".
+        :param key: The entity key, e.g. the user ID.
+        :return: The cached value, or None if it is missing or expired.
+        """
+        now = time.time()
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT value, expires_at FROM entries WHERE kind = ? AND key = ?", (kind, str(key))
+            ).fetchone()
+            if row is None:
+                return None
+            value, expires_at = row
+            if expires_at < now:
+                self._connection.execute("DELETE FROM entries WHERE kind = ? AND key = ?", (kind, str(key)))
+                self._connection.commit()
+                return None
+            self._accessed[(kind, str(key))] = now
+            if len(self._accessed) >= self.ACCESS_FLUSH_SIZE:
+                self._flush_accessed()
+                self._connection.commit()
+        return json.loads(value)
+
+    def set(self, kind: str, key: Any, value: Any) -> None:
+        """
+        Store a value with the TTL of its entity kind.
+
+        :param kind: The entity kind, e.g. "user".
+        :param key: The entity key, e.g. the user ID.
+        :param value: A JSON-serializable value.
+        """
+        now = time.time()
+        ttl = self.ttls.get(kind)
+        if ttl is None or ttl <= 0:
+            return
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO entries (kind, key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+                (kind, str(key), json.dumps(value), now + ttl, now),
+            )
+            self._accessed.pop((kind, str(key)), None)
+            self._writes += 1
+            if self._writes % self.EVICTION_INTERVAL == 0:
+                self._evict(now)
+            self._connection.commit()
+
+    def invalidate(self, kind: str, key: Optional[Any] = None) -> None:
+        """
+        Drop one cached entity, or every entity of a kind.
+
+        :param kind: The entity kind.
+        :param key: The entity key, None to drop the whole kind.
+        """
+        with self._lock:
+            if key is None:
+                self._connection.execute("DELETE FROM entries WHERE kind = ?", (kind,))
+            else:
+                self._connection.execute("DELETE FROM entries WHERE kind = ? AND key = ?", (kind, str(key)))
+            self._connection.commit()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._connection.execute("DELETE FROM entries")
+            self._connection.commit()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def flush(self) -> None:
+        """
+        Write the buffered access times.
+        """
+        with self._lock:
+            self._flush_accessed()
+            self._connection.commit()
+
+    def _flush_accessed(self) -> None:
+        if not self._accessed:
+            return
+        self._connection.executemany(
+            "UPDATE entries SET accessed_at = ? WHERE kind = ? AND key = ?",
+            [(accessed_at, kind, key) for (kind, key), accessed_at in self._accessed.items()],
+        )
+        self._accessed.clear()
+
+    def _evict(self, now: float) -> None:
+        self._flush_accessed()
+        self._connection.execute("DELETE FROM entries WHERE expires_at < ?", (now,))
+        (count,) = self._connection.execute("SELECT COUNT(*) FROM entries").fetchone()
+        if count > self.max_entries:
+            self._connection.execute(
+                "DELETE FROM entries WHERE rowid IN (SELECT rowid FROM entries ORDER BY accessed_at LIMIT ?)",
+                (count - self.max_entries,),
+            )
+
+    def get_response(self, request_data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """
+        Retrieve the cached response to a request.
+
+        :param request_data: The request, e.g. {"@type": "getUser", "user_id": 1}.
+        :return: The cached response event, or None if the request is not cacheable or not cached.
+        """
+        cacheable = CACHEABLE_REQUESTS.get(request_data["@type"])
+        if cacheable is None:
+            return None
+        kind, key_fields = cacheable
+        return self.get(kind, self._request_key(request_data, key_fields))
+
+    def store_response(self, request_data: Dict[str, Any], event: Dict[str, Any]) -> None:
+        """
+        Cache the successful response to a cacheable request.
+
+        :param request_data: The request the event answers.
+        :param event: The response event.
+        """
+        cacheable = CACHEABLE_REQUESTS.get(request_data["@type"])
+        if cacheable is None or event.get("@type") == "error":
+            return
+        kind, key_fields = cacheable
+        self.set(
+            kind,
+            self._request_key(request_data, key_fields),
+            {k: v for k, v in event.items() if k not in ("@extra", "@client_id")},
+        )
+
+    @staticmethod
+    def _request_key(request_data: Dict[str, Any], key_fields: Sequence[str]) -> str:
+        return ":".join(str(request_data.get(field)) for field in key_fields)
@@ -1,30 +1,175 @@
-import json
+import copy
+import itertools
 import os
-import sys
+import queue
+import threading
 import time
-from typing import Dict
+from concurrent.futures import Future, InvalidStateError
+from typing import Callable, Dict, Hashable, List, Optional, Sequence, Tuple
 
 from dotenv import load_dotenv
 from loguru import logger
 
 import app.telegram.functional as F
+from app.telegram.codec import get_codec, is_response, peek_type
+from app.telegram.metrics import (
+    COALESCED_REQUESTS,
+    DISCARDED_EVENTS,
+    FLOOD_WAIT_RETRIES,
+    FLOOD_WAIT_SECONDS,
+    REQUEST_NETWORK_SECONDS,
+    REQUEST_QUEUE_SECONDS,
+    REQUESTS,
+    REQUESTS_IN_FLIGHT,
+)
+from app.telegram.scheduler import RequestScheduler, parse_flood_wait
+from app.telegram.store import EntityStore
 
 load_dotenv()
 
+UpdateHandler = Callable[[Dict], None]
+
+
+class _ReceiveLoop:
+    """
+    Process-wide receiver thread.
+
+    td_receive returns events of every client created in the process, so a single thread drains it and
+    hands each event to the client it belongs to (by ``@client_id``).
+    """
+
+    def __init__(self):
+        self._clients: Dict[int, "TDLibClient"] = {}
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def register(self, client: "TDLibClient") -> None:
+        with self._lock:
+            self._clients[client.client_id] = client
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="tdlib-receiver", daemon=True)
+                self._thread.start()
+
+    def unregister(self, client: "TDLibClient") -> None:
+        with self._lock:
+            self._clients.pop(client.client_id, None)
+
+    def _is_wanted(self, data: bytes) -> bool:
+        """
+        Check whether an event has to be decoded: it may answer a request, or some client handles it.
+        """
+        if is_response(data):
+            return True
+        event_type = peek_type(data)
+        if event_type is None:
+            return True
+        return any(client.wants(event_type, data) for client in list(self._clients.values()))
+
+    def _run(self) -> None:
+        while True:
+            try:
+                data = F.receive(TDLibClient.RECEIVE_LOOP_TIMEOUT)
+            except Exception:
+                logger.exception("Failed to receive from TDLib")
+                time.sleep(TDLibClient.RECEIVE_LOOP_TIMEOUT)
+                continue
+            if not data:
+                continue
+            if not self._is_wanted(data):
+                DISCARDED_EVENTS.inc(reason="unhandled")
+                continue
+            try:
+                event = TDLibClient.codec.loads(data)
+            except Exception:
+                logger.exception(f"Failed to decode event: {data[:200]!r}")
+                DISCARDED_EVENTS.inc(reason="invalid")
+                continue
+            client = self._clients.get(event.get("@client_id"))
+            if client is None:
+                DISCARDED_EVENTS.inc(reason="unknown_client")
+                continue
+            try:
+                client._dispatch(event)
+            except Exception:
+                logger.exception(f"Failed to dispatch event: {event.get('@type')}")
+
+
+_receive_loop = _ReceiveLoop()
+
+
+class _PendingRequest:
+    __slots__ = ("query", "future", "attempts", "queued_at", "sent_at")
+
+    def __init__(self, query: Dict, future: Future):
+        self.query = query
+        self.future = future
+        self.attempts = 1
+        self.queued_at = time.monotonic()
+        self.sent_at: Optional[float] = None
+
 
 class TDLibClient:
     TDLIB_LOGGING_LEVEL = int(os.getenv("TDLIB_LOGGING_LEVEL", 2))
-    RECEIVE_LOOP_TIMEOUT = 5
+    DATABASE_DIR = os.getenv("DATABASE_DIR", "tdlib")
+    WARM_START = os.getenv("TDLIB_WARM_START", "true").lower() in ("1", "true", "yes")
+    RECEIVE_LOOP_TIMEOUT = 1
     AUTHORIZE_LOOP_TIMEOUT = 5
+    MAX_FLOOD_WAIT_RETRIES = 5
+    HANDLED_EVENTS = ("updateAuthorizationState", "error")
+    # Read-only lookups: identical ones in flight at the same time share a single round trip
+    COALESCED_REQUESTS = frozenset(
+        (
+            "getMe",
+            "getUser",
+            "getUserFullInfo",
+            "getChat",
+            "searchPublicChat",
+            "getBasicGroup",
+            "getBasicGroupFullInfo",
+            "getSupergroup",
+            "getSupergroupFullInfo",
+            "getSupergroupMembers",
+            "getGroupsInCommon",
+        )
+    )
+    codec = get_codec(os.getenv("TDLIB_JSON_CODEC"))
 
-    def __init__(self, api_id: str, api_hash: str):
+    def __init__(
+        self, api_id: str, api_hash: str, database_directory: str = DATABASE_DIR, warm_start: bool = WARM_START
+    ):
         self.__api_id = api_id
         self.__api_hash = api_hash
+        self.database_directory = database_directory
+        self.warm_start = warm_start
+        self.startup_timings: Dict[str, float] = {}
+        self._startup_step_at = self._startup_started_at = time.monotonic()
         self._client_id = F.create_client_id()
+        self._record_startup_step("create_client_id")
+        self._request_ids = itertools.count(1)
+        self._pending: Dict[str, _PendingRequest] = {}
+        self._pending_lock = threading.Lock()
+        self._coalesced: Dict[Hashable, Future] = {}
+        self._closed = False
+        self.scheduler = RequestScheduler(self.send)
+        self._update_handlers: Dict[str, List[UpdateHandler]] = {}
+        # The markers of every update handler, in the order of _update_handlers; None for every event
+        self._update_markers: Dict[str, List[Optional[Tuple[bytes, ...]]]] = {}
+        self._auth_states: "queue.Queue[Dict]" = queue.Queue()
+        self.store = EntityStore(self)
         self._set_verbosity_level(TDLibClient.TDLIB_LOGGING_LEVEL)
         self._is_authorized = False
+        _receive_loop.register(self)
         self._authorize()
-        time.sleep(TDLibClient.AUTHORIZE_LOOP_TIMEOUT)
+        self.startup_timings["total"] = time.monotonic() - self._startup_started_at
+        logger.info(
+            f"Startup took {self.startup_timings['total']:.2f} s ("
+            + ", ".join(f"{step} {seconds:.2f} s" for step, seconds in self.startup_timings.items() if step != "total")
+            + ")"
+        )
+
+    @property
+    def client_id(self) -> int:
+        return self._client_id
 
     def _set_verbosity_level(self, level: int):
         self.execute({"@type": "setLogVerbosityLevel", "new_verbosity_level": level})
@@ -32,23 +177,124 @@ class TDLibClient:
     def _authorize(self):
         self.send({"@type": "getAuthorizationState"})
         while not self._is_authorized:
-            event = self.receive()
-            if event:
-                self._handle_event(event)
-            else:
-                time.sleep(TDLibClient.AUTHORIZE_LOOP_TIMEOUT)
+            try:
+                auth_state = self._auth_states.get(timeout=TDLibClient.AUTHORIZE_LOOP_TIMEOUT)
+            except queue.Empty:
+                continue
+            self._record_startup_step(auth_state["@type"])
+            self._handle_auth_state(auth_state)
+
+    def _record_startup_step(self, step: str) -> None:
+        """
+        Record the time spent since the previous startup step, e.g. waiting for an authorization state.
+
+        :param step: The name of the step that has just completed.
+        """
+        now = time.monotonic()
+        self.startup_timings[step] = self.startup_timings.get(step, 0.0) + now - self._startup_step_at
+        self._startup_step_at = now
+
+    def _dispatch(self, event: Dict) -> None:
+        """
+        Route an event received by the receiver thread.
+
+        Responses resolve the future of the request they answer, everything else is passed to the update
+        handlers registered for its @type.
+
+        :param event: The received event.
+        """
+        request_id = event.get("@extra")
+        if request_id is not None:
+            with self._pending_lock:
+                request = self._pending.get(request_id)
+                wait_time = parse_flood_wait(event)
+                retry = (
+                    request is not None and wait_time is not None and request.attempts <= self.MAX_FLOOD_WAIT_RETRIES
+                )
+                if retry:
+                    request.attempts += 1
+                elif request is not None:
+                    del self._pending[request_id]
+            if request is not None:
+                method = request.query["@type"]
+                now = time.monotonic()
+                if request.sent_at is not None:
+                    REQUEST_NETWORK_SECONDS.observe(now - request.sent_at, method=method)
+                if retry:
+                    FLOOD_WAIT_RETRIES.inc(method=method)
+                    FLOOD_WAIT_SECONDS.inc(wait_time, method=method)
+                    request.queued_at = now
+                    self.scheduler.on_flood_wait(method, wait_time)
+                    self.scheduler.submit(request.query)
+                    return
+                REQUESTS_IN_FLIGHT.dec(method=method)
+                REQUESTS.inc(method=method, result="error" if event["@type"] == "error" else "ok")
+                if event["@type"] != "error":
+                    self.scheduler.on_success(method)
+                try:
+                    request.future.set_result(event)
+                except InvalidStateError:
+                    pass
+                return
+
+        for handler in list(self._update_handlers.get(event["@type"], [])):
+            try:
+                handler(event)
+            except Exception:
+                logger.exception(f"Update handler failed for {event['@type']}")
+        self._handle_event(event)
+
+    def add_update_handler(
+        self, update_type: str, handler: UpdateHandler, markers: Optional[Sequence[str]] = None
+    ) -> None:
+        """
+        Register a handler that is called from the receiver thread for every event of the given @type.
+
+        :param update_type: The @type of the events, e.g. "updateUser".
+        :param handler: The callable receiving the event.
+        :param markers: Strings of which an event must contain one to be decoded for this handler, e.g. the
+            content types of the only messages it handles; every event of the @type is decoded if None. The
+            handler may still receive other events of the @type that another handler needs decoded.
+        """
+        self._update_handlers.setdefault(update_type, []).append(handler)
+        self._update_markers.setdefault(update_type, []).append(
+            None if markers is None else tuple(marker.encode("utf-8") for marker in markers)
+        )
+
+    def remove_update_handler(self, update_type: str, handler: UpdateHandler) -> None:
+        """
+        Unregister a handler previously added with add_update_handler.
+
+        :param update_type: The @type the handler was registered for.
+        :param handler: The handler to remove.
+        """
+        handlers = self._update_handlers.get(update_type, [])
+        if handler in handlers:
+            del self._update_markers[update_type][handlers.index(handler)]
+            handlers.remove(handler)
+
+    def wants(self, event_type: str, data: bytes = b"") -> bool:
+        """
+        Check whether an event is handled by this client; others are dropped undecoded.
+
+        :param event_type: The @type of an update event.
+        :param data: The undecoded event, matched against the markers of the handlers.
+        :return: True if the client itself or an update handler whose markers the event contains handles it.
+        """
+        if event_type in self.HANDLED_EVENTS:
+            return True
+        return any(
+            markers is None or any(marker in data for marker in markers)
+            for markers in self._update_markers.get(event_type, [])
+        )
 
     def _handle_event(self, event: Dict):
         if event["@type"] == "updateAuthorizationState":
-            self._handle_auth_state(event["authorization_state"])
+            self._auth_states.put(event["authorization_state"])
         elif event["@type"] == "error":
-            if event["code"] == 420 and "FLOOD_WAIT" in event["message"]:
-                wait_time = int(event["message"].split("_")[-1])
-                logger.debug(f"Необходимо подождать {wait_time} секунд из-за ограничения запросов.")
-                if input("Ожидать? [y/n]") == "y":
-                    time.sleep(wait_time)
-                else:
-                    sys.exit()
+            wait_time = parse_flood_wait(event)
+            if wait_time is not None:
+                logger.warning(f"Необходимо подождать {wait_time} секунд из-за ограничения запросов.")
             else:
                 logger.error(f"Error: {event}")
 
@@ -59,11 +305,11 @@ class TDLibClient:
                 {
                     "@type": "setTdlibParameters",
                     "use_test_dc": False,
-                    "database_directory": "tdlib",
-                    "files_directory": "tdlib",
-                    "use_file_database": False,
-                    "use_chat_info_database": False,
-                    "use_message_database": False,
+                    "database_directory": self.database_directory,
+                    "files_directory": self.database_directory,
+                    "use_file_database": self.warm_start,
+                    "use_chat_info_database": self.warm_start,
+                    "use_message_database": self.warm_start,
                     "use_secret_chats": False,
                     "api_id": self.__api_id,
                     "api_hash": self.__api_hash,
@@ -97,19 +343,123 @@ class TDLibClient:
 
     @staticmethod
     def execute(query: Dict) -> Dict:
-        query_json = json.dumps(query).encode("utf-8")
-        result = F.execute(query_json)
+        result = F.execute(TDLibClient.codec.dumps(query))
         if result:
-            result = json.loads(result.decode("utf-8"))
+            result = TDLibClient.codec.loads(result)
         return result
 
     @staticmethod
     def receive() -> Dict:
         result = F.receive(TDLibClient.RECEIVE_LOOP_TIMEOUT)
         if result:
-            result = json.loads(result.decode("utf-8"))
+            result = TDLibClient.codec.loads(result)
         return result
 
     def send(self, query: Dict) -> None:
-        query_json = json.dumps(query).encode("utf-8")
-        F.send(self._client_id, query_json)
+        request_id = query.get("@extra")
+        if request_id is not None:
+            with self._pending_lock:
+                request = self._pending.get(request_id)
+            if request is not None:
+                request.sent_at = time.monotonic()
+                REQUEST_QUEUE_SECONDS.observe(request.sent_at - request.queued_at, method=query["@type"])
+        F.send(self._client_id, self.codec.dumps(query))
+
+    def send_request(self, query: Dict) -> Future:
+        """
+        Queue a query tagged with a unique ``@extra`` value.
+
+        TDLib echoes ``@extra`` back in the response, which lets the receiver thread resolve the future of
+        this query even when several queries are in flight at once. The query is sent by the scheduler
+        as soon as the rate budget of its method allows, and resent automatically after a FLOOD_WAIT.
+
+        Lookups in COALESCED_REQUESTS that are identical to one already in flight, e.g. from another thread,
+        are not sent again: every caller gets its own future, resolved with a deep copy of the shared response, so
+        callers can modify their response without affecting the others.
+
+        :param query: The query to send.
+        :return: A future resolved with the response event (which may be an ``error`` event).
+        """
+        key = self._coalescing_key(query)
+        if key is None:
+            future: Future = Future()
+            self._send_tagged(query, future)
+            return future
+
+        with self._pending_lock:
+            shared = self._coalesced.get(key)
+            is_leader = shared is None
+            if shared is None:
+                shared = self._coalesced[key] = Future()
+        if is_leader:
+            shared.add_done_callback(lambda done: self._forget_coalesced(key, done))
+            self._send_tagged(query, shared)
+        else:
+            COALESCED_REQUESTS.inc(method=query["@type"])
+        return self._follow(shared)
+
+    def _send_tagged(self, query: Dict, future: Future) -> None:
+        request_id = str(next(self._request_ids))
+        tagged_query = {**query, "@extra": request_id}
+        with self._pending_lock:
+            closed = self._closed
+            if not closed:
+                self._pending[request_id] = _PendingRequest(tagged_query, future)
+        if closed:
+            future.set_exception(ConnectionError(f"TDLib client {self._client_id} is closed"))
+            return
+        REQUESTS_IN_FLIGHT.inc(method=query["@type"])
+        self.scheduler.submit(tagged_query)
+
+    def _coalescing_key(self, query: Dict) -> Optional[Hashable]:
+        if query["@type"] not in self.COALESCED_REQUESTS:
+            return None
+        key = tuple(sorted(query.items()))
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def _forget_coalesced(self, key: Hashable, future: Future) -> None:
+        with self._pending_lock:
+            if self._coalesced.get(key) is future:
+                del self._coalesced[key]
+
+    @staticmethod
+    def _follow(shared: Future) -> Future:
+        """
+        A future of its own for one caller of a shared request, so that cancelling it leaves the others waiting.
+        """
+        future: Future = Future()
+
+        def resolve(done: Future) -> None:
+            if not future.set_running_or_notify_cancel():
+                return
+            if done.exception() is not None:
+                future.set_exception(done.exception())
+            else:
+                future.set_result(copy.deepcopy(done.result()))
+
+        shared.add_done_callback(resolve)
+        return future
+
+    def close(self) -> None:
+        """
+        Close the TDLib instance, stop routing its events and sending its queries, and fail the futures of the
+        requests still waiting for a response with a ConnectionError.
+        """
+        self.send({"@type": "close"})
+        _receive_loop.unregister(self)
+        self.scheduler.stop()
+        with self._pending_lock:
+            self._closed = True
+            pending = list(self._pending.values())
+            self._pending.clear()
+        error = ConnectionError(f"TDLib client {self._client_id} is closed")
+        for request in pending:
+            REQUESTS_IN_FLIGHT.dec(method=request.query["@type"])
+            try:
+                request.future.set_exception(error)
+            except InvalidStateError:
+                pass
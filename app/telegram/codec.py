@@ -0,0 +1,108 @@
+import json
+import re
+from typing import Any, Dict, Optional, Protocol
+
+from loguru import logger
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# TDLib serializes @type as the first field of every object
+TYPE_PATTERN = re.compile(rb'\{\s*"@type"\s*:\s*"(\w+)"')
+
+
+class Codec(Protocol):
+    name: str
+
+    def dumps(self, query: Dict[str, Any]) -> bytes:
+        """
+        Serialize a query for td_send/td_execute.
+        """
+
+    def loads(self, data: bytes) -> Dict[str, Any]:
+        """
+        Deserialize an event returned by td_receive/td_execute.
+        """
+
+
+class JsonCodec:
+    """
+    Standard library codec, used when orjson is not installed.
+    """
+
+    name = "json"
+
+    def dumps(self, query: Dict[str, Any]) -> bytes:
+        return json.dumps(query, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+    def loads(self, data: bytes) -> Dict[str, Any]:
+        # json.loads detects the encoding of bytes before decoding them, decoding up front is faster
+        return json.loads(data.decode("utf-8"))
+
+
+class OrjsonCodec:
+    """
+    Codec backed by orjson, which parses the bytes returned by TDLib directly, without an intermediate str.
+    """
+
+    name = "orjson"
+
+    def __init__(self):
+        if orjson is None:
+            raise ImportError("orjson is not installed")
+
+    def dumps(self, query: Dict[str, Any]) -> bytes:
+        return orjson.dumps(query)
+
+    def loads(self, data: bytes) -> Dict[str, Any]:
+        return orjson.loads(data)
+
+
+CODECS = {JsonCodec.name: JsonCodec, OrjsonCodec.name: OrjsonCodec}
+
+
+def get_codec(name: Optional[str] = None) -> Codec:
+    """
+    Create a codec by name.
+
+    :param name: "json" or "orjson"; None picks orjson when it is installed and json otherwise.
+    :return: The codec, the json codec if the requested one is unavailable.
+    """
+    if name is None:
+        name = OrjsonCodec.name if orjson is not None else JsonCodec.name
+    codec_class = CODECS.get(name)
+    if codec_class is None:
+        logger.warning(f"Unknown JSON codec {name!r}, using json")
+        return JsonCodec()
+    try:
+        return codec_class()
+    except ImportError as e:
+        logger.warning(f"JSON codec {name!r} is unavailable ({e}), using json")
+        return JsonCodec()
+
+
+def peek_type(data: bytes) -> Optional[str]:
+    """
+    Read the @type of a serialized event without decoding it.
+
+    :param data: The event as returned by td_receive.
+    :return: The @type, or None if it is not the first field.
+    """
+    match = TYPE_PATTERN.match(data)
+    if match is None:
+        return None
+    return match.group(1).decode("ascii")
+
+
+def is_response(data: bytes) -> bool:
+    """
+    Check whether a serialized event may be the response to a request.
+
+    May return True for an update that merely contains the text ``"@extra"``, never False for a response.
+
+    :param data: The event as returned by td_receive.
+    :return: True if the event has to be decoded to resolve a pending request.
+    """
+    return b'"@extra"' in data
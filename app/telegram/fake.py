@@ -0,0 +1,534 @@
+import bisect
+import heapq
+import itertools
+import math
+import random
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Deque, Dict, List, Optional, Sequence, Set, Tuple
+
+from app.telegram.codec import get_codec
+
+MY_USER_ID = 1
+MAX_BASIC_GROUP_SIZE = 200
+MAX_MEMBERS_PAGE = 200
+MAX_MEMBERS_OFFSET = 10000
+MAX_HISTORY_PAGE = 100
+MESSAGE_INTERVAL = 600
+# One first name per initial, so that searching members by name prefix reaches every one of them
+FIRST_NAMES = (
+    "Alex",
+    "Boris",
+    "Chen",
+    "Dana",
+    "Elena",
+    "Farid",
+    "Gosha",
+    "Hana",
+    "Igor",
+    "Jamal",
+    "Kate",
+    "Lena",
+    "Maria",
+    "Nikita",
+    "Olga",
+    "Pavel",
+    "Quinn",
+    "Roman",
+    "Sofya",
+    "Timur",
+    "Ulyana",
+    "Vera",
+    "Wei",
+    "Xenia",
+    "Yuri",
+    "Zara",
+)
+
+
+class FakeGroup:
+    __slots__ = ("index", "chat_id", "kind", "group_id", "title", "username", "members", "messages")
+
+    def __init__(self, index: int, members: List[int]):
+        self.index = index
+        self.members = members
+        self.messages: List[Dict[str, Any]] = []
+        self.title = f"Group {index}"
+        self.username = f"group{index}"
+        if len(members) <= MAX_BASIC_GROUP_SIZE:
+            self.kind = "basicGroup"
+            self.group_id = index + 1
+            self.chat_id = -self.group_id
+        else:
+            self.kind = "supergroup"
+            self.group_id = 1000000 + index
+            self.chat_id = -1000000000000 - self.group_id
+
+
+class _FakeSession:
+    """
+    Per-client state: what this TDLib instance has already told its client.
+    """
+
+    def __init__(self, client_id: int):
+        self.client_id = client_id
+        self.due = 0.0
+        self.authorized = False
+        self.loaded_chats = 0
+        self.known_users: Set[int] = set()
+        self.sent_at: Dict[str, Deque[float]] = {}
+        self.flood_until: Dict[str, float] = {}
+
+
+class FakeTelegram:
+    """
+    In-process stand-in for libtdjson with a synthetic account.
+
+    The account (user 1) is a member of groups of the given sizes, filled with members drawn from a pool of
+    synthetic users. Groups of up to 200 members are basic groups, larger ones supergroups. Like TDLib, the
+    fake pushes ``updateUser``/``updateNewChat``/``updateBasicGroup``/``updateSupergroup`` before the responses
+    referencing them, answers after ``latency`` seconds and replies ``420 FLOOD_WAIT_X`` to a method sent
+    more than ``flood_limits[method]`` times within a second.
+
+    Like Telegram, getSupergroupMembers lists no member past offset 10000, and supports searching members by
+    name prefix with supergroupMembersFilterSearch.
+    """
+
+    def __init__(
+        self,
+        group_sizes: Sequence[int] = (10, 50, 300),
+        user_count: Optional[int] = None,
+        latency: float = 0.0,
+        flood_limits: Optional[Dict[str, int]] = None,
+        flood_wait: int = 1,
+        seed: int = 0,
+        messages_per_group: int = 0,
+    ):
+        """
+        Initialize the FakeTelegram.
+
+        :param group_sizes: The number of members of every group, the account included.
+        :param user_count: The number of synthetic users members are drawn from, twice the largest group if omitted.
+        :param latency: Seconds between a request and its response.
+        :param flood_limits: Requests per second per method above which FLOOD_WAIT is returned.
+        :param flood_wait: The number of seconds FLOOD_WAIT asks to wait.
+        :param seed: Seed of the synthetic memberships.
+        :param messages_per_group: The number of text messages in the history of every group, sent by random members
+            every ten minutes up to now.
+        """
+        self.latency = latency
+        self.flood_limits = flood_limits or {}
+        self.flood_wait = flood_wait
+        self.codec = get_codec()
+        self.requests = 0
+        self.flood_errors = 0
+
+        rng = random.Random(seed)
+        user_count = user_count or 2 * max(group_sizes, default=1)
+        other_users = range(MY_USER_ID + 1, MY_USER_ID + 1 + user_count)
+        self.groups = [
+            FakeGroup(index, [MY_USER_ID] + rng.sample(other_users, min(size - 1, user_count)))
+            for index, size in enumerate(group_sizes)
+        ]
+        self.groups_by_chat_id = {group.chat_id: group for group in self.groups}
+        self.groups_by_id = {(group.kind, group.group_id): group for group in self.groups}
+        self.user_chats: Dict[int, List[int]] = {}
+        for group in self.groups:
+            for user_id in group.members:
+                self.user_chats.setdefault(user_id, []).append(group.chat_id)
+
+        self._search_results: Dict[Tuple[int, str], List[int]] = {}
+        self._sessions: Dict[int, _FakeSession] = {}
+        self._client_ids = itertools.count(1)
+        self._sequence = itertools.count()
+        now = int(time.time())
+        for group in self.groups:
+            for index in range(messages_per_group):
+                sender_id = rng.choice(group.members)
+                date = now - (messages_per_group - index) * MESSAGE_INTERVAL
+                group.messages.append(self._message(group, sender_id, {"@type": "messageText"}, date))
+        self._events: List[Tuple[float, int, bytes]] = []
+        self._condition = threading.Condition()
+        self._handlers: Dict[str, Callable[[_FakeSession, Dict[str, Any]], Optional[Dict[str, Any]]]] = {
+            "getAuthorizationState": self._get_authorization_state,
+            "setTdlibParameters": self._set_tdlib_parameters,
+            "checkDatabaseEncryptionKey": self._ok,
+            "close": self._close,
+            "getMe": lambda session, query: self._user(MY_USER_ID),
+            "getUser": self._get_user,
+            "getChat": self._get_chat,
+            "searchPublicChat": self._search_public_chat,
+            "loadChats": self._load_chats,
+            "getBasicGroup": self._get_basic_group,
+            "getBasicGroupFullInfo": self._get_basic_group_full_info,
+            "getSupergroup": self._get_supergroup,
+            "getSupergroupMembers": self._get_supergroup_members,
+            "getGroupsInCommon": self._get_groups_in_common,
+            "getChatHistory": self._get_chat_history,
+        }
+
+    def create_client_id(self) -> int:
+        client_id = next(self._client_ids)
+        self._sessions[client_id] = _FakeSession(client_id)
+        return client_id
+
+    def send(self, client_id: int, query: bytes) -> None:
+        request = self.codec.loads(query)
+        session = self._sessions[client_id]
+        self.requests += 1
+        method = request["@type"]
+        # Updates pushed while handling the request are delivered together with, and before, its response
+        session.due = time.monotonic() + self.latency
+
+        response = self._check_flood(session, method)
+        if response is None:
+            handler = self._handlers.get(method)
+            if handler is None:
+                response = self._error(400, f"Method {method} is not supported by FakeTelegram")
+            else:
+                response = handler(session, request) or self._ok(session, request)
+        if "@extra" in request:
+            response["@extra"] = request["@extra"]
+        self._push(client_id, response, session.due)
+
+    def receive(self, timeout: float) -> Optional[bytes]:
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                if self._events and self._events[0][0] <= now:
+                    return heapq.heappop(self._events)[2]
+                if now >= deadline:
+                    return None
+                wait_until = min(deadline, self._events[0][0]) if self._events else deadline
+                self._condition.wait(wait_until - now)
+
+    def execute(self, query: bytes) -> Optional[bytes]:
+        request = self.codec.loads(query)
+        if request["@type"] == "setLogVerbosityLevel":
+            return self.codec.dumps({"@type": "ok"})
+        return self.codec.dumps(self._error(400, f"Method {request['@type']} can't be executed synchronously"))
+
+    def add_member(self, chat_id: int, user_id: int) -> None:
+        """
+        Add a user to a group and announce it with a messageChatAddMembers service message.
+
+        :param chat_id: The ID of the group chat.
+        :param user_id: The ID of the joining user.
+        """
+        group = self.groups_by_chat_id[chat_id]
+        group.members.append(user_id)
+        self._search_results.clear()
+        self.user_chats.setdefault(user_id, []).append(chat_id)
+        content = {"@type": "messageChatAddMembers", "member_user_ids": [user_id]}
+        self._broadcast_message(group, MY_USER_ID, content, [user_id])
+
+    def remove_member(self, chat_id: int, user_id: int) -> None:
+        """
+        Remove a user from a group and announce it with a messageChatDeleteMember service message.
+
+        :param chat_id: The ID of the group chat.
+        :param user_id: The ID of the leaving user.
+        """
+        group = self.groups_by_chat_id[chat_id]
+        group.members.remove(user_id)
+        self._search_results.clear()
+        self.user_chats[user_id].remove(chat_id)
+        self._broadcast_message(group, MY_USER_ID, {"@type": "messageChatDeleteMember", "user_id": user_id}, [])
+
+    def post_message(self, chat_id: int, user_id: int, date: Optional[int] = None) -> Dict[str, Any]:
+        """
+        Send a text message to a group on behalf of a member.
+
+        :param chat_id: The ID of the group chat.
+        :param user_id: The ID of the sender.
+        :param date: The Unix time of the message, now if omitted.
+        :return: The message.
+        """
+        group = self.groups_by_chat_id[chat_id]
+        return self._broadcast_message(group, user_id, {"@type": "messageText"}, [user_id], date)
+
+    def rename_chat(self, chat_id: int, title: str) -> None:
+        """
+        Change the title of a group and announce it with updateChatTitle.
+
+        :param chat_id: The ID of the group chat.
+        :param title: The new title.
+        """
+        self.groups_by_chat_id[chat_id].title = title
+        for session in self._sessions.values():
+            if session.authorized:
+                session.due = time.monotonic()
+                self._push_update(session, {"@type": "updateChatTitle", "chat_id": chat_id, "title": title})
+
+    def leave_chat(self, chat_id: int) -> None:
+        """
+        Make the account leave a group: it disappears from the common groups of every member.
+
+        :param chat_id: The ID of the group chat.
+        """
+        group = self.groups_by_chat_id.pop(chat_id)
+        del self.groups_by_id[(group.kind, group.group_id)]
+        self.groups.remove(group)
+        for user_id in group.members:
+            self.user_chats[user_id].remove(chat_id)
+        field = "basic_group" if group.kind == "basicGroup" else "supergroup"
+        update = {
+            "@type": "updateBasicGroup" if group.kind == "basicGroup" else "updateSupergroup",
+            field: {**self._group(group), "status": {"@type": "chatMemberStatusLeft"}},
+        }
+        for session in self._sessions.values():
+            if session.authorized:
+                session.due = time.monotonic()
+                self._push_update(session, dict(update))
+
+    def _message(self, group: FakeGroup, sender_id: int, content: Dict[str, Any], date: int) -> Dict[str, Any]:
+        # Like server message IDs, IDs grow with time and are multiples of 2^20
+        return {
+            "@type": "message",
+            "id": (next(self._sequence) + 1) << 20,
+            "chat_id": group.chat_id,
+            "sender_id": {"@type": "messageSenderUser", "user_id": sender_id},
+            "date": date,
+            "content": content,
+        }
+
+    def _broadcast_message(
+        self,
+        group: FakeGroup,
+        sender_id: int,
+        content: Dict[str, Any],
+        introduced_users: Sequence[int],
+        date: Optional[int] = None,
+    ) -> Dict[str, Any]:
+        message = self._message(group, sender_id, content, int(time.time()) if date is None else date)
+        group.messages.append(message)
+        for session in self._sessions.values():
+            if session.authorized:
+                session.due = time.monotonic()
+                self._introduce_users(session, introduced_users)
+                self._push_update(session, {"@type": "updateNewMessage", "message": message})
+        return message
+
+    def get_common_chats_count(self, user_id: int) -> int:
+        """
+        The number of groups shared with a user, as getGroupsInCommon reports it.
+
+        :param user_id: The ID of the user.
+        :return: The number of groups of the account the user is a member of.
+        """
+        return len(self.user_chats.get(user_id, []))
+
+    def _push(self, client_id: int, event: Dict[str, Any], due: float) -> None:
+        event["@client_id"] = client_id
+        data = self.codec.dumps(event)
+        with self._condition:
+            heapq.heappush(self._events, (due, next(self._sequence), data))
+            self._condition.notify()
+
+    def _push_update(self, session: _FakeSession, update: Dict[str, Any]) -> None:
+        self._push(session.client_id, update, session.due)
+
+    def _check_flood(self, session: _FakeSession, method: str) -> Optional[Dict[str, Any]]:
+        limit = self.flood_limits.get(method)
+        if limit is None:
+            return None
+        now = time.monotonic()
+        flood_until = session.flood_until.get(method, 0.0)
+        if now < flood_until:
+            self.flood_errors += 1
+            return self._error(420, f"FLOOD_WAIT_{math.ceil(flood_until - now)}")
+        sent_at = session.sent_at.setdefault(method, deque())
+        while sent_at and sent_at[0] <= now - 1:
+            sent_at.popleft()
+        if len(sent_at) >= limit:
+            session.flood_until[method] = now + self.flood_wait
+            self.flood_errors += 1
+            return self._error(420, f"FLOOD_WAIT_{self.flood_wait}")
+        sent_at.append(now)
+        return None
+
+    @staticmethod
+    def _ok(session: _FakeSession, request: Dict[str, Any]) -> Dict[str, Any]:
+        return {"@type": "ok"}
+
+    @staticmethod
+    def _error(code: int, message: str) -> Dict[str, Any]:
+        return {"@type": "error", "code": code, "message": message}
+
+    def _authorization_state(self, session: _FakeSession, state: str) -> None:
+        self._push_update(session, {"@type": "updateAuthorizationState", "authorization_state": {"@type": state}})
+
+    def _get_authorization_state(self, session: _FakeSession, request: Dict[str, Any]) -> Dict[str, Any]:
+        state = "authorizationStateReady" if session.authorized else "authorizationStateWaitTdlibParameters"
+        self._authorization_state(session, state)
+        return {"@type": state}
+
+    def _set_tdlib_parameters(self, session: _FakeSession, request: Dict[str, Any]) -> None:
+        session.authorized = True
+        self._authorization_state(session, "authorizationStateReady")
+
+    def _close(self, session: _FakeSession, request: Dict[str, Any]) -> None:
+        session.authorized = False
+        self._authorization_state(session, "authorizationStateClosed")
+
+    def get_user_name(self, user_id: int) -> str:
+        """
+        The first and last name of a user, as ChatMemberService formats them.
+        """
+        user = self._user(user_id)
+        return f"{user['first_name']} {user['last_name']}"
+
+    def _user(self, user_id: int) -> Dict[str, Any]:
+        return {
+            "@type": "user",
+            "id": user_id,
+            "first_name": "Me" if user_id == MY_USER_ID else FIRST_NAMES[user_id % len(FIRST_NAMES)],
+            "last_name": "" if user_id == MY_USER_ID else str(user_id),
+            "status": {"@type": "userStatusEmpty"},
+        }
+
+    def _introduce_users(self, session: _FakeSession, user_ids: Sequence[int]) -> None:
+        for user_id in user_ids:
+            if user_id not in session.known_users:
+                session.known_users.add(user_id)
+                self._push_update(session, {"@type": "updateUser", "user": self._user(user_id)})
+
+    def _get_user(self, session: _FakeSession, request: Dict[str, Any]) -> Dict[str, Any]:
+        if request["user_id"] not in session.known_users and request["user_id"] != MY_USER_ID:
+            return self._error(404, "User not found")
+        return self._user(request["user_id"])
+
+    def _chat(self, group: FakeGroup, order: int = 0) -> Dict[str, Any]:
+        chat_type: Dict[str, Any]
+        if group.kind == "basicGroup":
+            chat_type = {"@type": "chatTypeBasicGroup", "basic_group_id": group.group_id}
+        else:
+            chat_type = {"@type": "chatTypeSupergroup", "supergroup_id": group.group_id, "is_channel": False}
+        positions = []
+        if order:
+            positions.append(
+                {"@type": "chatPosition", "list": {"@type": "chatListMain"}, "order": str(order), "is_pinned": False}
+            )
+        return {"@type": "chat", "id": group.chat_id, "type": chat_type, "title": group.title, "positions": positions}
+
+    def _group(self, group: FakeGroup) -> Dict[str, Any]:
+        if group.kind == "basicGroup":
+            return {
+                "@type": "basicGroup",
+                "id": group.group_id,
+                "member_count": len(group.members),
+                "status": {"@type": "chatMemberStatusMember"},
+                "is_active": True,
+            }
+        return {
+            "@type": "supergroup",
+            "id": group.group_id,
+            "usernames": {"@type": "usernames", "active_usernames": [group.username]},
+            "member_count": len(group.members),
+            "status": {"@type": "chatMemberStatusMember"},
+            "is_channel": False,
+        }
+
+    def _get_chat(self, session: _FakeSession, request: Dict[str, Any]) -> Dict[str, Any]:
+        group = self.groups_by_chat_id.get(request["chat_id"])
+        if group is None:
+            return self._error(400, "Chat not found")
+        return self._chat(group)
+
+    def _search_public_chat(self, session: _FakeSession, request: Dict[str, Any]) -> Dict[str, Any]:
+        group = next((group for group in self.groups if group.username == request["username"].lstrip("@")), None)
+        if group is None:
+            return self._error(400, "USERNAME_NOT_OCCUPIED")
+        return self._chat(group)
+
+    def _load_chats(self, session: _FakeSession, request: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        if session.loaded_chats >= len(self.groups):
+            return self._error(404, "Not Found")
+        page = self.groups[session.loaded_chats : session.loaded_chats + request.get("limit", 100)]
+        for group in page:
+            update_type = "updateBasicGroup" if group.kind == "basicGroup" else "updateSupergroup"
+            field = "basic_group" if group.kind == "basicGroup" else "supergroup"
+            self._push_update(session, {"@type": update_type, field: self._group(group)})
+            order = len(self.groups) - group.index
+            self._push_update(session, {"@type": "updateNewChat", "chat": self._chat(group, order)})
+        session.loaded_chats += len(page)
+        return None
+
+    def _get_basic_group(self, session: _FakeSession, request: Dict[str, Any]) -> Dict[str, Any]:
+        group = self.groups_by_id.get(("basicGroup", request["basic_group_id"]))
+        if group is None:
+            return self._error(400, "Basic group not found")
+        return self._group(group)
+
+    def _get_supergroup(self, session: _FakeSession, request: Dict[str, Any]) -> Dict[str, Any]:
+        group = self.groups_by_id.get(("supergroup", request["supergroup_id"]))
+        if group is None:
+            return self._error(400, "Supergroup not found")
+        return self._group(group)
+
+    @staticmethod
+    def _members(user_ids: Sequence[int]) -> List[Dict[str, Any]]:
+        return [
+            {
+                "@type": "chatMember",
+                "member_id": {"@type": "messageSenderUser", "user_id": user_id},
+                "inviter_user_id": MY_USER_ID,
+                "joined_chat_date": 1700000000,
+                "status": {"@type": "chatMemberStatusMember"},
+            }
+            for user_id in user_ids
+        ]
+
+    def _get_basic_group_full_info(self, session: _FakeSession, request: Dict[str, Any]) -> Dict[str, Any]:
+        group = self.groups_by_id.get(("basicGroup", request["basic_group_id"]))
+        if group is None:
+            return self._error(400, "Basic group not found")
+        self._introduce_users(session, group.members)
+        return {"@type": "basicGroupFullInfo", "creator_user_id": MY_USER_ID, "members": self._members(group.members)}
+
+    def _get_supergroup_members(self, session: _FakeSession, request: Dict[str, Any]) -> Dict[str, Any]:
+        group = self.groups_by_id.get(("supergroup", request["supergroup_id"]))
+        if group is None:
+            return self._error(400, "Supergroup not found")
+        member_filter = request.get("filter") or {}
+        user_ids = group.members
+        if member_filter.get("@type") == "supergroupMembersFilterSearch":
+            user_ids = self._search_members(group, member_filter.get("query", ""))
+        offset = request.get("offset", 0)
+        end = min(offset + min(request.get("limit", MAX_MEMBERS_PAGE), MAX_MEMBERS_PAGE), MAX_MEMBERS_OFFSET)
+        page = user_ids[offset:end]
+        self._introduce_users(session, page)
+        return {"@type": "chatMembers", "total_count": len(user_ids), "members": self._members(page)}
+
+    def _search_members(self, group: FakeGroup, query: str) -> List[int]:
+        """
+        The members of a group with a word of their name starting with the query, case-insensitively.
+        """
+        key = (group.chat_id, query.lower())
+        if key not in self._search_results:
+            self._search_results[key] = [
+                user_id
+                for user_id in group.members
+                if any(word.startswith(key[1]) for word in self.get_user_name(user_id).lower().split())
+            ]
+        return self._search_results[key]
+
+    def _get_groups_in_common(self, session: _FakeSession, request: Dict[str, Any]) -> Dict[str, Any]:
+        if request["user_id"] not in session.known_users:
+            return self._error(400, "User not found")
+        chat_ids = self.user_chats.get(request["user_id"], [])[: request.get("limit", 100)]
+        return {"@type": "chats", "total_count": len(chat_ids), "chat_ids": chat_ids}
+
+    def _get_chat_history(self, session: _FakeSession, request: Dict[str, Any]) -> Dict[str, Any]:
+        group = self.groups_by_chat_id.get(request["chat_id"])
+        if group is None:
+            return self._error(400, "Chat not found")
+        # Messages from from_message_id (inclusive, the newest message if 0) back in time, newest first
+        from_message_id = request.get("from_message_id", 0) or math.inf
+        end = bisect.bisect_right([message["id"] for message in group.messages], from_message_id)
+        limit = min(request.get("limit", MAX_HISTORY_PAGE), MAX_HISTORY_PAGE)
+        messages = group.messages[max(end - limit, 0) : end][::-1]
+        self._introduce_users(session, [message["sender_id"]["user_id"] for message in messages])
+        return {"@type": "messages", "total_count": len(messages), "messages": messages}
@@ -1,44 +1,126 @@
 import os
 import sys
 from ctypes import CDLL, CFUNCTYPE, c_char_p, c_double, c_int
+from typing import Optional, Protocol
 
 from dotenv import load_dotenv
 
 load_dotenv()
 
-# Load shared library
-tdjson_path = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), "libtdjson.so")
-tdjson = CDLL(tdjson_path)
+TDJSON_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), "libtdjson.so")
 
-# Load TDLib functions from shared library
-create_client_id = tdjson.td_create_client_id
-create_client_id.restype = c_int
-create_client_id.argtypes = []
+log_message_callback_type = CFUNCTYPE(None, c_int, c_char_p)
 
-receive = tdjson.td_receive
-receive.restype = c_char_p
-receive.argtypes = [c_double]
 
-send = tdjson.td_send
-send.restype = None
-send.argtypes = [c_int, c_char_p]
+class Backend(Protocol):
+    """
+    The tdjson interface: a client ID per TDLib instance, JSON bytes in and out.
+    """
 
-execute = tdjson.td_execute
-execute.restype = c_char_p
-execute.argtypes = [c_char_p]
+    def create_client_id(self) -> int:
+        """
+        Create a TDLib instance and return its client ID.
+        """
 
-log_message_callback_type = CFUNCTYPE(None, c_int, c_char_p)
+    def send(self, client_id: int, query: bytes) -> None:
+        """
+        Send a query to a TDLib instance; the response arrives through receive.
+        """
+
+    def receive(self, timeout: float) -> Optional[bytes]:
+        """
+        Wait up to timeout seconds for the next event of any TDLib instance.
+        """
+
+    def execute(self, query: bytes) -> Optional[bytes]:
+        """
+        Execute a synchronous query.
+        """
+
+
+class TDJsonBackend:
+    """
+    The real TDLib, loaded from libtdjson.so via ctypes.
+    """
+
+    def __init__(self, path: str = TDJSON_PATH):
+        # Load shared library
+        tdjson = CDLL(path)
 
-set_log_message_callback = tdjson.td_set_log_message_callback
-set_log_message_callback.restype = None
-set_log_message_callback.argtypes = [c_int, log_message_callback_type]
+        # Load TDLib functions from shared library
+        self.create_client_id = tdjson.td_create_client_id
+        self.create_client_id.restype = c_int
+        self.create_client_id.argtypes = []
+
+        self.receive = tdjson.td_receive
+        self.receive.restype = c_char_p
+        self.receive.argtypes = [c_double]
+
+        self.send = tdjson.td_send
+        self.send.restype = None
+        self.send.argtypes = [c_int, c_char_p]
+
+        self.execute = tdjson.td_execute
+        self.execute.restype = c_char_p
+        self.execute.argtypes = [c_char_p]
+
+        set_log_message_callback = tdjson.td_set_log_message_callback
+        set_log_message_callback.restype = None
+        set_log_message_callback.argtypes = [c_int, log_message_callback_type]
+
+        # Initialize TDLib log with desired parameters; the callback is kept alive as long as the backend
+        self._on_log_message = log_message_callback_type(on_log_message_callback)
+        set_log_message_callback(int(os.getenv("TDLIB_LOGGING_LEVEL", 2)), self._on_log_message)
 
 
-# Initialize TDLib log with desired parameters
-@log_message_callback_type
 def on_log_message_callback(verbosity_level: int, message: str) -> None:
     if verbosity_level == 0:
         sys.exit(f"TDLib fatal error: {message!r}")
 
 
-set_log_message_callback(int(os.getenv("TDLIB_LOGGING_LEVEL", 2)), on_log_message_callback)
+_backend: Optional[Backend] = None
+
+
+def get_backend() -> Backend:
+    """
+    Return the backend, loading it on first use.
+
+    ``TDLIB_BACKEND=fake`` selects the in-process fake Telegram, anything else loads libtdjson.so.
+
+    :return: The current backend.
+    """
+    global _backend
+    if _backend is None:
+        if os.getenv("TDLIB_BACKEND", "tdjson") == "fake":
+            from app.telegram.fake import FakeTelegram
+
+            _backend = FakeTelegram()
+        else:
+            _backend = TDJsonBackend()
+    return _backend
+
+
+def set_backend(backend: Optional[Backend]) -> None:
+    """
+    Replace the backend, e.g. with a configured FakeTelegram; None loads the default one on next use.
+
+    :param backend: The backend to use from now on.
+    """
+    global _backend
+    _backend = backend
+
+
+def create_client_id() -> int:
+    return get_backend().create_client_id()
+
+
+def send(client_id: int, query: bytes) -> None:
+    get_backend().send(client_id, query)
+
+
+def receive(timeout: float) -> Optional[bytes]:
+    return get_backend().receive(timeout)
+
+
+def execute(query: bytes) -> Optional[bytes]:
+    return get_backend().execute(query)
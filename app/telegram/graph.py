@@ -0,0 +1,239 @@
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from loguru import logger
+
+from app.telegram.membership import CoMembershipMatrix
+
+
+def _pair_counts(columns: np.ndarray, row_indptr: np.ndarray, n_columns: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Count the rows shared by every pair of columns, from the column indices of the entries in row order.
+
+    Every entry is paired with the entries after it in its row, so a row of d entries yields d * (d - 1) / 2
+    pairs, and a pair (i, j) with i < j is encoded as i * n_columns + j.
+
+    :param columns: The column of every entry, rows one after another, ascending within each row.
+    :param row_indptr: Offsets into columns where every row starts.
+    :param n_columns: The number of columns.
+    :return: The encoded pairs sharing at least one row and the number of rows they share.
+    """
+    degrees = np.diff(row_indptr)
+    positions = np.arange(len(columns)) - np.repeat(row_indptr[:-1], degrees)
+    partners = np.repeat(degrees, degrees) - 1 - positions
+    left = np.repeat(np.arange(len(columns)), partners)
+    starts = np.cumsum(partners) - partners
+    right = left + 1 + np.arange(len(left)) - np.repeat(starts, partners)
+    keys = columns[left] * n_columns + columns[right]
+    return np.unique(keys, return_counts=True)
+
+
+def _label_propagation(
+    n_nodes: int, sources: np.ndarray, targets: np.ndarray, weights: np.ndarray, max_iterations: int, seed: int
+) -> np.ndarray:
+    """
+    Weighted label propagation: every node repeatedly takes the label with the largest total edge weight
+    among its neighbors, keeping its own label on ties.
+
+    Each round updates a random half of the nodes, which prevents two neighbors from swapping labels forever.
+
+    :return: The label of every node, the index of a node of its community.
+    """
+    labels = np.arange(n_nodes)
+    if len(sources) == 0:
+        return labels
+    nodes = np.concatenate([sources, targets])
+    neighbors = np.concatenate([targets, sources])
+    weights = np.concatenate([weights, weights])
+    rng = np.random.default_rng(seed)
+    for _ in range(max_iterations):
+        keys, inverse = np.unique(nodes * n_nodes + labels[neighbors], return_inverse=True)
+        totals = np.bincount(inverse, weights=weights)
+        key_nodes, key_labels = np.divmod(keys, n_nodes)
+        order = np.lexsort((key_labels, key_labels != labels[key_nodes], -totals, key_nodes))
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = key_nodes[order][1:] != key_nodes[order][:-1]
+        best = labels.copy()
+        best[key_nodes[order][first]] = key_labels[order][first]
+        changed = best != labels
+        if not changed.any():
+            break
+        update = changed & (rng.random(n_nodes) < 0.5)
+        labels[update] = best[update]
+    return labels
+
+
+class GroupGraph:
+    """
+    Similarity graph of groups: an edge joins two groups sharing members, weighted by the Jaccard similarity of
+    their member sets, and groups are clustered into communities.
+
+    Overlaps are computed for all pairs at once from a CoMembershipMatrix, by pairing the groups of every member,
+    so the cost grows with the sum of the squared number of groups of every member rather than with the square
+    of the number of groups, and no request is sent.
+    """
+
+    MIN_SIMILARITY = 0.05
+    MAX_NEIGHBORS = 5
+    MAX_PAIRS_PER_CHUNK = 1 << 22
+
+    def __init__(
+        self,
+        chat_ids: np.ndarray,
+        sizes: np.ndarray,
+        sources: np.ndarray,
+        targets: np.ndarray,
+        overlaps: np.ndarray,
+        similarities: np.ndarray,
+        communities: np.ndarray,
+    ):
+        """
+        Initialize the GroupGraph. Use from_matrix to build one.
+
+        :param chat_ids: The chat ID of every node.
+        :param sizes: The number of members of every node.
+        :param sources: The node index of the first group of every edge.
+        :param targets: The node index of the second group of every edge.
+        :param overlaps: The number of members shared by the groups of every edge.
+        :param similarities: The Jaccard similarity of every edge.
+        :param communities: The community of every node, 0 for the largest community.
+        """
+        self.chat_ids = chat_ids
+        self.sizes = sizes
+        self.sources = sources
+        self.targets = targets
+        self.overlaps = overlaps
+        self.similarities = similarities
+        self.communities = communities
+
+    @classmethod
+    def from_matrix(
+        cls,
+        matrix: CoMembershipMatrix,
+        min_similarity: float = MIN_SIMILARITY,
+        max_neighbors: Optional[int] = MAX_NEIGHBORS,
+        max_iterations: int = 30,
+        seed: int = 0,
+    ) -> "GroupGraph":
+        """
+        Build the graph of the groups of a co-membership matrix.
+
+        :param matrix: The members of every group.
+        :param min_similarity: Edges with a lower Jaccard similarity are dropped.
+        :param max_neighbors: Keep only the edges that are among the strongest of either of their groups;
+            None keeps all edges above min_similarity.
+        :param max_iterations: The maximum number of label propagation rounds.
+        :param seed: Seed of the label propagation.
+        :return: The GroupGraph.
+        """
+        n_columns = len(matrix.chat_ids)
+        sizes = np.diff(matrix.indptr)
+        sources, targets, overlaps = cls._overlaps(matrix)
+        similarities = overlaps / (sizes[sources] + sizes[targets] - overlaps)
+
+        keep = similarities >= min_similarity
+        sources, targets, overlaps, similarities = sources[keep], targets[keep], overlaps[keep], similarities[keep]
+        labels = _label_propagation(n_columns, sources, targets, similarities, max_iterations, seed)
+        if max_neighbors is not None:
+            keep = cls._strongest_edges(n_columns, sources, targets, similarities, max_neighbors)
+            sources, targets, overlaps, similarities = sources[keep], targets[keep], overlaps[keep], similarities[keep]
+
+        # Number communities by decreasing size
+        _, labels, community_sizes = np.unique(labels, return_inverse=True, return_counts=True)
+        ranks = np.empty(len(community_sizes), dtype=np.int64)
+        ranks[np.argsort(-community_sizes, kind="stable")] = np.arange(len(community_sizes))
+        order = np.argsort(-similarities, kind="stable")
+        logger.info(f"Built graph of {n_columns} groups, {len(order)} edges, {len(community_sizes)} communities")
+        return cls(
+            matrix.chat_ids,
+            sizes,
+            sources[order],
+            targets[order],
+            overlaps[order],
+            similarities[order],
+            ranks[labels],
+        )
+
+    @classmethod
+    def _overlaps(cls, matrix: CoMembershipMatrix) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Count the members shared by every pair of groups sharing any.
+
+        Members are processed in chunks of about MAX_PAIRS_PER_CHUNK pairs to bound the memory used.
+
+        :return: The first and second node of every pair, and the number of members they share.
+        """
+        n_columns = len(matrix.chat_ids)
+        order, row_indptr = matrix._get_rows()
+        columns = np.searchsorted(matrix.indptr, order, side="right") - 1
+        degrees = np.diff(row_indptr)
+        pair_totals = np.cumsum(degrees * (degrees - 1) // 2)
+        total_pairs = int(pair_totals[-1]) if len(pair_totals) else 0
+        bounds = np.searchsorted(pair_totals, np.arange(cls.MAX_PAIRS_PER_CHUNK, total_pairs, cls.MAX_PAIRS_PER_CHUNK))
+
+        chunks_keys, chunks_counts = [], []
+        for start, end in zip(np.concatenate([[0], bounds]), np.concatenate([bounds, [len(degrees)]])):
+            if end == start:
+                continue
+            chunk_indptr = row_indptr[start : end + 1]
+            chunk_columns = columns[chunk_indptr[0] : chunk_indptr[-1]]
+            keys, counts = _pair_counts(chunk_columns, chunk_indptr - chunk_indptr[0], n_columns)
+            chunks_keys.append(keys)
+            chunks_counts.append(counts)
+        if not chunks_keys:
+            empty = np.empty(0, dtype=np.int64)
+            return empty, empty, empty
+        keys, inverse = np.unique(np.concatenate(chunks_keys), return_inverse=True)
+        overlaps = np.bincount(inverse, weights=np.concatenate(chunks_counts)).astype(np.int64)
+        sources, targets = np.divmod(keys, n_columns)
+        return sources, targets, overlaps
+
+    @staticmethod
+    def _strongest_edges(
+        n_nodes: int, sources: np.ndarray, targets: np.ndarray, similarities: np.ndarray, max_neighbors: int
+    ) -> np.ndarray:
+        """
+        Select the edges that are among the max_neighbors most similar of either of their nodes.
+
+        :return: A boolean mask over the edges.
+        """
+        nodes = np.concatenate([sources, targets])
+        edges = np.tile(np.arange(len(sources)), 2)
+        order = np.lexsort((-np.concatenate([similarities, similarities]), nodes))
+        starts = np.searchsorted(nodes[order], np.arange(n_nodes))
+        ranks = np.arange(len(order)) - starts[nodes[order]]
+        keep = np.zeros(len(sources), dtype=bool)
+        keep[edges[order][ranks < max_neighbors]] = True
+        return keep
+
+    @property
+    def community_count(self) -> int:
+        return int(self.communities.max()) + 1 if len(self.communities) else 0
+
+    def get_community(self, chat_id: int) -> Optional[np.ndarray]:
+        """
+        Retrieve the groups of the community of a group.
+
+        :param chat_id: The ID of the group chat.
+        :return: The chat IDs of the community, the group included, or None if the group is not in the graph.
+        """
+        nodes = np.flatnonzero(self.chat_ids == chat_id)
+        if len(nodes) == 0:
+            return None
+        return self.chat_ids[self.communities == self.communities[nodes[0]]]
+
+    def edges(self, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        """
+        The edges, most similar first.
+
+        :param limit: The maximum number of edges.
+        :return: Dictionaries with the chat IDs of both groups, their overlap and their similarity.
+        """
+        sources = self.chat_ids[self.sources[:limit]].tolist()
+        targets = self.chat_ids[self.targets[:limit]].tolist()
+        return [
+            {"source": source, "target": target, "overlap": overlap, "similarity": similarity}
+            for source, target, overlap, similarity in zip(
+                sources, targets, self.overlaps[:limit].tolist(), self.similarities[:limit].tolist()
+            )
+        ]
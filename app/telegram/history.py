@@ -0,0 +1,303 @@
+import os
+import sqlite3
+import threading
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+from dotenv import load_dotenv
+from loguru import logger
+
+from app.telegram.processor import ChatMemberService
+
+load_dotenv()
+
+# Service messages are not counted as activity
+SERVICE_MESSAGES = ("messageBasicGroupChatCreate", "messageSupergroupChatCreate", "messagePinMessage")
+
+Range = Tuple[int, int]
+
+ScanProgressCallback = Callable[[int, int], None]
+"""Called after each page with (pages fetched, new messages counted)."""
+
+
+class ActivityStats:
+    """
+    Message activity of a chat: per-user message counts and a weekday x hour histogram of messages, in UTC.
+    """
+
+    def __init__(
+        self,
+        user_ids: np.ndarray,
+        message_counts: np.ndarray,
+        last_message_dates: np.ndarray,
+        histogram: np.ndarray,
+        complete: bool,
+    ):
+        """
+        Initialize the ActivityStats.
+
+        :param user_ids: The users who sent messages, most active first.
+        :param message_counts: The number of messages of every user.
+        :param last_message_dates: The Unix time of the last message of every user.
+        :param histogram: Messages per weekday (0 is Monday) and hour, of shape (7, 24).
+        :param complete: Whether the history has been scanned back to its beginning.
+        """
+        self.user_ids = user_ids
+        self.message_counts = message_counts
+        self.last_message_dates = last_message_dates
+        self.histogram = histogram
+        self.complete = complete
+
+    @property
+    def total(self) -> int:
+        return int(self.histogram.sum())
+
+    @property
+    def hourly(self) -> np.ndarray:
+        return self.histogram.sum(axis=0)
+
+    @property
+    def weekly(self) -> np.ndarray:
+        return self.histogram.sum(axis=1)
+
+
+class HistoryStore:
+    """
+    Persistent aggregates of scanned message histories and the ranges of message IDs they cover.
+
+    A range (low, high) means that every message of the chat with an ID from low to high has been counted;
+    low is 0 once the beginning of the history has been reached. Aggregates and ranges of a page are written
+    in one transaction, so an interrupted scan never counts a message twice.
+    """
+
+    DEFAULT_PATH = os.getenv("HISTORY_PATH", "history.sqlite3")
+
+    def __init__(self, path: str = DEFAULT_PATH):
+        """
+        Initialize the HistoryStore.
+
+        :param path: Path to the SQLite database file, ":memory:" for a store that is not persisted.
+        """
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS scanned_ranges (
+                chat_id INTEGER NOT NULL,
+                low INTEGER NOT NULL,
+                high INTEGER NOT NULL,
+                PRIMARY KEY (chat_id, low)
+            );
+            CREATE TABLE IF NOT EXISTS user_activity (
+                chat_id INTEGER NOT NULL,
+                user_id INTEGER NOT NULL,
+                messages INTEGER NOT NULL,
+                last_message_date INTEGER NOT NULL,
+                PRIMARY KEY (chat_id, user_id)
+            );
+            CREATE TABLE IF NOT EXISTS activity_histogram (
+                chat_id INTEGER NOT NULL,
+                weekday INTEGER NOT NULL,
+                hour INTEGER NOT NULL,
+                messages INTEGER NOT NULL,
+                PRIMARY KEY (chat_id, weekday, hour)
+            );
+            """
+        )
+        self._connection.commit()
+
+    def get_ranges(self, chat_id: int) -> List[Range]:
+        """
+        The scanned ranges of a chat, newest first.
+        """
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT low, high FROM scanned_ranges WHERE chat_id = ? ORDER BY high DESC", (chat_id,)
+            ).fetchall()
+        return [(low, high) for low, high in rows]
+
+    def commit_page(
+        self,
+        chat_id: int,
+        ranges: List[Range],
+        user_activity: Dict[int, Tuple[int, int]],
+        histogram: np.ndarray,
+    ) -> None:
+        """
+        Add the aggregates of a page and replace the scanned ranges of the chat, atomically.
+
+        :param chat_id: The ID of the chat.
+        :param ranges: All scanned ranges of the chat, including the page.
+        :param user_activity: The number of messages and the date of the last message per user in the page.
+        :param histogram: Messages of the page per weekday and hour.
+        """
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM scanned_ranges WHERE chat_id = ?", (chat_id,))
+            self._connection.executemany(
+                "INSERT INTO scanned_ranges (chat_id, low, high) VALUES (?, ?, ?)",
+                [(chat_id, low, high) for low, high in ranges],
+            )
+            self._connection.executemany(
+                """
+                INSERT INTO user_activity (chat_id, user_id, messages, last_message_date) VALUES (?, ?, ?, ?)
+                ON CONFLICT (chat_id, user_id) DO UPDATE SET
+                    messages = messages + excluded.messages,
+                    last_message_date = MAX(last_message_date, excluded.last_message_date)
+                """,
+                [(chat_id, user_id, messages, date) for user_id, (messages, date) in user_activity.items()],
+            )
+            weekdays, hours = np.nonzero(histogram)
+            self._connection.executemany(
+                """
+                INSERT INTO activity_histogram (chat_id, weekday, hour, messages) VALUES (?, ?, ?, ?)
+                ON CONFLICT (chat_id, weekday, hour) DO UPDATE SET messages = messages + excluded.messages
+                """,
+                [
+                    (chat_id, int(weekday), int(hour), int(histogram[weekday, hour]))
+                    for weekday, hour in zip(weekdays, hours)
+                ],
+            )
+
+    def get_stats(self, chat_id: int) -> ActivityStats:
+        with self._lock:
+            users = self._connection.execute(
+                "SELECT user_id, messages, last_message_date FROM user_activity WHERE chat_id = ? "
+                "ORDER BY messages DESC, user_id",
+                (chat_id,),
+            ).fetchall()
+            cells = self._connection.execute(
+                "SELECT weekday, hour, messages FROM activity_histogram WHERE chat_id = ?", (chat_id,)
+            ).fetchall()
+            complete = self._connection.execute(
+                "SELECT 1 FROM scanned_ranges WHERE chat_id = ? AND low = 0", (chat_id,)
+            ).fetchone()
+        columns = np.array(users, dtype=np.int64).reshape(-1, 3)
+        histogram = np.zeros((7, 24), dtype=np.int64)
+        for weekday, hour, messages in cells:
+            histogram[weekday, hour] = messages
+        return ActivityStats(columns[:, 0], columns[:, 1], columns[:, 2], histogram, complete is not None)
+
+    def reset(self, chat_id: int) -> None:
+        """
+        Forget the aggregates of a chat, so that the next scan starts over.
+        """
+        with self._lock, self._connection:
+            for table in ("scanned_ranges", "user_activity", "activity_histogram"):
+                self._connection.execute(f"DELETE FROM {table} WHERE chat_id = ?", (chat_id,))
+
+
+def _is_counted(message: Dict[str, Any]) -> bool:
+    if message.get("sender_id", {}).get("@type") != "messageSenderUser":
+        return False
+    content_type = message.get("content", {}).get("@type", "")
+    return not content_type.startswith("messageChat") and content_type not in SERVICE_MESSAGES
+
+
+def aggregate(messages: List[Dict[str, Any]]) -> Tuple[Dict[int, Tuple[int, int]], np.ndarray]:
+    """
+    Count messages per user and per weekday and hour.
+
+    :param messages: Message objects.
+    :return: The number of messages and the date of the last message per user, and the (7, 24) histogram.
+    """
+    user_activity: Dict[int, Tuple[int, int]] = {}
+    dates = []
+    for message in messages:
+        if not _is_counted(message):
+            continue
+        user_id = message["sender_id"]["user_id"]
+        count, last_date = user_activity.get(user_id, (0, 0))
+        user_activity[user_id] = (count + 1, max(last_date, message["date"]))
+        dates.append(message["date"])
+    histogram = np.zeros((7, 24), dtype=np.int64)
+    if dates:
+        days, seconds = np.divmod(np.asarray(dates, dtype=np.int64), 86400)
+        # 1 January 1970 was a Thursday
+        np.add.at(histogram, ((days + 3) % 7, seconds // 3600), 1)
+    return user_activity, histogram
+
+
+class HistoryScanner:
+    """
+    Scans message histories page by page, newest first, and keeps only aggregates.
+
+    Scanned ranges are checkpointed after every page. A scan stops at the newest scanned range and skips over
+    it, so after a first full pass, later scans only fetch the messages sent since, and an interrupted scan
+    resumes where it stopped.
+    """
+
+    def __init__(self, service: ChatMemberService, store: HistoryStore):
+        """
+        Initialize the HistoryScanner.
+
+        :param service: The service the history is requested with.
+        :param store: Where aggregates and scanned ranges are kept.
+        """
+        self.service = service
+        self.store = store
+
+    def scan(
+        self,
+        chat_id: int,
+        progress_callback: Optional[ScanProgressCallback] = None,
+        max_pages: Optional[int] = None,
+    ) -> Optional[ActivityStats]:
+        """
+        Count the messages of a chat that have not been counted yet.
+
+        :param chat_id: The ID of the chat.
+        :param progress_callback: Called after each page with (pages fetched, new messages counted).
+        :param max_pages: Stop after this many pages; the next scan continues from there.
+        :return: The activity of the chat, or None if the history could not be retrieved.
+        """
+        ranges = self.store.get_ranges(chat_id)
+        current: Optional[Range] = None
+        from_message_id = 0
+        pages = 0
+        counted = 0
+        while max_pages is None or pages < max_pages:
+            messages = self.service.get_chat_history_page(chat_id, from_message_id)
+            if messages is None:
+                logger.error(f"Failed to get the history of chat {chat_id}")
+                return None
+            pages += 1
+            if from_message_id:
+                messages = [message for message in messages if message["id"] < from_message_id]
+            if not messages:
+                # The beginning of the history
+                if current is not None or not ranges:
+                    ranges = self._merge(ranges, (0, current[1] if current is not None else 0), current)
+                    self.store.commit_page(chat_id, ranges, {}, np.zeros((7, 24), dtype=np.int64))
+                break
+
+            high = current[1] if current is not None else messages[0]["id"]
+            covering = None
+            new_messages = []
+            for message in messages:
+                covering = next((r for r in ranges if r is not current and r[0] <= message["id"] <= r[1]), None)
+                if covering is not None:
+                    break
+                new_messages.append(message)
+
+            low = covering[0] if covering is not None else new_messages[-1]["id"]
+            if covering is not None:
+                high = max(high, covering[1])
+            merged_ranges = self._merge(ranges, (low, high), current, covering)
+            user_activity, histogram = aggregate(new_messages)
+            self.store.commit_page(chat_id, merged_ranges, user_activity, histogram)
+            current = next(r for r in merged_ranges if r[0] == low)
+            ranges = merged_ranges
+            counted += int(histogram.sum())
+            if progress_callback is not None:
+                progress_callback(pages, counted)
+            if low == 0:
+                break
+            from_message_id = low
+        logger.info(f"Scanned {pages} pages of chat {chat_id}, {counted} new messages")
+        return self.store.get_stats(chat_id)
+
+    @staticmethod
+    def _merge(ranges: List[Range], new_range: Range, *replaced: Optional[Range]) -> List[Range]:
+        kept = [r for r in ranges if r not in replaced]
+        return sorted(kept + [new_range], key=lambda r: r[1], reverse=True)
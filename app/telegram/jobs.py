@@ -0,0 +1,230 @@
+import itertools
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from loguru import logger
+
+from app.telegram.journal import RunJournal
+from app.telegram.processor import ChatMemberService, is_member_count_fingerprint
+from app.telegram.results import CommonChatsResult, CommonChatsRow
+from app.telegram.snapshots import SnapshotStore
+
+
+class AnalysisJob:
+    """
+    The analysis of one chat, run by a JobManager worker; its rows can be read while it runs.
+    """
+
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+    def __init__(self, job_id: int, chat_id: int, fingerprint: str):
+        self.job_id = job_id
+        self.chat_id = chat_id
+        self.fingerprint = fingerprint
+        self.status = self.QUEUED
+        self.error: Optional[str] = None
+        self.done = 0
+        self.total = 0
+        self.resumed = 0
+        # Members left out because Telegram does not list all members of the largest supergroups
+        self.unlisted = 0
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.future: Optional[Future] = None
+        self._result = CommonChatsResult()
+        self._lock = threading.Lock()
+
+    @property
+    def finished(self) -> bool:
+        return self.status in (self.DONE, self.FAILED)
+
+    def get_result(self) -> CommonChatsResult:
+        """
+        The rows analyzed so far; a copy while the job is running, so it is safe to read from another thread.
+        """
+        with self._lock:
+            if self.finished:
+                return self._result
+            return self._result.take(np.arange(len(self._result)))
+
+    def wait(self, timeout: Optional[float] = None) -> CommonChatsResult:
+        """
+        Block until the job has finished.
+
+        :param timeout: The maximum number of seconds to wait.
+        :return: The result rows.
+        """
+        if self.future is not None:
+            self.future.result(timeout=timeout)
+        return self.get_result()
+
+    def _on_progress(self, done: int, total: int, user_id: int, error: Optional[str]) -> None:
+        # Progress covers the members left after those of a resumed run
+        self.done = self.resumed + done
+        self.total = self.resumed + max(total, done)
+
+    def _append(self, row: CommonChatsRow) -> None:
+        with self._lock:
+            self._result.append(row)
+
+
+class JobManager:
+    """
+    Runs chat analyses on a bounded pool of worker threads, independently of the UI that requested them.
+
+    Jobs are keyed by chat ID and member-set fingerprint: a request for a chat whose members have not changed
+    attaches to the queued or running job of that chat, or is served at once by its finished job. A finished
+    job keyed by a member count fingerprint, which misses members replaced by others, is reused only for
+    ChatMemberService.MEMBER_COUNT_FINGERPRINT_MAX_AGE seconds, and so is its journal. The most
+    recent ``max_results`` finished jobs are kept, and every completed analysis is saved to the snapshot store
+    if one is given. With a journal, every analyzed member is journaled as soon as its lookups complete, and
+    an analysis interrupted by a crash or a failure is resumed by the next job of its chat.
+    """
+
+    DEFAULT_WORKERS = 2
+    DEFAULT_MAX_RESULTS = 32
+
+    def __init__(
+        self,
+        service: ChatMemberService,
+        max_workers: int = DEFAULT_WORKERS,
+        max_results: int = DEFAULT_MAX_RESULTS,
+        concurrency: int = ChatMemberService.DEFAULT_CONCURRENCY,
+        snapshot_store: Optional[SnapshotStore] = None,
+        journal: Optional[RunJournal] = None,
+    ):
+        """
+        Initialize the JobManager.
+
+        :param service: The service the analyses are run with.
+        :param max_workers: The number of analyses run at the same time; further jobs wait in the queue.
+        :param max_results: The number of finished jobs kept for reuse.
+        :param concurrency: The maximum number of members whose lookups are in flight in each analysis.
+        :param snapshot_store: Where completed analyses are saved.
+        :param journal: Where the progress of analyses is journaled.
+        """
+        self.service = service
+        self.max_results = max_results
+        self.concurrency = concurrency
+        self.snapshot_store = snapshot_store
+        self.journal = journal
+        self._jobs: "OrderedDict[Tuple[int, str], AnalysisJob]" = OrderedDict()
+        self._jobs_by_id: Dict[int, AnalysisJob] = {}
+        self._job_ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="analysis")
+
+    def submit(self, chat_id: int) -> Optional[AnalysisJob]:
+        """
+        Analyze a chat, reusing the job of an earlier request while the members of the chat are unchanged.
+
+        :param chat_id: The ID of the group chat.
+        :return: The job, or None if the members of the chat cannot be fingerprinted.
+        """
+        fingerprint = self.service.get_members_fingerprint(chat_id)
+        if fingerprint is None:
+            logger.error(f"Cannot analyze chat {chat_id}: members unavailable")
+            return None
+        key = (chat_id, fingerprint)
+        with self._lock:
+            job = self._jobs.get(key)
+            if job is not None and job.status != AnalysisJob.FAILED and not self._is_expired(job):
+                self._jobs.move_to_end(key)
+                return job
+            if job is not None:
+                del self._jobs_by_id[job.job_id]
+            job = AnalysisJob(next(self._job_ids), chat_id, fingerprint)
+            self._jobs[key] = job
+            self._jobs_by_id[job.job_id] = job
+            job.future = self._executor.submit(self._run, job)
+            self._evict()
+        logger.info(f"Queued analysis job {job.job_id} of chat {chat_id}")
+        return job
+
+    def get(self, job_id: int) -> Optional[AnalysisJob]:
+        with self._lock:
+            return self._jobs_by_id.get(job_id)
+
+    def jobs(self) -> List[AnalysisJob]:
+        """
+        All known jobs, most recently requested last.
+        """
+        with self._lock:
+            return list(self._jobs.values())
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _is_expired(self, job: AnalysisJob) -> bool:
+        return (
+            job.finished_at is not None
+            and is_member_count_fingerprint(job.fingerprint)
+            and time.time() - job.finished_at > self.service.MEMBER_COUNT_FINGERPRINT_MAX_AGE
+        )
+
+    def _evict(self) -> None:
+        finished = [key for key, job in self._jobs.items() if job.finished]
+        for key in finished[: max(len(finished) - self.max_results, 0)]:
+            job = self._jobs.pop(key)
+            del self._jobs_by_id[job.job_id]
+
+    def _run(self, job: AnalysisJob) -> None:
+        job.status = AnalysisJob.RUNNING
+        job.started_at = time.time()
+        run = None
+        try:
+            skip_user_ids = None
+            if self.journal is not None:
+                idle_max_age = None
+                if is_member_count_fingerprint(job.fingerprint):
+                    idle_max_age = self.service.MEMBER_COUNT_FINGERPRINT_MAX_AGE
+                run = self.journal.open(job.chat_id, job.fingerprint, idle_max_age)
+                for row in run.rows:
+                    job._append(row)
+                job.resumed = job.done = run.resumed
+                skip_user_ids = run.user_ids
+            rows = self.service.iter_users_common_chats_count_for_chat(
+                job.chat_id, self.concurrency, progress_callback=job._on_progress, skip_user_ids=skip_user_ids
+            )
+            if rows is None:
+                job.error = "members unavailable"
+            else:
+                for row in rows:
+                    if run is not None:
+                        run.append(row)
+                    job._append(row)
+                # The member count reported by Telegram is only an estimate of the number of lookups
+                job.total = job.done
+                job.unlisted = self.service.unlisted_member_counts.get(job.chat_id, 0)
+        except Exception as e:
+            logger.exception(f"Analysis job {job.job_id} of chat {job.chat_id} failed")
+            job.error = str(e)
+        job.finished_at = time.time()
+        if job.error is None and self.snapshot_store is not None:
+            try:
+                self.snapshot_store.save(job.chat_id, job._result, created_at=job.finished_at)
+            except OSError:
+                logger.exception(f"Failed to save the snapshot of analysis job {job.job_id}")
+        # The journal of a completed run is deleted only once its result is saved
+        if run is not None:
+            try:
+                if job.error is None:
+                    run.finish()
+                else:
+                    run.close()
+            except OSError:
+                logger.exception(f"Failed to close the journal of analysis job {job.job_id}")
+        job.status = AnalysisJob.FAILED if job.error is not None else AnalysisJob.DONE
+        logger.info(
+            f"Analysis job {job.job_id} of chat {job.chat_id} {job.status} in {job.finished_at - job.started_at:.1f} s"
+        )
+        with self._lock:
+            self._evict()
@@ -0,0 +1,234 @@
+import json
+import os
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from dotenv import load_dotenv
+from loguru import logger
+
+from app.telegram.results import CommonChatsResult, CommonChatsRow
+
+load_dotenv()
+
+
+class AnalysisRun:
+    """
+    The journal of one analysis run: an append-only file with a header line and one JSON line per analyzed
+    member.
+
+    Every line is flushed as soon as it is written, so it survives the process being killed; lines are also
+    fsynced at most every ``RunJournal.FSYNC_INTERVAL`` seconds, and on close, to survive a power loss.
+    """
+
+    def __init__(self, journal: "RunJournal", chat_id: int, run_id: str, path: str, rows: CommonChatsResult):
+        """
+        Initialize the AnalysisRun. Use RunJournal.open to start or resume one.
+
+        :param journal: The journal the run belongs to.
+        :param chat_id: The ID of the analyzed chat.
+        :param run_id: The ID of the run, unique within the chat.
+        :param path: The path of the journal file, opened for appending.
+        :param rows: The rows journaled before the run was (re)opened.
+        """
+        self.journal = journal
+        self.chat_id = chat_id
+        self.run_id = run_id
+        self.path = path
+        self.rows = rows
+        self.user_ids: Set[int] = set(rows.user_ids.tolist())
+        self._file = open(path, "ab")
+        self._synced_at = time.monotonic()
+
+    @property
+    def resumed(self) -> int:
+        """
+        The number of members analyzed before the run was (re)opened.
+        """
+        return len(self.rows)
+
+    def append(self, row: CommonChatsRow) -> None:
+        """
+        Record an analyzed member.
+        """
+        line = json.dumps({"user_id": row.user_id, "name": row.name, "count": row.count}, ensure_ascii=False)
+        self._file.write(line.encode("utf-8") + b"\n")
+        self._file.flush()
+        if time.monotonic() - self._synced_at >= self.journal.fsync_interval:
+            os.fsync(self._file.fileno())
+            self._synced_at = time.monotonic()
+
+    def close(self) -> None:
+        """
+        Close the journal file and keep it, so that the run can be resumed.
+        """
+        if not self._file.closed:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+        self.journal._release(self)
+
+    def finish(self) -> None:
+        """
+        Close the run once every member has been analyzed and delete its journal.
+        """
+        self.close()
+        os.remove(self.path)
+        logger.info(f"Finished analysis run {self.run_id} of chat {self.chat_id}")
+
+
+class RunJournal:
+    """
+    Write-ahead journals of analysis runs, one directory per chat and one file per run.
+
+    A run that did not finish, because the process died or the analysis failed, is resumed by the next run of
+    its chat with the same member fingerprint: the members it journaled are not looked up again. Journals of
+    another member set, older than ``max_age``, or not written to for the ``idle_max_age`` given to ``open``,
+    are stale and deleted instead of resumed.
+    """
+
+    DEFAULT_DIR = os.getenv("JOURNAL_DIR", "journal")
+    FSYNC_INTERVAL = 1.0
+    MAX_AGE = 24 * 3600
+    SUFFIX = ".jsonl"
+
+    def __init__(self, root: str = DEFAULT_DIR, fsync_interval: float = FSYNC_INTERVAL, max_age: float = MAX_AGE):
+        """
+        Initialize the RunJournal.
+
+        :param root: The directory journals are kept in, created if missing.
+        :param fsync_interval: The maximum number of seconds between fsyncs of a journal.
+        :param max_age: The number of seconds after its start a run can still be resumed.
+        """
+        self.root = root
+        self.fsync_interval = fsync_interval
+        self.max_age = max_age
+        self._open_runs: Set[Tuple[int, str]] = set()
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def _chat_dir(self, chat_id: int) -> str:
+        return os.path.join(self.root, str(chat_id))
+
+    def unfinished_runs(self, chat_id: int) -> List[str]:
+        """
+        The IDs of the runs of a chat whose journal is kept, oldest first.
+        """
+        chat_dir = self._chat_dir(chat_id)
+        if not os.path.isdir(chat_dir):
+            return []
+        names = [name[: -len(self.SUFFIX)] for name in os.listdir(chat_dir) if name.endswith(self.SUFFIX)]
+        return sorted(names, key=int)
+
+    def open(
+        self, chat_id: int, fingerprint: Optional[str] = None, idle_max_age: Optional[float] = None
+    ) -> AnalysisRun:
+        """
+        Resume the latest unfinished run of a chat with the same member fingerprint that is not open already,
+        or start a new one. Stale journals of the chat that are not open are deleted.
+
+        :param chat_id: The ID of the chat.
+        :param fingerprint: The fingerprint of the member set analyzed, see
+            ChatMemberService.get_members_fingerprint.
+        :param idle_max_age: The number of seconds after its last write a run can still be resumed, for
+            fingerprints that may miss changes of the member set; unlimited if None.
+        :return: The run; its rows are the members already analyzed.
+        """
+        chat_dir = self._chat_dir(chat_id)
+        os.makedirs(chat_dir, exist_ok=True)
+        with self._lock:
+            run_id = None
+            for unfinished_run_id in reversed(self.unfinished_runs(chat_id)):
+                if (chat_id, unfinished_run_id) in self._open_runs:
+                    continue
+                path = os.path.join(chat_dir, unfinished_run_id + self.SUFFIX)
+                header = self._read_header(path)
+                if (
+                    header is None
+                    or header.get("fingerprint") != fingerprint
+                    or time.time() - header["started_at"] > self.max_age
+                    or (idle_max_age is not None and time.time() - os.path.getmtime(path) > idle_max_age)
+                ):
+                    logger.info(f"Discarding stale analysis run {unfinished_run_id} of chat {chat_id}")
+                    os.remove(path)
+                elif run_id is None:
+                    run_id = unfinished_run_id
+            if run_id is not None:
+                path = os.path.join(chat_dir, run_id + self.SUFFIX)
+                rows = self._recover(path)
+                logger.info(f"Resuming analysis run {run_id} of chat {chat_id} after {len(rows)} members")
+            else:
+                run_id = str(int(time.time() * 1000))
+                while os.path.exists(os.path.join(chat_dir, run_id + self.SUFFIX)):
+                    run_id = str(int(run_id) + 1)
+                path = os.path.join(chat_dir, run_id + self.SUFFIX)
+                with open(path, "xb") as file:
+                    header = {
+                        "chat_id": chat_id,
+                        "run_id": run_id,
+                        "started_at": time.time(),
+                        "fingerprint": fingerprint,
+                    }
+                    file.write(json.dumps(header).encode("utf-8") + b"\n")
+                rows = CommonChatsResult()
+            self._open_runs.add((chat_id, run_id))
+        return AnalysisRun(self, chat_id, run_id, path, rows)
+
+    def _release(self, run: AnalysisRun) -> None:
+        with self._lock:
+            self._open_runs.discard((run.chat_id, run.run_id))
+
+    @staticmethod
+    def _read_header(path: str) -> Optional[Dict[str, Any]]:
+        """
+        Read the header line of a journal.
+
+        :param path: The path of the journal file.
+        :return: The header, or None if it is incomplete.
+        """
+        with open(path, "rb") as file:
+            line = file.readline()
+        try:
+            header = json.loads(line)
+        except ValueError:
+            return None
+        return header if isinstance(header, dict) and "started_at" in header else None
+
+    @staticmethod
+    def _recover(path: str) -> CommonChatsResult:
+        """
+        Read the rows of a journal, and cut off a last line left incomplete by a crash.
+
+        :param path: The path of the journal file.
+        :return: The journaled rows; a member journaled twice keeps its last row.
+        """
+        rows = {}
+        valid_length = 0
+        with open(path, "rb") as file:
+            for line in file:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                valid_length += len(line)
+                # Rows have a user_id, the header line does not
+                if "user_id" in record:
+                    rows[record["user_id"]] = CommonChatsRow(record["user_id"], record["name"], record["count"])
+        if valid_length < os.path.getsize(path):
+            logger.warning(f"Discarding an incomplete record at the end of {path}")
+            os.truncate(path, valid_length)
+        return CommonChatsResult.from_rows(rows.values())
+
+    def discard(self, chat_id: int, run_ids: Optional[Iterable[str]] = None) -> None:
+        """
+        Delete the journals of unfinished runs of a chat, so that its next analysis starts over.
+
+        :param chat_id: The ID of the chat.
+        :param run_ids: The runs to delete, all unfinished runs that are not open if omitted.
+        """
+        with self._lock:
+            for run_id in run_ids if run_ids is not None else self.unfinished_runs(chat_id):
+                if (chat_id, run_id) not in self._open_runs:
+                    os.remove(os.path.join(self._chat_dir(chat_id), run_id + self.SUFFIX))
@@ -0,0 +1,308 @@
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, Optional, Set
+
+from loguru import logger
+
+from app.telegram.processor import ChatMemberService, format_user_name
+from app.telegram.results import CommonChatsResult, CommonChatsRow
+
+LEFT_STATUSES = ("chatMemberStatusLeft", "chatMemberStatusBanned")
+
+# Service messages announcing that members joined or left a chat
+JOIN_MESSAGES = ("messageChatAddMembers", "messageChatJoinByLink", "messageChatJoinByRequest")
+LEAVE_MESSAGES = ("messageChatDeleteMember",)
+
+
+def basic_group_chat_id(basic_group_id: int) -> int:
+    return -basic_group_id
+
+
+def supergroup_chat_id(supergroup_id: int) -> int:
+    return -1000000000000 - supergroup_id
+
+
+def is_basic_group_chat_id(chat_id: int) -> bool:
+    return supergroup_chat_id(0) < chat_id < 0
+
+
+class LiveStats:
+    """
+    Common-group counts of watched chats, kept current by membership updates instead of rescans.
+
+    After the initial scan of a watched chat, the groups shared with every member are known. A member joining
+    a watched chat costs one getGroupsInCommon; members joining or leaving any other group, or the current
+    user joining or leaving a group, only adjust the known sets. Updates are received on the receiver thread
+    and applied in order on a single worker thread, which is also where lookups are sent from. Of the new
+    messages, only the service messages announcing joins and leaves are decoded.
+    """
+
+    def __init__(self, service: ChatMemberService):
+        """
+        Initialize the LiveStats and subscribe to the membership updates of the service's client.
+
+        :param service: The service used for the initial scans and the lookups of joining members.
+        """
+        self.service = service
+        self.my_user_id = service.get_my_user_id()
+        self.common_chats: Dict[int, Set[int]] = {}
+        self.watched: Dict[int, Set[int]] = {}
+        self.names: Dict[int, Optional[str]] = {}
+        self.versions: Dict[int, int] = {}
+        self._my_chats: Optional[Set[int]] = None
+        self._basic_group_members: Dict[int, Set[int]] = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="live-stats")
+        self._handlers: Dict[str, Callable[[Dict[str, Any]], None]] = {
+            "updateNewMessage": self._on_new_message,
+            "updateChatMember": self._on_chat_member,
+            "updateBasicGroupFullInfo": self._on_basic_group_full_info,
+            "updateBasicGroup": self._on_basic_group,
+            "updateSupergroup": self._on_supergroup,
+        }
+        for update_type, handler in self._handlers.items():
+            markers = JOIN_MESSAGES + LEAVE_MESSAGES if update_type == "updateNewMessage" else None
+            service.td_client.add_update_handler(update_type, handler, markers)
+
+    def close(self) -> None:
+        """
+        Unsubscribe from updates and stop the worker thread.
+        """
+        for update_type, handler in self._handlers.items():
+            self.service.td_client.remove_update_handler(update_type, handler)
+        self._executor.shutdown(wait=False)
+
+    def watch(self, chat_id: int, concurrency: int = ChatMemberService.DEFAULT_CONCURRENCY) -> Future:
+        """
+        Scan a chat once and keep its stats current from then on.
+
+        :param chat_id: The ID of the group chat.
+        :param concurrency: The maximum number of members whose lookups are in flight during the scan.
+        :return: A future resolved with True once the scan is done, False if the members are unavailable.
+        """
+        return self._executor.submit(self._watch, chat_id, concurrency)
+
+    def unwatch(self, chat_id: int) -> None:
+        self._executor.submit(self._unwatch, chat_id)
+
+    def get_stats(self, chat_id: int) -> Optional[CommonChatsResult]:
+        """
+        Current stats of a watched chat.
+
+        :param chat_id: The ID of the group chat.
+        :return: The user IDs, names and counts of the members, or None if the chat is not watched.
+        """
+        with self._lock:
+            members = self.watched.get(chat_id)
+            if members is None:
+                return None
+            return CommonChatsResult.from_rows(
+                CommonChatsRow(user_id, self.names.get(user_id), len(self.common_chats[user_id]))
+                for user_id in members
+                if user_id in self.common_chats
+            )
+
+    def _watch(self, chat_id: int, concurrency: int) -> bool:
+        if chat_id in self.watched:
+            return True
+        member_pages = self.service.iter_chat_members(chat_id)
+        if member_pages is None:
+            logger.error(f"Cannot watch chat {chat_id}: members unavailable")
+            return False
+        if self._my_chats is None:
+            self._my_chats = self._get_my_chats()
+
+        members = set()
+        listed = {self.my_user_id}
+
+        def iter_listed_user_ids():
+            for user_id in self.service.iter_member_user_ids(member_pages):
+                listed.add(user_id)
+                yield user_id
+
+        for user_id, common_groups, user, error in self.service.iter_common_groups(iter_listed_user_ids(), concurrency):
+            if common_groups is None:
+                logger.error(f"Failed to get common groups for user_id: {user_id}: {error}")
+                continue
+            members.add(user_id)
+            with self._lock:
+                self.common_chats[user_id] = set(common_groups.get("chat_ids", []))
+                self.names[user_id] = format_user_name(user) if user is not None else None
+        with self._lock:
+            self.watched[chat_id] = members
+            self._changed(chat_id)
+        self._seed_basic_group_members(chat_id, listed)
+        logger.info(f"Watching chat {chat_id} with {len(members)} members")
+        return True
+
+    def _unwatch(self, chat_id: int) -> None:
+        with self._lock:
+            self.watched.pop(chat_id, None)
+            self.versions.pop(chat_id, None)
+            tracked = set().union(*self.watched.values()) if self.watched else set()
+            for user_id in list(self.common_chats):
+                if user_id not in tracked:
+                    del self.common_chats[user_id]
+                    self.names.pop(user_id, None)
+
+    def _get_my_chats(self) -> Set[int]:
+        store = self.service.store
+        my_chats = {
+            basic_group_chat_id(basic_group["id"])
+            for basic_group in list(store.basic_groups.values())
+            if basic_group["status"]["@type"] not in LEFT_STATUSES and basic_group.get("is_active", True)
+        }
+        my_chats.update(
+            supergroup_chat_id(supergroup["id"])
+            for supergroup in list(store.supergroups.values())
+            if supergroup["status"]["@type"] not in LEFT_STATUSES
+        )
+        return my_chats
+
+    def _changed(self, chat_id: int) -> None:
+        self.versions[chat_id] = self.versions.get(chat_id, 0) + 1
+
+    def _changed_users(self, user_ids: Iterable[int]) -> None:
+        user_ids = set(user_ids)
+        for chat_id, members in self.watched.items():
+            if not members.isdisjoint(user_ids):
+                self._changed(chat_id)
+
+    # Update handlers, called on the receiver thread: only hand the work over to the worker thread
+
+    def _on_new_message(self, update: Dict[str, Any]) -> None:
+        message = update["message"]
+        content_type = message.get("content", {}).get("@type")
+        if content_type not in JOIN_MESSAGES and content_type not in LEAVE_MESSAGES:
+            return
+        if content_type == "messageChatAddMembers":
+            user_ids = message["content"].get("member_user_ids", [])
+        elif content_type == "messageChatDeleteMember":
+            user_ids = [message["content"]["user_id"]]
+        else:
+            user_ids = [message.get("sender_id", {}).get("user_id")]
+        joined = content_type in JOIN_MESSAGES
+        for user_id in user_ids:
+            if user_id is not None:
+                self._executor.submit(self._on_membership, message["chat_id"], user_id, joined)
+
+    def _on_chat_member(self, update: Dict[str, Any]) -> None:
+        new_member = update["new_chat_member"]
+        user_id = new_member.get("member_id", {}).get("user_id")
+        if user_id is None:
+            return
+        was_member = update["old_chat_member"]["status"]["@type"] not in LEFT_STATUSES
+        is_member = new_member["status"]["@type"] not in LEFT_STATUSES
+        if was_member != is_member:
+            self._executor.submit(self._on_membership, update["chat_id"], user_id, is_member)
+
+    def _on_basic_group_full_info(self, update: Dict[str, Any]) -> None:
+        chat_id = basic_group_chat_id(update["basic_group_id"])
+        user_ids = {
+            member["member_id"]["user_id"]
+            for member in update["basic_group_full_info"].get("members", [])
+            if member.get("member_id", {}).get("@type") == "messageSenderUser"
+        }
+        self._executor.submit(self._on_basic_group_members, chat_id, user_ids)
+
+    def _on_basic_group(self, update: Dict[str, Any]) -> None:
+        basic_group = update["basic_group"]
+        is_member = basic_group["status"]["@type"] not in LEFT_STATUSES and basic_group.get("is_active", True)
+        self._executor.submit(self._on_my_membership, basic_group_chat_id(basic_group["id"]), is_member)
+
+    def _on_supergroup(self, update: Dict[str, Any]) -> None:
+        supergroup = update["supergroup"]
+        is_member = supergroup["status"]["@type"] not in LEFT_STATUSES
+        self._executor.submit(self._on_my_membership, supergroup_chat_id(supergroup["id"]), is_member)
+
+    # State changes, applied on the worker thread
+
+    def _on_membership(self, chat_id: int, user_id: int, joined: bool) -> None:
+        if user_id == self.my_user_id:
+            self._on_my_membership(chat_id, joined)
+            return
+        if joined:
+            self._on_member_joined(chat_id, user_id)
+        else:
+            self._on_member_left(chat_id, user_id)
+
+    def _on_member_joined(self, chat_id: int, user_id: int) -> None:
+        with self._lock:
+            common_chats = self.common_chats.get(user_id)
+            if common_chats is not None:
+                common_chats.add(chat_id)
+                if chat_id in self.watched:
+                    self.watched[chat_id].add(user_id)
+                self._changed_users([user_id])
+                return
+            if chat_id not in self.watched:
+                return
+        common_groups = self.service.get_common_groups_with_user(user_id)
+        if common_groups is None:
+            return
+        name = self.service.get_name_by_user_id(user_id)
+        with self._lock:
+            self.common_chats[user_id] = set(common_groups.get("chat_ids", [])) | {chat_id}
+            self.names[user_id] = name
+            if chat_id in self.watched:
+                self.watched[chat_id].add(user_id)
+            self._changed_users([user_id])
+
+    def _on_member_left(self, chat_id: int, user_id: int) -> None:
+        with self._lock:
+            common_chats = self.common_chats.get(user_id)
+            if common_chats is None:
+                return
+            self._changed_users([user_id])
+            common_chats.discard(chat_id)
+            members = self.watched.get(chat_id)
+            if members is not None:
+                members.discard(user_id)
+
+    def _on_basic_group_members(self, chat_id: int, user_ids: Set[int]) -> None:
+        previous = self._basic_group_members.get(chat_id)
+        self._basic_group_members[chat_id] = user_ids
+        if previous is None:
+            return
+        for user_id in user_ids - previous:
+            self._on_membership(chat_id, user_id, True)
+        for user_id in previous - user_ids:
+            self._on_membership(chat_id, user_id, False)
+
+    def _seed_basic_group_members(self, chat_id: int, user_ids: Set[int]) -> None:
+        # The members listed by a scan are the baseline the next updateBasicGroupFullInfo is compared with
+        if is_basic_group_chat_id(chat_id):
+            self._basic_group_members[chat_id] = user_ids
+
+    def _on_my_membership(self, chat_id: int, is_member: bool) -> None:
+        if self._my_chats is None:
+            return
+        if is_member and chat_id not in self._my_chats:
+            self._my_chats.add(chat_id)
+            self._on_my_join(chat_id)
+        elif not is_member and chat_id in self._my_chats:
+            self._my_chats.discard(chat_id)
+            self._on_my_leave(chat_id)
+
+    def _on_my_join(self, chat_id: int) -> None:
+        member_pages = self.service.iter_chat_members(chat_id)
+        if member_pages is None:
+            return
+        joined = set(self.service.iter_member_user_ids(member_pages))
+        self._seed_basic_group_members(chat_id, joined | {self.my_user_id})
+        with self._lock:
+            tracked = joined & set(self.common_chats)
+            for user_id in tracked:
+                self.common_chats[user_id].add(chat_id)
+            self._changed_users(tracked)
+        logger.info(f"Joined chat {chat_id}: counts of {len(tracked)} tracked members increased")
+
+    def _on_my_leave(self, chat_id: int) -> None:
+        with self._lock:
+            affected = [user_id for user_id, common_chats in self.common_chats.items() if chat_id in common_chats]
+            self._changed_users(affected)
+            for user_id in affected:
+                self.common_chats[user_id].discard(chat_id)
+        if chat_id in self.watched:
+            self._unwatch(chat_id)
+        logger.info(f"Left chat {chat_id}: counts of {len(affected)} tracked members decreased")
@@ -0,0 +1,107 @@
+from typing import Dict, Iterable, Optional, Tuple
+
+import numpy as np
+
+
+class CoMembershipMatrix:
+    """
+    Sparse user x chat incidence matrix of the groups the current user belongs to.
+
+    The matrix is stored column-compressed: the members of the chat at column ``j`` are
+    ``user_ids[member_indices[indptr[j]:indptr[j + 1]]]``. Since every chat in the matrix is one of our
+    groups, the number of groups shared with a user is the number of non-zero entries in the user's row,
+    so the common-group counts of all members of all groups come from a single ``bincount``.
+    """
+
+    def __init__(self, chat_ids: np.ndarray, indptr: np.ndarray, user_ids: np.ndarray, member_indices: np.ndarray):
+        """
+        Initialize the CoMembershipMatrix. Use from_member_lists to build one from member lists.
+
+        :param chat_ids: The chat ID of every column.
+        :param indptr: Offsets into member_indices where the members of every column start, one more than columns.
+        :param user_ids: The sorted user ID of every row.
+        :param member_indices: Row indices of the members, column by column.
+        """
+        self.chat_ids = chat_ids
+        self.indptr = indptr
+        self.user_ids = user_ids
+        self.member_indices = member_indices
+        self.common_chats_counts = np.bincount(member_indices, minlength=len(user_ids))
+        self._columns: Dict[int, int] = {int(chat_id): column for column, chat_id in enumerate(chat_ids)}
+        self._rows: Optional[Tuple[np.ndarray, np.ndarray]] = None
+
+    @classmethod
+    def from_member_lists(cls, members: Dict[int, Iterable[int]]) -> "CoMembershipMatrix":
+        """
+        Build the matrix from the member user IDs of every chat.
+
+        :param members: A mapping of chat ID to the user IDs of its members; duplicates are ignored.
+        :return: The CoMembershipMatrix.
+        """
+        chat_ids = np.fromiter(members.keys(), dtype=np.int64, count=len(members))
+        columns = [np.unique(np.fromiter(user_ids, dtype=np.int64)) for user_ids in members.values()]
+        indptr = np.zeros(len(columns) + 1, dtype=np.int64)
+        np.cumsum([len(column) for column in columns], out=indptr[1:])
+        all_user_ids = np.concatenate(columns) if columns else np.empty(0, dtype=np.int64)
+        user_ids, member_indices = np.unique(all_user_ids, return_inverse=True)
+        return cls(chat_ids, indptr, user_ids, member_indices.astype(np.int64))
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        return len(self.user_ids), len(self.chat_ids)
+
+    def __contains__(self, chat_id: int) -> bool:
+        return chat_id in self._columns
+
+    def get_members(self, chat_id: int) -> Optional[np.ndarray]:
+        """
+        Retrieve the members of a chat.
+
+        :param chat_id: The ID of the chat.
+        :return: The user IDs of the members, or None if the chat is not in the matrix.
+        """
+        column = self._columns.get(chat_id)
+        if column is None:
+            return None
+        return self.user_ids[self.member_indices[self.indptr[column] : self.indptr[column + 1]]]
+
+    def get_common_chats_counts(self, chat_id: int) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        """
+        Count the groups shared with every member of a chat, the chat itself included.
+
+        :param chat_id: The ID of the chat.
+        :return: The user IDs of the members and their common group counts, or None if the chat is not in
+            the matrix.
+        """
+        column = self._columns.get(chat_id)
+        if column is None:
+            return None
+        rows = self.member_indices[self.indptr[column] : self.indptr[column + 1]]
+        return self.user_ids[rows], self.common_chats_counts[rows]
+
+    def get_common_chats(self, user_id: int) -> np.ndarray:
+        """
+        Retrieve the groups shared with a user, like getGroupsInCommon restricted to the chats in the matrix.
+
+        :param user_id: The ID of the user.
+        :return: The chat IDs, empty if the user is not a member of any chat in the matrix.
+        """
+        row = np.searchsorted(self.user_ids, user_id)
+        if row == len(self.user_ids) or self.user_ids[row] != user_id:
+            return np.empty(0, dtype=np.int64)
+        order, row_indptr = self._get_rows()
+        columns = np.searchsorted(self.indptr, order[row_indptr[row] : row_indptr[row + 1]], side="right") - 1
+        return self.chat_ids[columns]
+
+    def _get_rows(self) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Row-compressed view of the entries, built on first use.
+
+        :return: Positions into member_indices sorted by row, and the offsets where every row starts.
+        """
+        if self._rows is None:
+            order = np.argsort(self.member_indices, kind="stable")
+            row_indptr = np.zeros(len(self.user_ids) + 1, dtype=np.int64)
+            np.cumsum(self.common_chats_counts, out=row_indptr[1:])
+            self._rows = order, row_indptr
+        return self._rows
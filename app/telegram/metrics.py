@@ -0,0 +1,275 @@
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple, TypeVar
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+Sample = Tuple[str, Dict[str, str], float]
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    escaped = {
+        name: value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for name, value in labels.items()
+    }
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped.items()) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Metric:
+    """
+    A named metric with optional labels, in the spirit of the Prometheus client.
+    """
+
+    TYPE = "untyped"
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, Any]) -> Tuple[str, ...]:
+        if set(labels) != set(self.label_names):
+            raise ValueError(f"{self.name} expects labels {self.label_names}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def _labels(self, key: Tuple[str, ...]) -> Dict[str, str]:
+        return dict(zip(self.label_names, key))
+
+    def samples(self) -> Iterator[Sample]:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    TYPE = "counter"
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = ()):
+        super().__init__(name, documentation, label_names)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: Any) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def get(self, **labels: Any) -> float:
+        """
+        Current value for the given labels; without labels, the sum over all of them.
+        """
+        with self._lock:
+            if not labels:
+                return sum(self._values.values())
+            return self._values.get(self._key(labels), 0.0)
+
+    def samples(self) -> Iterator[Sample]:
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in values:
+            yield self.name, self._labels(key), value
+
+
+class Gauge(Counter):
+    TYPE = "gauge"
+
+    def dec(self, amount: float = 1.0, **labels: Any) -> None:
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels: Any) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(Metric):
+    TYPE = "histogram"
+
+    def __init__(
+        self, name: str, documentation: str, label_names: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS
+    ):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(sorted(buckets))
+        # Per label key: the count of every bucket (the last one is +Inf), the sum and the count of observations
+        self._values: Dict[Tuple[str, ...], Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels: Any) -> None:
+        key = self._key(labels)
+        with self._lock:
+            counts, totals = self._values.setdefault(key, ([0] * (len(self.buckets) + 1), [0.0, 0.0]))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            totals[0] += value
+            totals[1] += 1
+
+    def label_values(self) -> List[Dict[str, str]]:
+        with self._lock:
+            return [self._labels(key) for key in self._values]
+
+    def get_count(self, **labels: Any) -> int:
+        with self._lock:
+            values = self._values.get(self._key(labels))
+        return int(values[1][1]) if values is not None else 0
+
+    def get_sum(self, **labels: Any) -> float:
+        with self._lock:
+            values = self._values.get(self._key(labels))
+        return values[1][0] if values is not None else 0.0
+
+    def quantile(self, q: float, **labels: Any) -> Optional[float]:
+        """
+        Estimate a quantile by linear interpolation within the bucket that contains it.
+
+        :param q: The quantile, between 0 and 1.
+        :return: The estimate in the unit of the observations, or None if nothing was observed.
+        """
+        with self._lock:
+            values = self._values.get(self._key(labels))
+            if values is None or values[1][1] == 0:
+                return None
+            counts = list(values[0])
+            total = values[1][1]
+        rank = q * total
+        cumulative = 0
+        for index, count in enumerate(counts):
+            if count and cumulative + count >= rank:
+                lower = self.buckets[index - 1] if index > 0 else 0.0
+                if index == len(self.buckets):
+                    return lower
+                return lower + (self.buckets[index] - lower) * (rank - cumulative) / count
+            cumulative += count
+        return self.buckets[-1]
+
+    def samples(self) -> Iterator[Sample]:
+        with self._lock:
+            values = [(key, list(counts), list(totals)) for key, (counts, totals) in self._values.items()]
+        for key, counts, (total_sum, total_count) in values:
+            labels = self._labels(key)
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                yield f"{self.name}_bucket", {**labels, "le": _format_value(bound)}, cumulative
+            yield f"{self.name}_sum", labels, total_sum
+            yield f"{self.name}_count", labels, total_count
+
+
+M = TypeVar("M", bound=Metric)
+
+
+class Registry:
+    """
+    A collection of metrics rendered together in the Prometheus text exposition format.
+    """
+
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: M) -> M:
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.TYPE}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+REQUEST_QUEUE_SECONDS = REGISTRY.register(
+    Histogram("tdlib_request_queue_seconds", "Time requests wait in the scheduler before being sent.", ("method",))
+)
+REQUEST_NETWORK_SECONDS = REGISTRY.register(
+    Histogram("tdlib_request_network_seconds", "Time from sending a request to TDLib to its response.", ("method",))
+)
+REQUESTS = REGISTRY.register(
+    Counter("tdlib_requests_total", "Responses received, by method and result.", ("method", "result"))
+)
+REQUESTS_IN_FLIGHT = REGISTRY.register(
+    Gauge("tdlib_requests_in_flight", "Requests sent or queued and not answered yet.", ("method",))
+)
+FLOOD_WAIT_RETRIES = REGISTRY.register(
+    Counter("tdlib_flood_wait_retries_total", "Requests resent after a FLOOD_WAIT error.", ("method",))
+)
+FLOOD_WAIT_SECONDS = REGISTRY.register(
+    Counter("tdlib_flood_wait_seconds_total", "Seconds Telegram asked to wait in FLOOD_WAIT errors.", ("method",))
+)
+COALESCED_REQUESTS = REGISTRY.register(
+    Counter("tdlib_coalesced_requests_total", "Requests that joined an identical request in flight.", ("method",))
+)
+DISCARDED_EVENTS = REGISTRY.register(
+    Counter("tdlib_discarded_events_total", "Received events that were dropped, by reason.", ("reason",))
+)
+LOCAL_RESPONSES = REGISTRY.register(
+    Counter(
+        "tdlib_local_responses_total",
+        "Requests answered without TDLib, from the entity store or the cache.",
+        ("source", "method"),
+    )
+)
+
+
+def request_summary() -> List[Dict[str, Any]]:
+    """
+    Per-method statistics for the diagnostics panel.
+
+    :return: One row per method with the number of responses and errors, median and 95th percentile network
+        latency in milliseconds, mean scheduler wait in milliseconds, requests in flight and FLOOD_WAIT seconds.
+    """
+    methods = sorted({labels["method"] for labels in REQUEST_NETWORK_SECONDS.label_values()})
+    rows = []
+    for method in methods:
+        queued = REQUEST_QUEUE_SECONDS.get_count(method=method)
+        rows.append(
+            {
+                "method": method,
+                "responses": REQUESTS.get(method=method, result="ok") + REQUESTS.get(method=method, result="error"),
+                "errors": REQUESTS.get(method=method, result="error"),
+                "p50_ms": (REQUEST_NETWORK_SECONDS.quantile(0.5, method=method) or 0.0) * 1e3,
+                "p95_ms": (REQUEST_NETWORK_SECONDS.quantile(0.95, method=method) or 0.0) * 1e3,
+                "queue_ms": REQUEST_QUEUE_SECONDS.get_sum(method=method) / queued * 1e3 if queued else 0.0,
+                "in_flight": REQUESTS_IN_FLIGHT.get(method=method),
+                "flood_wait_s": FLOOD_WAIT_SECONDS.get(method=method),
+            }
+        )
+    return rows
+
+
+def start_http_server(port: int, registry: Registry = REGISTRY) -> ThreadingHTTPServer:
+    """
+    Serve the metrics at /metrics from a daemon thread.
+
+    :param port: The port to listen on.
+    :param registry: The registry to expose.
+    :return: The running server.
+    """
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = registry.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("", port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    return server
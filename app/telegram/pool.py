@@ -0,0 +1,267 @@
+import bisect
+import hashlib
+import threading
+from concurrent.futures import Future, InvalidStateError
+from functools import partial
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from loguru import logger
+
+from app.telegram.client import TDLibClient, UpdateHandler
+from app.telegram.store import EntityStore
+
+# Requests about a single user, sent to the session that listed the user, or sharded by user_id
+SHARDED_REQUESTS = ("getUser", "getUserFullInfo", "getGroupsInCommon")
+# Pages of members, each sent to one session, which then looks up the members it listed
+MEMBER_PAGE_REQUESTS = ("getSupergroupMembers",)
+# Single requests that make a chat and all members of a basic group known to a session; sent to every session
+# so that each of them can resolve the users it is sharded
+BROADCAST_REQUESTS = ("getChat", "getBasicGroupFullInfo")
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+class PoolScheduler:
+    """
+    Combined view of the request schedulers of all sessions in a pool.
+    """
+
+    def __init__(self, clients: Sequence[TDLibClient]):
+        self._clients = clients
+
+    def get_delay(self, method: str) -> float:
+        """
+        Seconds until every session may send the next request of a method.
+
+        :param method: The @type of the request.
+        :return: The longest delay among the sessions, 0 if none of them is limited.
+        """
+        return max(client.scheduler.get_delay(method) for client in self._clients)
+
+    def budget(self) -> Dict[str, Dict[str, Optional[float]]]:
+        """
+        Budget of every method summed over the sessions.
+
+        :return: A mapping of method to its total rate (None if any session is unlimited), available tokens,
+            longest remaining pause in seconds and number of queued requests.
+        """
+        budget: Dict[str, Dict[str, Optional[float]]] = {}
+        for client in self._clients:
+            for method, method_budget in client.scheduler.budget().items():
+                total = budget.get(method)
+                if total is None:
+                    budget[method] = dict(method_budget)
+                    continue
+                for field in ("rate", "tokens"):
+                    value = method_budget[field]
+                    total[field] = None if value is None or total[field] is None else total[field] + value
+                total["paused_for"] = max(total["paused_for"] or 0.0, method_budget["paused_for"] or 0.0)
+                total["queued"] = (total["queued"] or 0) + (method_budget["queued"] or 0)
+        return budget
+
+
+class ClientPool:
+    """
+    Several TDLib sessions of the same account used as one client.
+
+    Pages of supergroup members are distributed over the sessions, and the per-user requests such as
+    ``getGroupsInCommon`` about a listed member go to the session that listed it, so no page is requested
+    twice. Other users are distributed by consistent hashing of the user ID, so adding a session only moves
+    about 1/n of them to it. Every session paces its own requests, but Telegram applies flood limits to the
+    account, which all sessions share: the pool spreads the work, it does not raise those limits. The sessions
+    must be logged in to the same account, otherwise the common groups of a user depend on the session that
+    answers.
+    """
+
+    VIRTUAL_NODES = 64
+    # Listed members whose session is remembered; the oldest are forgotten first
+    MAX_ROUTED_USERS = 1000000
+    FALLBACK_ERROR_CODES = (400, 404)
+
+    def __init__(self, clients: Sequence[TDLibClient]):
+        """
+        Initialize the ClientPool.
+
+        :param clients: Authorized clients; the first one is the primary session whose updates feed the store.
+        """
+        if not clients:
+            raise ValueError("ClientPool needs at least one client")
+        self.clients = list(clients)
+        self.scheduler = PoolScheduler(self.clients)
+        self._ring: List[Tuple[int, int]] = sorted(
+            (_hash(f"{index}:{node}"), index)
+            for index in range(len(self.clients))
+            for node in range(self.VIRTUAL_NODES)
+        )
+        self._ring_keys = [key for key, _ in self._ring]
+        # The index of the session that listed a user, by user ID
+        self._user_sessions: Dict[int, int] = {}
+        self._user_sessions_lock = threading.Lock()
+
+    @classmethod
+    def create(cls, api_id: str, api_hash: str, database_directories: Sequence[str]) -> "ClientPool":
+        """
+        Create and authorize one session per database directory.
+
+        :param api_id: The Telegram API ID.
+        :param api_hash: The Telegram API hash.
+        :param database_directories: A separate TDLib database directory for every session.
+        :return: A ClientPool of the authorized sessions.
+        """
+        clients = []
+        for database_directory in database_directories:
+            logger.info(f"Starting TDLib session in {database_directory}")
+            clients.append(TDLibClient(api_id, api_hash, database_directory=database_directory))
+        return cls(clients)
+
+    @property
+    def primary(self) -> TDLibClient:
+        return self.clients[0]
+
+    @property
+    def store(self) -> EntityStore:
+        return self.primary.store
+
+    @property
+    def startup_timings(self) -> Dict[str, float]:
+        """
+        Startup steps of all sessions, summed since the sessions are started one after another.
+        """
+        timings: Dict[str, float] = {}
+        for client in self.clients:
+            for step, seconds in client.startup_timings.items():
+                timings[step] = timings.get(step, 0.0) + seconds
+        return timings
+
+    def get_client(self, user_id: int) -> TDLibClient:
+        """
+        Select the session responsible for a user.
+
+        :param user_id: The ID of the user.
+        :return: The client that listed the user as a member, otherwise the client whose point on the hash ring
+            follows the hash of the user ID.
+        """
+        index = self._user_sessions.get(user_id)
+        if index is not None:
+            return self.clients[index]
+        return self._get_ring_client(str(user_id))
+
+    def _get_ring_client(self, key: str) -> TDLibClient:
+        position = bisect.bisect(self._ring_keys, _hash(key)) % len(self._ring)
+        return self.clients[self._ring[position][1]]
+
+    def send_request(self, query: Dict) -> Future:
+        """
+        Send a query through the session responsible for it.
+
+        Per-user queries go to the session of the user, every page of members goes to one session chosen by
+        hashing the page, queries that load a chat or a basic group are sent to every session and resolved with
+        the response of the primary one, everything else goes to the primary.
+
+        :param query: The query to send.
+        :return: A future resolved with the response event (which may be an ``error`` event).
+        """
+        method = query["@type"]
+        if method in SHARDED_REQUESTS:
+            client = self.get_client(query["user_id"])
+            if client is self.primary:
+                return client.send_request(query)
+            return self._send_with_fallback(client, query)
+        if method in MEMBER_PAGE_REQUESTS:
+            member_filter = query.get("filter") or {}
+            client = self._get_ring_client(
+                f"{query.get('supergroup_id')}:{member_filter.get('query')}:{query.get('offset')}"
+            )
+            return self._send_with_fallback(client, query, on_answer=self._route_members)
+        if method in BROADCAST_REQUESTS:
+            for client in self.clients[1:]:
+                client.send_request(query)
+        return self.primary.send_request(query)
+
+    def _send_with_fallback(
+        self,
+        client: TDLibClient,
+        query: Dict,
+        on_answer: Optional[Callable[[TDLibClient, Dict], None]] = None,
+    ) -> Future:
+        """
+        Send a query through a session and resend it through the primary one if the session does not know the
+        user or the chat yet.
+
+        :param client: The session responsible for the query.
+        :param query: The query to send.
+        :param on_answer: Called with the session that answered and its response event before the future is
+            resolved.
+        :return: A future resolved with the response of the session, or of the primary one.
+        """
+        future: Future = Future()
+
+        def resolve(answered_by: TDLibClient, done: Future) -> None:
+            try:
+                if done.exception() is not None:
+                    future.set_exception(done.exception())
+                    return
+                if on_answer is not None:
+                    on_answer(answered_by, done.result())
+                future.set_result(done.result())
+            except InvalidStateError:
+                pass
+
+        def on_response(done: Future) -> None:
+            event = done.result() if done.exception() is None else None
+            if (
+                client is not self.primary
+                and event is not None
+                and event.get("@type") == "error"
+                and event.get("code") in self.FALLBACK_ERROR_CODES
+            ):
+                self.primary.send_request(query).add_done_callback(partial(resolve, self.primary))
+            else:
+                resolve(client, done)
+
+        client.send_request(query).add_done_callback(on_response)
+        return future
+
+    def _route_members(self, client: TDLibClient, event: Dict) -> None:
+        """
+        Remember the session that listed the members of a page, which TDLib made known to that session only.
+        """
+        if event.get("@type") != "chatMembers":
+            return
+        index = self.clients.index(client)
+        with self._user_sessions_lock:
+            for member in event.get("members", []):
+                member_id = member.get("member_id", {})
+                if member_id.get("@type") == "messageSenderUser":
+                    self._user_sessions.pop(member_id["user_id"], None)
+                    self._user_sessions[member_id["user_id"]] = index
+            while len(self._user_sessions) > self.MAX_ROUTED_USERS:
+                del self._user_sessions[next(iter(self._user_sessions))]
+
+    def add_update_handler(
+        self, update_type: str, handler: UpdateHandler, markers: Optional[Sequence[str]] = None
+    ) -> None:
+        """
+        Register a handler for the update events of the primary session.
+
+        :param update_type: The @type of the events, e.g. "updateUser".
+        :param handler: The callable receiving the event.
+        :param markers: Strings of which an event must contain one to be decoded, see
+            TDLibClient.add_update_handler.
+        """
+        self.primary.add_update_handler(update_type, handler, markers)
+
+    def remove_update_handler(self, update_type: str, handler: UpdateHandler) -> None:
+        """
+        Unregister a handler previously added with add_update_handler.
+
+        :param update_type: The @type the handler was registered for.
+        :param handler: The handler to remove.
+        """
+        self.primary.remove_update_handler(update_type, handler)
+
+    def close(self) -> None:
+        for client in self.clients:
+            client.close()
@@ -1,25 +1,303 @@
-import time
-from typing import Any, Callable, Dict, List, Optional, Union
+import hashlib
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+from typing import AbstractSet, Any, Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Set, Tuple, Union
 
+import numpy as np
 from loguru import logger
 
+from app.telegram.cache import SQLiteCache
 from app.telegram.client import TDLibClient
+from app.telegram.membership import CoMembershipMatrix
+from app.telegram.metrics import LOCAL_RESPONSES
+from app.telegram.pool import ClientPool
+from app.telegram.results import CommonChatsResult, CommonChatsRow, MemberList
+from app.telegram.search import ChatIndex
+from app.telegram.store import EntityStore
+
+GROUP_CHAT_TYPES = ("chatTypeBasicGroup", "chatTypeSupergroup")
+
+ProgressCallback = Callable[[int, int, int, Optional[str]], None]
+"""Called once per member with (done, total, user_id, error); error is None when the lookup succeeded."""
+
+
+class SupergroupMemberPager:
+    """
+    The listing of the members of a supergroup, without I/O: it tells which getSupergroupMembers request to
+    send next and takes the responses, so that the sync and the async service share it.
+
+    Telegram lists no member past ``max_offset``. Members of larger supergroups are then searched by every query
+    in turn, and only those not listed yet are returned. The members listed first are unique by offset; only
+    their IDs, and those of the members found by search, are kept to tell new members apart, which bounds the
+    memory used by max_offset + max_search_requests * page_size members.
+    """
+
+    def __init__(
+        self,
+        supergroup_id: int,
+        page_size: int,
+        max_offset: int,
+        search_queries: Sequence[str],
+        max_search_requests: int,
+    ):
+        """
+        Initialize the SupergroupMemberPager.
+
+        :param supergroup_id: The ID of the supergroup.
+        :param page_size: The number of members per request.
+        :param max_offset: The offset past which Telegram lists no member.
+        :param search_queries: The name prefixes the members past max_offset are searched by.
+        :param max_search_requests: The maximum number of search requests.
+        """
+        self.supergroup_id = supergroup_id
+        self.page_size = page_size
+        self.max_offset = max_offset
+        self.max_search_requests = max_search_requests
+        self.total_count: Optional[int] = None
+        self.listed = 0
+        self.search_requests = 0
+        self.query: Optional[str] = None
+        self.done = False
+        self._queries = iter(search_queries)
+        self._offset = 0
+        self._seen: Set[Tuple[Optional[str], Optional[int]]] = set()
+
+    @property
+    def unlisted(self) -> int:
+        """
+        The number of members of a supergroup larger than max_offset that were not listed; below max_offset, a
+        shortfall only means that the member count was stale.
+        """
+        if self.total_count is None or self.total_count <= self.max_offset:
+            return 0
+        return max(self.total_count - self.listed, 0)
+
+    def next_request(self) -> Optional[Dict[str, Any]]:
+        """
+        The next getSupergroupMembers request, or None once the listing is over.
+        """
+        if self.done:
+            return None
+        if self.query is None:
+            member_filter = {"@type": "supergroupMembersFilterRecent"}
+        else:
+            member_filter = {"@type": "supergroupMembersFilterSearch", "query": self.query}
+            self.search_requests += 1
+        return {
+            "@type": "getSupergroupMembers",
+            "supergroup_id": self.supergroup_id,
+            "filter": member_filter,
+            "offset": self._offset,
+            "limit": self.page_size,
+        }
+
+    def feed(self, page: Optional[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        Take the response to the last request.
+
+        :param page: The chatMembers object, None if the request failed, which ends the listing.
+        :return: The members not listed yet.
+        """
+        if page is None:
+            logger.error(f"Failed to get members of supergroup {self.supergroup_id} at offset {self._offset}")
+            self.done = True
+            return []
+        if self.total_count is None:
+            self.total_count = page["total_count"]
+            if self.total_count > self.max_offset:
+                logger.warning(
+                    f"Supergroup {self.supergroup_id} has {self.total_count} members, more than the "
+                    f"{self.max_offset} Telegram lists: searching the rest by name"
+                )
+        members = page["members"]
+        self._offset += len(members)
+        if self.query is not None or self.total_count > self.max_offset:
+            members = self._take_unseen(members)
+        self.listed += len(members)
+        if self.listed >= self.total_count:
+            self.done = True
+        elif self.query is not None and self.search_requests >= self.max_search_requests:
+            self.done = True
+        elif not page["members"] or self._offset >= min(page["total_count"], self.max_offset):
+            self._next_query()
+        return members
+
+    def record_unlisted(self, unlisted_member_counts: Dict[int, int], chat_id: int) -> None:
+        """
+        Record the number of members the finished listing missed, or that it missed none.
+
+        :param unlisted_member_counts: The unlisted members of every chat, by chat ID.
+        :param chat_id: The ID of the supergroup chat.
+        """
+        if self.unlisted:
+            unlisted_member_counts[chat_id] = self.unlisted
+            logger.warning(f"Listed {self.listed} of the {self.total_count} members of chat {chat_id}")
+        else:
+            unlisted_member_counts.pop(chat_id, None)
+
+    def _take_unseen(self, members: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        unseen = []
+        for member in members:
+            member_id = member.get("member_id", {})
+            key = (member_id.get("@type"), member_id.get("user_id", member_id.get("chat_id")))
+            if key not in self._seen:
+                self._seen.add(key)
+                unseen.append(member)
+        return unseen
+
+    def _next_query(self) -> None:
+        query = next(self._queries, None)
+        if (
+            self.total_count is None
+            or self.total_count <= self.max_offset
+            or query is None
+            or self.search_requests >= self.max_search_requests
+        ):
+            self.done = True
+            return
+        self.query = query
+        self._offset = 0
+
+
+def select_member_user_ids(
+    members: Iterable[Dict[str, Any]], my_user_id: Optional[int], skip_user_ids: AbstractSet[int] = frozenset()
+) -> Iterator[int]:
+    """
+    Extract the user IDs of chatMember objects, skipping non-user senders, the current user and skip_user_ids.
+
+    :param members: The chatMember objects.
+    :param my_user_id: The ID of the current user.
+    :param skip_user_ids: Further users to leave out.
+    :return: An iterator over the user IDs to analyze.
+    """
+    for member in members:
+        member_id = member.get("member_id", {})
+        if member_id.get("@type") != "messageSenderUser":
+            continue
+        user_id = member_id.get("user_id")
+        if user_id is None or user_id == my_user_id or user_id in skip_user_ids:
+            continue
+        yield user_id
+
+
+def format_user_name(user: Dict[str, Any]) -> str:
+    """
+    Build a display name from a user object.
+
+    :param user: The user object.
+    :return: The first and last name of the user.
+    """
+    first_name = user.get("first_name", "")
+    last_name = user.get("last_name", "")
+    return f"{first_name} {last_name}"
+
+
+def fingerprint_user_ids(user_ids: np.ndarray) -> str:
+    """
+    Fingerprint a member set by the IDs of its members, in any order.
+    """
+    return "members:" + hashlib.sha1(np.sort(np.asarray(user_ids, dtype=np.int64)).tobytes()).hexdigest()
+
+
+def fingerprint_member_count(member_count: int) -> str:
+    """
+    Fingerprint a member set by its size only; see is_member_count_fingerprint.
+    """
+    return f"count:{member_count}"
+
+
+def is_member_count_fingerprint(fingerprint: str) -> bool:
+    """
+    Whether a fingerprint is of the size of a member set only: such a fingerprint does not change when as many
+    members leave as join, so results keyed by it must not be reused for longer than
+    ChatMemberService.MEMBER_COUNT_FINGERPRINT_MAX_AGE.
+    """
+    return fingerprint.startswith("count:")
+
+
+def build_member_count_request(chat_info: Dict[str, Any]) -> Optional[Tuple[Dict[str, Any], str]]:
+    """
+    Build the request of the group object of a chat, which holds its member count.
+
+    :param chat_info: The chat object.
+    :return: The request and the @type of its response, or None if the chat is not a group.
+    """
+    chat_type = chat_info["type"]
+    if chat_type["@type"] == "chatTypeBasicGroup":
+        return {"@type": "getBasicGroup", "basic_group_id": chat_type["basic_group_id"]}, "basicGroup"
+    if chat_type["@type"] == "chatTypeSupergroup":
+        return {"@type": "getSupergroup", "supergroup_id": chat_type["supergroup_id"]}, "supergroup"
+    return None
+
+
+def build_common_groups_request(user_id: int, limit: int) -> Dict[str, Any]:
+    """
+    Build a getGroupsInCommon request for a user.
+
+    :param user_id: The user ID for which to find common groups.
+    :param limit: The maximum number of chats to return.
+    :return: The request data.
+    """
+    return {"@type": "getGroupsInCommon", "user_id": user_id, "offset_chat_id": 0, "limit": limit}
+
+
+def select_local_common_chats_counts(
+    matrix: CoMembershipMatrix, chat_id: int, skip_user_ids: AbstractSet[int]
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    The members of a chat in a co-membership matrix and their common chat counts, less skip_user_ids.
+    """
+    user_ids, counts = matrix.get_common_chats_counts(chat_id)
+    if skip_user_ids:
+        kept = ~np.isin(user_ids, np.fromiter(skip_user_ids, dtype=np.int64, count=len(skip_user_ids)))
+        user_ids, counts = user_ids[kept], counts[kept]
+    return user_ids, counts
 
 
 class ChatMemberService:
-    RECEIVE_LOOP_TIMEOUT = 5
+    REQUEST_TIMEOUT = 60
     MAX_COUNT_CHATS_RESPONSE = 100000
     MAX_COUNT_MEMBERS_RESPONSE = 100000
-
-    def __init__(self, td_client: TDLibClient):
+    DEFAULT_CONCURRENCY = 32
+    CHATS_PAGE_SIZE = 100
+    MEMBERS_PAGE_SIZE = 200
+    HISTORY_PAGE_SIZE = 100
+    # getSupergroupMembers returns no member past this offset, whatever the filter
+    MAX_MEMBERS_OFFSET = 10000
+    # Name prefixes the members of supergroups larger than MAX_MEMBERS_OFFSET are searched by
+    MEMBER_SEARCH_QUERIES = tuple("abcdefghijklmnopqrstuvwxyz0123456789абвгдеёжзийклмнопрстуфхцчшщъыьэюя")
+    # Search requests per listing, up to 200000 searched members with pages of 200
+    MAX_MEMBER_SEARCH_REQUESTS = 1000
+    # Seconds results keyed by a member count fingerprint are reused, see is_member_count_fingerprint
+    MEMBER_COUNT_FINGERPRINT_MAX_AGE = 15 * 60
+
+    def __init__(
+        self,
+        td_client: Union[TDLibClient, ClientPool],
+        cache: Optional[SQLiteCache] = None,
+        store: Optional[EntityStore] = None,
+    ):
         """
         Initialize the ChatMemberService.
 
-        :param td_client: An instance of TDLibClient for sending and receiving requests.
+        :param td_client: An instance of TDLibClient, or a ClientPool of several sessions, for sending and
+            receiving requests.
+        :param cache: Optional persistent cache for chats, users and common groups.
+        :param store: Store of entities pushed by TDLib updates, the store of td_client if omitted.
         """
         self.td_client = td_client
+        self.cache = cache
+        self.store = store if store is not None else td_client.store
+        self.co_membership: Optional[CoMembershipMatrix] = None
+        self.chat_index = ChatIndex()
+        # Members Telegram did not list in the last complete listing of a chat, by chat ID
+        self.unlisted_member_counts: Dict[int, int] = {}
+        td_client.add_update_handler("updateChatTitle", self._on_chat_title)
         self.__my_user_id = self.get_my_user_id()
 
+    def _on_chat_title(self, update: Dict[str, Any]) -> None:
+        # Called on the receiver thread: renamed chats are found by their new title
+        self.chat_index.rename(update["chat_id"], update["title"])
+
     def get_my_user_id(self) -> Optional[int]:
         """
         Retrieve the current user's ID and store it for future checks.
@@ -57,6 +335,118 @@ class ChatMemberService:
         :param success_condition: Can be a string (@type), a list of @types, or a callable that checks the event.
         :return: The event dictionary if the condition is met, None otherwise.
         """
+        return self._send_and_wait_for_responses([request_data], success_condition)[0]
+
+    def _send_and_wait_for_responses(
+        self,
+        requests: List[Dict[str, Any]],
+        success_condition: Union[str, List[str], Callable[[Dict[str, Any]], bool]],
+    ) -> List[Optional[Dict[str, Any]]]:
+        """
+        Sends all requests at once and waits until every one of them has been answered.
+
+        Each request is tagged with its own ``@extra`` value, so the receiver thread of td_client resolves
+        the future of every request with its own response, regardless of arrival order.
+
+        :param requests: The requests to be sent through td_client.
+        :param success_condition: Can be a string (@type), a list of @types, or a callable that checks the event.
+        :return: The response events in the order of the requests, with None for failed requests.
+        """
+        condition = self._build_condition(success_condition)
+        futures = [self._send_request(request_data) for request_data in requests]
+
+        results: List[Optional[Dict[str, Any]]] = []
+        for request_data, future in zip(requests, futures):
+            event = self._wait_for_result(future, request_data["@type"])
+            if event is None:
+                future.cancel()
+                logger.error(f"Timed out waiting for {request_data['@type']} response")
+                results.append(None)
+                continue
+            results.append(self._check_response(request_data, event, condition))
+        return results
+
+    def _send_request(self, request_data: Dict[str, Any]) -> Future:
+        """
+        Send a request, answering it from the entity store or the cache when possible.
+
+        Successful responses to cacheable requests are written to the cache.
+
+        :param request_data: The request data to be sent through td_client.
+        :return: A future resolved with the response event.
+        """
+        known = self.store.get_response(request_data)
+        source = "store"
+        if known is None and self.cache is not None:
+            known = self.cache.get_response(request_data)
+            source = "cache"
+        if known is not None:
+            LOCAL_RESPONSES.inc(source=source, method=request_data["@type"])
+            future: Future = Future()
+            future.set_result(known)
+            return future
+
+        if self.cache is None:
+            return self.td_client.send_request(request_data)
+
+        cache = self.cache
+
+        def store(done: Future) -> None:
+            if not done.cancelled() and done.exception() is None:
+                cache.store_response(request_data, done.result())
+
+        future = self.td_client.send_request(request_data)
+        future.add_done_callback(store)
+        return future
+
+    def _wait_for_result(self, future: Future, method: str) -> Optional[Dict[str, Any]]:
+        """
+        Wait for a response, extending the deadline while the method is paused by a FLOOD_WAIT.
+
+        :param future: The future returned by td_client.send_request.
+        :param method: The @type of the request.
+        :return: The response event, or None on timeout.
+        """
+        timeout: float = self.REQUEST_TIMEOUT
+        while True:
+            try:
+                return future.result(timeout=timeout)
+            except TimeoutError:
+                delay = self.td_client.scheduler.get_delay(method)
+                if delay <= 0:
+                    return None
+                timeout = delay + self.REQUEST_TIMEOUT
+
+    @staticmethod
+    def _check_response(
+        request_data: Dict[str, Any], event: Dict[str, Any], condition: Callable[[Dict[str, Any]], bool]
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Validate the response to a request.
+
+        :param request_data: The request the event answers.
+        :param event: The response event.
+        :param condition: The predicate the event must satisfy.
+        :return: The event if it is not an error and meets the condition, None otherwise.
+        """
+        if event.get("@type") == "error":
+            logger.error(f"Error in {request_data['@type']}: {event.get('message')}")
+            return None
+        if not condition(event):
+            logger.error(f"Unexpected response to {request_data['@type']}: {event.get('@type')}")
+            return None
+        return event
+
+    @staticmethod
+    def _build_condition(
+        success_condition: Union[str, List[str], Callable[[Dict[str, Any]], bool]],
+    ) -> Callable[[Dict[str, Any]], bool]:
+        """
+        Convert a success_condition into a predicate over events.
+
+        :param success_condition: Can be a string (@type), a list of @types, or a callable that checks the event.
+        :return: A callable that returns True for events meeting the condition.
+        """
         condition: Callable[[Dict[str, Any]], bool]
 
         if isinstance(success_condition, str):
@@ -75,19 +465,7 @@ class ChatMemberService:
             raise ValueError(
                 f"Invalid success_condition type: {type(success_condition)}. Accepted types: str, list, Callable"
             )
-
-        self.td_client.send(request_data)
-
-        while True:
-            event = self.td_client.receive()
-            if event:
-                if event.get("@type") == "error":
-                    logger.error(f"Error: {event.get('message')}")
-                    return None
-                if condition(event):
-                    return event
-            else:
-                time.sleep(self.RECEIVE_LOOP_TIMEOUT)
+        return condition
 
     def get_chat_id_by_username(self, username: str) -> Optional[int]:
         """
@@ -118,44 +496,172 @@ class ChatMemberService:
 
         :return: A list of dictionaries, each containing chat ID and title, or None if no chats are found.
         """
-        event = self._send_and_wait_for_response(
-            {"@type": "getChats", "limit": self.MAX_COUNT_CHATS_RESPONSE}, success_condition="chats"
-        )
+        chats: List[Dict[str, Any]] = []
+        for page in self.iter_chat_pages():
+            chats.extend(page)
+        return chats
 
-        if event is None:
-            return None
+    def iter_chat_pages(self, page_size: int = CHATS_PAGE_SIZE) -> Iterator[List[Dict[str, Any]]]:
+        """
+        Load the main chat list page by page and yield the group chats of every page as soon as it arrives.
+
+        Each ``loadChats`` call makes TDLib push ``updateNewChat``/``updateChatPosition`` for the next chats,
+        which the entity store records, so no per-chat ``getChat`` is needed. Chats that are already known
+        are yielded first. Every page is also added to chat_index.
 
-        chat_ids = event["chat_ids"]
+        :param page_size: The number of chats to request per page.
+        :return: An iterator over lists of dictionaries, each containing chat ID and title.
+        """
+        yielded: Set[int] = set()
+        request_data = {"@type": "loadChats", "chat_list": {"@type": "chatListMain"}, "limit": page_size}
+        complete = False
+        while True:
+            page = self._take_new_group_chats(self.store, yielded)
+            if page:
+                self.chat_index.add(page)
+                yield page
+            if complete:
+                return
+
+            event = self._wait_for_result(self._send_request(request_data), request_data["@type"])
+            if event is None:
+                logger.error("Timed out loading chats")
+                return
+            if event["@type"] == "error":
+                if event.get("code") != 404:
+                    logger.error(f"Error in loadChats: {event.get('message')}")
+                    return
+                complete = True
+
+    @staticmethod
+    def _take_new_group_chats(store: EntityStore, yielded: Set[int]) -> List[Dict[str, Any]]:
+        """
+        Collect the groups, supergroups and channels of the main chat list that have not been yielded yet.
+
+        :param store: The entity store holding the chat list.
+        :param yielded: IDs of the chats already seen; updated in place.
+        :return: A list of dictionaries, each containing chat ID and title.
+        """
         chats = []
-        for chat_id in chat_ids:
-            chat_info = self.get_chat_info_by_id(chat_id)
-            if chat_info is None:
+        for chat_id in store.get_main_chat_list():
+            if chat_id in yielded:
                 continue
-            chat_type = chat_info["type"]["@type"]
-            if chat_type != "chatTypeBasicGroup":
+            yielded.add(chat_id)
+            chat_info = store.get_chat(chat_id)
+            if chat_info is None or chat_info["type"]["@type"] not in GROUP_CHAT_TYPES:
                 continue
-            chat = {"id": chat_id, "name": chat_info["title"]}
-            chats.append(chat)
+            chats.append({"id": chat_id, "name": chat_info["title"]})
         return chats
 
-    def get_chat_members(self, chat_id: int) -> Optional[List[Dict[str, Any]]]:
+    def get_chat_members(self, chat_id: int) -> Optional[MemberList]:
+        """
+        Retrieve all user members from a basic group, supergroup or channel.
+
+        :param chat_id: The ID of the group chat.
+        :return: The user IDs and statuses of the members, or None if unable to retrieve members.
+        """
+        member_pages = self.iter_chat_members(chat_id)
+        if member_pages is None:
+            return None
+        return MemberList.from_pages(member_pages)
+
+    def iter_chat_members(
+        self, chat_id: int, page_size: int = MEMBERS_PAGE_SIZE
+    ) -> Optional[Iterator[List[Dict[str, Any]]]]:
         """
-        Retrieve all members from a basic group chat.
+        Retrieve the members of a chat page by page.
+
+        Basic groups return all members in one ``getBasicGroupFullInfo`` page. Supergroups and channels are paged
+        through ``getSupergroupMembers``, and the next page is only requested when the previous one has been
+        consumed, so huge chats are never held in memory at once.
+
+        Telegram lists only the first MAX_MEMBERS_OFFSET members of a supergroup. The members of larger
+        supergroups are then searched by name prefix, with at most MAX_MEMBER_SEARCH_REQUESTS requests, which
+        still misses members whose names start with other characters: once the pages are exhausted, the number
+        of members that could not be listed is recorded in ``unlisted_member_counts``.
 
         :param chat_id: The ID of the group chat.
-        :return: A list of member objects or None if unable to retrieve members.
+        :param page_size: The number of members per getSupergroupMembers request.
+        :return: An iterator over lists of member objects, or None if the chat or its first page is unavailable.
         """
         chat_info = self.get_chat_info_by_id(chat_id)
         if chat_info is None:
             return None
 
-        basic_group_id = chat_info["type"]["basic_group_id"]
-        full_info = self._send_and_wait_for_response(
-            {"@type": "getBasicGroupFullInfo", "basic_group_id": basic_group_id}, success_condition="basicGroupFullInfo"
+        chat_type = chat_info["type"]
+        if chat_type["@type"] == "chatTypeBasicGroup":
+            full_info = self._send_and_wait_for_response(
+                {"@type": "getBasicGroupFullInfo", "basic_group_id": chat_type["basic_group_id"]},
+                success_condition="basicGroupFullInfo",
+            )
+            if full_info is None:
+                return None
+            return iter([full_info["members"]])
+
+        if chat_type["@type"] == "chatTypeSupergroup":
+            pager = self._create_member_pager(chat_type["supergroup_id"], page_size)
+            request = pager.next_request()
+            first_page = self._send_and_wait_for_response(request, success_condition="chatMembers")
+            if first_page is None:
+                return None
+            return self._iter_supergroup_member_pages(chat_id, pager, pager.feed(first_page))
+
+        logger.error(f"Chat {chat_id} of type {chat_type['@type']} has no members to list.")
+        return None
+
+    def _iter_supergroup_member_pages(
+        self, chat_id: int, pager: "SupergroupMemberPager", members: List[Dict[str, Any]]
+    ) -> Iterator[List[Dict[str, Any]]]:
+        """
+        Yield the members of the already received first page, then request and yield the following pages.
+
+        :param chat_id: The ID of the supergroup chat.
+        :param pager: The pager the first page was fed to.
+        :param members: The members of the first page.
+        :return: An iterator over lists of member objects.
+        """
+        if members:
+            yield members
+        while (request := pager.next_request()) is not None:
+            members = pager.feed(self._send_and_wait_for_response(request, success_condition="chatMembers"))
+            if members:
+                yield members
+        pager.record_unlisted(self.unlisted_member_counts, chat_id)
+
+    def _create_member_pager(self, supergroup_id: int, page_size: int) -> "SupergroupMemberPager":
+        return SupergroupMemberPager(
+            supergroup_id,
+            page_size,
+            self.MAX_MEMBERS_OFFSET,
+            self.MEMBER_SEARCH_QUERIES,
+            self.MAX_MEMBER_SEARCH_REQUESTS,
+        )
+
+    def get_chat_history_page(
+        self, chat_id: int, from_message_id: int = 0, limit: int = HISTORY_PAGE_SIZE
+    ) -> Optional[List[Dict[str, Any]]]:
+        """
+        Request one page of the message history of a chat, newest message first.
+
+        :param chat_id: The ID of the chat.
+        :param from_message_id: The message to start from, included; 0 to start from the last message.
+        :param limit: The maximum number of messages to return; TDLib may return fewer.
+        :return: The messages, an empty list once the beginning of the history is reached, or None on failure.
+        """
+        messages = self._send_and_wait_for_response(
+            {
+                "@type": "getChatHistory",
+                "chat_id": chat_id,
+                "from_message_id": from_message_id,
+                "offset": 0,
+                "limit": limit,
+                "only_local": False,
+            },
+            success_condition="messages",
         )
-        if full_info is None:
+        if messages is None:
             return None
-        return full_info["members"]
+        return [message for message in messages.get("messages", []) if message is not None]
 
     def get_common_groups_with_user(self, user_id: int) -> Optional[Dict[str, Any]]:
         """
@@ -164,15 +670,8 @@ class ChatMemberService:
         :param user_id: The user ID for which to find common groups.
         :return: A dictionary containing common group IDs or None if the operation fails.
         """
-        offset_chat_id = 0
         response = self._send_and_wait_for_response(
-            {
-                "@type": "getGroupsInCommon",
-                "user_id": user_id,
-                "offset_chat_id": offset_chat_id,
-                "limit": self.MAX_COUNT_CHATS_RESPONSE,
-            },
-            success_condition="chats",
+            self._build_common_groups_request(user_id), success_condition="chats"
         )
 
         if response is None:
@@ -180,6 +679,15 @@ class ChatMemberService:
             return None
         return response
 
+    def _build_common_groups_request(self, user_id: int) -> Dict[str, Any]:
+        """
+        Build a getGroupsInCommon request for a user.
+
+        :param user_id: The user ID for which to find common groups.
+        :return: The request data.
+        """
+        return build_common_groups_request(user_id, self.MAX_COUNT_CHATS_RESPONSE)
+
     def get_name_by_user_id(self, user_id: int) -> Optional[str]:
         """
         Retrieve the username of a user by their ID.
@@ -190,44 +698,269 @@ class ChatMemberService:
         user = self._send_and_wait_for_response({"@type": "getUser", "user_id": user_id}, success_condition="user")
         if user is None:
             return None
-        first_name = user.get("first_name", "")
-        last_name = user.get("last_name", "")
-        return f"{first_name} {last_name}"
+        return format_user_name(user)
+
+    def iter_member_user_ids(
+        self, member_pages: Iterator[List[Dict[str, Any]]], skip_user_ids: AbstractSet[int] = frozenset()
+    ) -> Iterator[int]:
+        """
+        Extract the user IDs of the members, skipping non-user senders, the current user and skip_user_ids.
+
+        :param member_pages: Pages of chatMember objects of a chat.
+        :param skip_user_ids: Further users to leave out.
+        :return: An iterator over the user IDs to analyze.
+        """
+        for members in member_pages:
+            yield from select_member_user_ids(members, self.__my_user_id, skip_user_ids)
+
+    def get_chat_member_count(self, chat_id: int) -> Optional[int]:
+        """
+        Retrieve the number of members of a chat as reported by Telegram.
+
+        :param chat_id: The ID of the group chat.
+        :return: The member count, or None if it is unknown.
+        """
+        chat_info = self.get_chat_info_by_id(chat_id)
+        if chat_info is None:
+            return None
+        request = build_member_count_request(chat_info)
+        if request is None:
+            return None
+        group = self._send_and_wait_for_response(*request)
+        if group is None:
+            return None
+        return group.get("member_count")
 
-    def get_users_common_chats_count_for_chat(self, chat_id: int) -> Optional[List[Dict[str, Any]]]:
+    def get_members_fingerprint(self, chat_id: int) -> Optional[str]:
+        """
+        Fingerprint the member set of a chat, so that results can be reused until members join or leave.
+
+        Chats in the co-membership matrix and basic groups are fingerprinted by the IDs of their members.
+        Supergroups and channels, whose members can only be listed page by page, are fingerprinted by the member
+        count reported by Telegram only: that fingerprint misses a member leaving while another joins, so results
+        keyed by it are reused for MEMBER_COUNT_FINGERPRINT_MAX_AGE seconds at most.
+
+        :param chat_id: The ID of the group chat.
+        :return: The fingerprint, or None if the members or the member count are unavailable.
+        """
+        if self.co_membership is not None and chat_id in self.co_membership:
+            user_ids = self.co_membership.get_members(chat_id)
+        else:
+            chat_info = self.get_chat_info_by_id(chat_id)
+            if chat_info is None:
+                return None
+            if chat_info["type"]["@type"] != "chatTypeBasicGroup":
+                member_count = self.get_chat_member_count(chat_id)
+                return fingerprint_member_count(member_count) if member_count is not None else None
+            member_pages = self.iter_chat_members(chat_id)
+            if member_pages is None:
+                return None
+            user_ids = MemberList.from_pages(member_pages).user_ids
+        return fingerprint_user_ids(user_ids)
+
+    def get_users_common_chats_count_for_chat(
+        self,
+        chat_id: int,
+        concurrency: int = DEFAULT_CONCURRENCY,
+        progress_callback: Optional[ProgressCallback] = None,
+        skip_user_ids: Optional[Set[int]] = None,
+    ) -> Optional[CommonChatsResult]:
         """
         For each user in the specified chat, find how many common group chats are shared.
         If the user_id is the same as our own ID, skip or handle accordingly.
 
         :param chat_id: The ID of the group chat.
-        :return: A list of dictionaries of the form {"user_id": int, "count_of_common_chats": int}, or None on failure.
+        :param concurrency: The maximum number of members whose lookups are in flight at the same time.
+        :param skip_user_ids: Members left out of the result, e.g. those analyzed by an interrupted run.
+        :param progress_callback: Called after each member with (done, total, user_id, error); total is the
+            member count reported by Telegram.
+        :return: The user IDs, names and counts of the members, or None on failure.
+        """
+        rows = self.iter_users_common_chats_count_for_chat(chat_id, concurrency, progress_callback, skip_user_ids)
+        if rows is None:
+            return None
+        return CommonChatsResult.from_rows(rows)
+
+    def iter_users_common_chats_count_for_chat(
+        self,
+        chat_id: int,
+        concurrency: int = DEFAULT_CONCURRENCY,
+        progress_callback: Optional[ProgressCallback] = None,
+        skip_user_ids: Optional[Set[int]] = None,
+    ) -> Optional[Iterator[CommonChatsRow]]:
+        """
+        Streaming variant of get_users_common_chats_count_for_chat that yields each result row as soon as
+        the lookups of its member complete.
+
+        Members are streamed page by page, the common groups and the user lookups of up to ``concurrency``
+        members are in flight at once, and rows are yielded in the order they arrive. Chats in a loaded
+        co-membership matrix are answered from the matrix without any getGroupsInCommon request.
+
+        :param chat_id: The ID of the group chat.
+        :param concurrency: The maximum number of members whose lookups are in flight at the same time.
+        :param progress_callback: Called after each member with (done, total, user_id, error); total is the
+            member count reported by Telegram, less the skipped members.
+        :param skip_user_ids: Members that are not looked up and left out of the result.
+        :return: An iterator over result rows, or None if the members of the chat cannot be retrieved.
         """
-        members = self.get_chat_members(chat_id)
-        if members is None:
+        skip_user_ids = skip_user_ids or set()
+        if self.co_membership is not None and chat_id in self.co_membership:
+            return self._iter_local_common_chats_counts(
+                self.co_membership, chat_id, concurrency, progress_callback, skip_user_ids
+            )
+
+        member_pages = self.iter_chat_members(chat_id)
+        if member_pages is None:
             logger.error("Failed to get chat members.")
             return None
 
-        results = []
-        for member in members:
-            member_id = member.get("member_id", {})
-            if member_id.get("@type") == "messageSenderUser":
-                user_id = member_id.get("user_id")
-                if user_id is None:
-                    continue
+        total = max((self.get_chat_member_count(chat_id) or 0) - len(skip_user_ids), 0)
+        user_ids = self.iter_member_user_ids(member_pages, skip_user_ids)
+        return self._iter_common_chats_counts(user_ids, total, concurrency, progress_callback)
+
+    def load_co_membership_matrix(self, progress_callback: Optional[ProgressCallback] = None) -> CoMembershipMatrix:
+        """
+        Load the members of all group chats once and keep them as a co-membership matrix.
+
+        Once loaded, iter_users_common_chats_count_for_chat answers chats in the matrix locally instead of
+        sending one getGroupsInCommon per member. Counts only include the members Telegram lets us list, so for
+        supergroups with hidden or truncated member lists they can be lower than getGroupsInCommon reports.
+
+        :param progress_callback: Called after each chat with (done, total, chat_id, error).
+        :return: The loaded CoMembershipMatrix, also stored as co_membership.
+        """
+        chats = self.get_chats() or []
+        members: Dict[int, List[int]] = {}
+        for done, chat in enumerate(chats, start=1):
+            member_pages = self.iter_chat_members(chat["id"])
+            error = None
+            if member_pages is None:
+                error = "members unavailable"
+                logger.warning(f"Skipping chat {chat['id']} in the co-membership matrix: {error}")
+            else:
+                members[chat["id"]] = list(self.iter_member_user_ids(member_pages))
+            if progress_callback is not None:
+                progress_callback(done, len(chats), chat["id"], error)
+
+        self.co_membership = CoMembershipMatrix.from_member_lists(members)
+        logger.info(f"Loaded co-membership matrix of {self.co_membership.shape[0]} users in {len(members)} chats")
+        return self.co_membership
+
+    def _iter_local_common_chats_counts(
+        self,
+        matrix: CoMembershipMatrix,
+        chat_id: int,
+        concurrency: int,
+        progress_callback: Optional[ProgressCallback],
+        skip_user_ids: Set[int],
+    ) -> Iterator[CommonChatsRow]:
+        """
+        Yield the result rows of a chat from the co-membership matrix; only the names are requested, in batches.
+
+        :param matrix: The loaded co-membership matrix containing the chat.
+        :param chat_id: The ID of the group chat.
+        :param concurrency: The number of getUser requests sent at once.
+        :param progress_callback: Called after each user with (done, total, user_id, error).
+        :param skip_user_ids: Members left out of the result.
+        :return: An iterator over result rows in member order.
+        """
+        user_ids, counts = select_local_common_chats_counts(matrix, chat_id, skip_user_ids)
+        total = len(user_ids)
+        for start in range(0, total, concurrency):
+            batch = user_ids[start : start + concurrency].tolist()
+            users = self._send_and_wait_for_responses(
+                [{"@type": "getUser", "user_id": user_id} for user_id in batch], success_condition="user"
+            )
+            for offset, (user_id, count, user) in enumerate(zip(batch, counts[start : start + concurrency], users)):
+                if progress_callback is not None:
+                    progress_callback(start + offset + 1, total, user_id, None)
+                name = format_user_name(user) if user is not None else None
+                yield CommonChatsRow(user_id, name, int(count))
+
+    def _iter_common_chats_counts(
+        self,
+        user_ids: Iterator[int],
+        total: int,
+        concurrency: int,
+        progress_callback: Optional[ProgressCallback],
+    ) -> Iterator[CommonChatsRow]:
+        """
+        Look up the common groups and names of the users, keeping up to ``concurrency`` users in flight.
+
+        :param user_ids: The users to look up.
+        :param total: The expected number of users, passed to progress_callback.
+        :param concurrency: The maximum number of users whose lookups are in flight at the same time.
+        :param progress_callback: Called after each user with (done, total, user_id, error).
+        :return: An iterator over result rows in completion order.
+        """
+        done = 0
+        for user_id, common_groups, user, error in self.iter_common_groups(user_ids, concurrency):
+            done += 1
+            if error is not None:
+                logger.error(f"Failed to get common groups for user_id: {user_id}: {error}")
+            if progress_callback is not None:
+                progress_callback(done, total, user_id, error)
+            if common_groups is None:
+                continue
+            name = format_user_name(user) if user is not None else None
+            yield CommonChatsRow(user_id, name, len(common_groups.get("chat_ids", [])))
+
+    def iter_common_groups(
+        self, user_ids: Iterator[int], concurrency: int
+    ) -> Iterator[Tuple[int, Optional[Dict[str, Any]], Optional[Dict[str, Any]], Optional[str]]]:
+        """
+        Send getGroupsInCommon and getUser for the users, keeping up to ``concurrency`` users in flight.
+
+        :param user_ids: The users to look up.
+        :param concurrency: The maximum number of users whose lookups are in flight at the same time.
+        :return: An iterator over (user_id, chats response, user, error) in completion order; the chats response
+            is None and error is set if getGroupsInCommon failed.
+        """
+        common_groups_condition = self._build_condition("chats")
+        user_condition = self._build_condition("user")
+        in_flight: Dict[int, Tuple[Dict[str, Any], Future, Future]] = {}
 
-                if user_id == self.__my_user_id:
+        while True:
+            while len(in_flight) < concurrency:
+                next_user_id = next(user_ids, None)
+                if next_user_id is None:
+                    break
+                common_groups_request = self._build_common_groups_request(next_user_id)
+                in_flight[next_user_id] = (
+                    common_groups_request,
+                    self._send_request(common_groups_request),
+                    self._send_request({"@type": "getUser", "user_id": next_user_id}),
+                )
+            if not in_flight:
+                break
+
+            # Only wait while no member has both lookups done; a member with one lookup done must not wake the loop
+            if not any(all(future.done() for future in futures) for _, *futures in in_flight.values()):
+                pending_futures = [
+                    future for _, *futures in in_flight.values() for future in futures if not future.done()
+                ]
+                # The lookups may all have completed since the check, then there is nothing to wait for
+                finished, _ = wait(pending_futures, timeout=self.REQUEST_TIMEOUT, return_when=FIRST_COMPLETED)
+                if finished or not pending_futures:
+                    continue
+                if max(self.td_client.scheduler.get_delay(method) for method in ("getGroupsInCommon", "getUser")) > 0:
                     continue
+                for user_id, (_, *futures) in list(in_flight.items()):
+                    for future in futures:
+                        future.cancel()
+                    del in_flight[user_id]
+                    yield user_id, None, None, "timed out"
+                continue
 
-                common_groups_response = self.get_common_groups_with_user(user_id)
+            for user_id, (common_groups_request, common_groups_future, user_future) in list(in_flight.items()):
+                if not (common_groups_future.done() and user_future.done()):
+                    continue
+                del in_flight[user_id]
+                common_groups_response = self._check_response(
+                    common_groups_request, common_groups_future.result(), common_groups_condition
+                )
                 if common_groups_response is None:
-                    logger.error(f"Failed to get common groups for user_id: {user_id}")
+                    yield user_id, None, None, "getGroupsInCommon failed"
                     continue
-
-                chat_ids = common_groups_response.get("chat_ids", [])
-                result_item = {
-                    "name": self.get_name_by_user_id(user_id),
-                    "count": len(chat_ids),
-                }
-                results.append(result_item)
-
-        return results
+                user = self._check_response({"@type": "getUser"}, user_future.result(), user_condition)
+                yield user_id, common_groups_response, user, None
@@ -0,0 +1,318 @@
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+import numpy as np
+
+MEMBER_STATUSES = (
+    "chatMemberStatusCreator",
+    "chatMemberStatusAdministrator",
+    "chatMemberStatusMember",
+    "chatMemberStatusRestricted",
+    "chatMemberStatusLeft",
+    "chatMemberStatusBanned",
+)
+DEFAULT_MEMBER_STATUS = MEMBER_STATUSES.index("chatMemberStatusMember")
+_STATUS_CODES = {status: code for code, status in enumerate(MEMBER_STATUSES)}
+
+
+class GrowableArray:
+    """
+    A numpy array with amortized O(1) appends; ``view()`` exposes the filled part without copying.
+    """
+
+    INITIAL_CAPACITY = 64
+
+    def __init__(self, dtype: Any, capacity: int = INITIAL_CAPACITY):
+        self._data = np.empty(max(capacity, 1), dtype=dtype)
+        self._size = 0
+
+    @classmethod
+    def wrap(cls, data: np.ndarray) -> "GrowableArray":
+        """
+        Use an existing array, e.g. a read-only memmap, as the filled part without copying it.
+        """
+        array = cls.__new__(cls)
+        array._data = data
+        array._size = len(data)
+        return array
+
+    def __len__(self) -> int:
+        return self._size
+
+    def _reserve(self, size: int) -> None:
+        if size > len(self._data):
+            data = np.empty(max(size, 2 * len(self._data)), dtype=self._data.dtype)
+            data[: self._size] = self._data[: self._size]
+            self._data = data
+
+    def append(self, value: Any) -> None:
+        self._reserve(self._size + 1)
+        self._data[self._size] = value
+        self._size += 1
+
+    def extend(self, values: np.ndarray) -> None:
+        self._reserve(self._size + len(values))
+        self._data[self._size : self._size + len(values)] = values
+        self._size += len(values)
+
+    def view(self) -> np.ndarray:
+        # Views keep the buffer they were taken from alive, so later appends never invalidate them
+        return self._data[: self._size]
+
+
+class ChatMember:
+    __slots__ = ("user_id", "status")
+
+    def __init__(self, user_id: int, status: str):
+        self.user_id = user_id
+        self.status = status
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, ChatMember):
+            return NotImplemented
+        return (self.user_id, self.status) == (other.user_id, other.status)
+
+    def __repr__(self) -> str:
+        return f"ChatMember(user_id={self.user_id}, status={self.status!r})"
+
+
+class MemberList:
+    """
+    The user members of a chat as parallel arrays of user IDs and status codes.
+
+    A chatMember object from TDLib takes about a kilobyte as nested dicts; here a member takes 9 bytes.
+    Members that are chats rather than users (e.g. channels posting in a supergroup) are not kept.
+    """
+
+    def __init__(self):
+        self._user_ids = GrowableArray(np.int64)
+        self._statuses = GrowableArray(np.uint8)
+
+    @classmethod
+    def from_pages(cls, member_pages: Iterable[List[Dict[str, Any]]]) -> "MemberList":
+        """
+        Build the list from pages of chatMember objects.
+
+        :param member_pages: Pages of chatMember objects, as returned by iter_chat_members.
+        :return: The MemberList.
+        """
+        members = cls()
+        for page in member_pages:
+            members.extend(page)
+        return members
+
+    def extend(self, members: Iterable[Dict[str, Any]]) -> None:
+        """
+        Append chatMember objects, skipping members that are not users.
+
+        :param members: The chatMember objects.
+        """
+        for member in members:
+            member_id = member.get("member_id", {})
+            if member_id.get("@type") != "messageSenderUser":
+                continue
+            status = member.get("status", {}).get("@type")
+            self._user_ids.append(member_id["user_id"])
+            self._statuses.append(_STATUS_CODES.get(status, DEFAULT_MEMBER_STATUS))
+
+    @property
+    def user_ids(self) -> np.ndarray:
+        return self._user_ids.view()
+
+    @property
+    def statuses(self) -> np.ndarray:
+        """
+        Status codes of the members, indices into MEMBER_STATUSES.
+        """
+        return self._statuses.view()
+
+    def __len__(self) -> int:
+        return len(self._user_ids)
+
+    def __getitem__(self, index: int) -> ChatMember:
+        return ChatMember(int(self.user_ids[index]), MEMBER_STATUSES[self.statuses[index]])
+
+    def __iter__(self) -> Iterator[ChatMember]:
+        for user_id, status in zip(self.user_ids.tolist(), self.statuses.tolist()):
+            yield ChatMember(user_id, MEMBER_STATUSES[status])
+
+
+class CommonChatsRow:
+    """
+    The number of groups shared with one member; name is None if the user could not be retrieved.
+    """
+
+    __slots__ = ("user_id", "name", "count")
+
+    def __init__(self, user_id: int, name: Optional[str], count: int):
+        self.user_id = user_id
+        self.name = name
+        self.count = count
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, CommonChatsRow):
+            return NotImplemented
+        return (self.user_id, self.name, self.count) == (other.user_id, other.name, other.count)
+
+    def __repr__(self) -> str:
+        return f"CommonChatsRow(user_id={self.user_id}, name={self.name!r}, count={self.count})"
+
+
+class CommonChatsResult:
+    """
+    Result rows stored column by column: user IDs, counts and names as UTF-8 bytes with offsets.
+
+    The layout is the one of Arrow string columns, so to_arrow hands the columns over to a dataframe without
+    copying them, and a row costs about 12 bytes plus the bytes of its name instead of a dict per row.
+    Unknown names are stored as empty strings.
+    """
+
+    def __init__(self, capacity: int = GrowableArray.INITIAL_CAPACITY):
+        self._user_ids = GrowableArray(np.int64, capacity)
+        self._counts = GrowableArray(np.int32, capacity)
+        self._name_offsets = GrowableArray(np.int32, capacity + 1)
+        self._name_offsets.append(0)
+        self._names = GrowableArray(np.uint8, capacity * 16)
+
+    @classmethod
+    def from_rows(cls, rows: Iterable[CommonChatsRow]) -> "CommonChatsResult":
+        result = cls()
+        for row in rows:
+            result.append(row)
+        return result
+
+    @classmethod
+    def from_columns(
+        cls, user_ids: np.ndarray, counts: np.ndarray, name_offsets: np.ndarray, names: np.ndarray
+    ) -> "CommonChatsResult":
+        """
+        Build a result around existing columns without copying them, e.g. those of a snapshot.
+
+        :param user_ids: The user ID of every row.
+        :param counts: The common group count of every row.
+        :param name_offsets: Offsets into names where every name starts, one more than rows.
+        :param names: The UTF-8 bytes of all names.
+        :return: The CommonChatsResult.
+        """
+        result = cls.__new__(cls)
+        result._user_ids = GrowableArray.wrap(user_ids)
+        result._counts = GrowableArray.wrap(counts)
+        result._name_offsets = GrowableArray.wrap(name_offsets)
+        result._names = GrowableArray.wrap(names)
+        return result
+
+    @property
+    def columns(self) -> Dict[str, np.ndarray]:
+        """
+        The filled part of every column, as passed to from_columns.
+        """
+        return {
+            "user_ids": self.user_ids,
+            "counts": self.counts,
+            "name_offsets": self._name_offsets.view(),
+            "names": self._names.view(),
+        }
+
+    def append(self, row: CommonChatsRow) -> None:
+        name = (row.name or "").encode("utf-8")
+        self._user_ids.append(row.user_id)
+        self._counts.append(row.count)
+        self._names.extend(np.frombuffer(name, dtype=np.uint8))
+        self._name_offsets.append(len(self._names))
+
+    @property
+    def user_ids(self) -> np.ndarray:
+        return self._user_ids.view()
+
+    @property
+    def counts(self) -> np.ndarray:
+        return self._counts.view()
+
+    @property
+    def names(self) -> List[Optional[str]]:
+        return [row.name for row in self]
+
+    @property
+    def nbytes(self) -> int:
+        """
+        Memory taken by the rows, without the spare capacity of the arrays.
+        """
+        return sum(column.view().nbytes for column in (self._user_ids, self._counts, self._name_offsets, self._names))
+
+    def __len__(self) -> int:
+        return len(self._user_ids)
+
+    def _name(self, index: int) -> Optional[str]:
+        offsets = self._name_offsets.view()
+        name = self._names.view()[offsets[index] : offsets[index + 1]].tobytes().decode("utf-8")
+        return name or None
+
+    def __getitem__(self, index: int) -> CommonChatsRow:
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("CommonChatsResult index out of range")
+        return CommonChatsRow(int(self.user_ids[index]), self._name(index), int(self.counts[index]))
+
+    def __iter__(self) -> Iterator[CommonChatsRow]:
+        offsets = self._name_offsets.view().tolist()
+        names = self._names.view().tobytes()
+        for index, (user_id, count) in enumerate(zip(self.user_ids.tolist(), self.counts.tolist())):
+            name = names[offsets[index] : offsets[index + 1]].decode("utf-8")
+            yield CommonChatsRow(user_id, name or None, count)
+
+    def take(self, indices: np.ndarray) -> "CommonChatsResult":
+        """
+        Select rows by position.
+
+        :param indices: Positions of the rows to keep, in the order to keep them.
+        :return: A new CommonChatsResult.
+        """
+        offsets = self._name_offsets.view()
+        starts = offsets[indices]
+        lengths = offsets[indices + 1] - starts
+        result = CommonChatsResult(len(indices))
+        result._user_ids.extend(self.user_ids[indices])
+        result._counts.extend(self.counts[indices])
+        new_offsets = np.zeros(len(indices) + 1, dtype=np.int32)
+        np.cumsum(lengths, out=new_offsets[1:])
+        result._name_offsets = GrowableArray(np.int32, len(new_offsets))
+        result._name_offsets.extend(new_offsets)
+        # Position of every name byte in the source buffer: the start of its row plus its offset within the row
+        positions = np.repeat(starts - new_offsets[:-1], lengths) + np.arange(new_offsets[-1])
+        result._names.extend(self._names.view()[positions])
+        return result
+
+    def top_k(self, k: int) -> "CommonChatsResult":
+        """
+        Select the k rows with the most common groups, in descending order, without sorting all rows.
+
+        :param k: The number of rows to keep.
+        :return: A new CommonChatsResult of at most k rows.
+        """
+        counts = self.counts
+        if k <= 0 or len(counts) == 0:
+            return self.take(np.empty(0, dtype=np.int64))
+        if k < len(counts):
+            indices = np.argpartition(-counts, k - 1)[:k]
+        else:
+            indices = np.arange(len(counts))
+        return self.take(indices[np.argsort(-counts[indices], kind="stable")])
+
+    def to_arrow(self) -> Any:
+        """
+        Expose the columns as a pyarrow Table sharing the memory of this result.
+
+        :return: A pyarrow.Table with user_id, name and count columns.
+        :raises ImportError: If pyarrow is not installed; it comes with Streamlit or the "arrow" extra.
+        """
+        try:
+            import pyarrow as pa
+        except ImportError as e:
+            raise ImportError('to_arrow requires pyarrow: install it with the "arrow" extra') from e
+
+        names = pa.StringArray.from_buffers(
+            len(self), pa.py_buffer(self._name_offsets.view()), pa.py_buffer(self._names.view())
+        )
+        return pa.Table.from_arrays(
+            [pa.array(self.user_ids), names, pa.array(self.counts)], names=["user_id", "name", "count"]
+        )
@@ -0,0 +1,219 @@
+import re
+import threading
+import time
+from collections import deque
+from typing import Callable, Deque, Dict, Optional
+
+from loguru import logger
+
+FLOOD_WAIT_PATTERNS = (re.compile(r"FLOOD_WAIT_(\d+)"), re.compile(r"retry after (\d+)"))
+
+
+def parse_flood_wait(event: Dict) -> Optional[int]:
+    """
+    Extract the number of seconds to wait from a FLOOD_WAIT error.
+
+    TDLib reports flood limits either as ``420 FLOOD_WAIT_X`` or as ``429 Too Many Requests: retry after X``.
+
+    :param event: The received event.
+    :return: The wait time in seconds, or None if the event is not a flood error.
+    """
+    if event.get("@type") != "error" or event.get("code") not in (420, 429):
+        return None
+    for pattern in FLOOD_WAIT_PATTERNS:
+        match = pattern.search(event.get("message", ""))
+        if match:
+            return int(match.group(1))
+    return None
+
+
+class TokenBucket:
+    """
+    Token bucket for a single method class. A rate of None means the method is not limited.
+    """
+
+    def __init__(self, rate: Optional[float] = None):
+        self.rate = rate
+        self.tokens = 1.0
+        self.paused_until = 0.0
+        self._updated_at = time.monotonic()
+        self._sent_at: Deque[float] = deque(maxlen=50)
+
+    @property
+    def capacity(self) -> float:
+        return max(1.0, self.rate or 1.0)
+
+    def _refill(self, now: float) -> None:
+        if self.rate is not None:
+            self.tokens = min(self.capacity, self.tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    def get_delay(self, now: float) -> float:
+        """
+        Seconds until the next request of this method may be sent.
+        """
+        self._refill(now)
+        if now < self.paused_until:
+            return self.paused_until - now
+        if self.rate is None or self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self, now: float) -> None:
+        if self.rate is not None:
+            self.tokens -= 1
+        self._sent_at.append(now)
+
+    def observed_rate(self, now: float) -> Optional[float]:
+        """
+        Requests per second sent recently, or None if there is not enough history.
+        """
+        if len(self._sent_at) < 2 or now <= self._sent_at[0]:
+            return None
+        return len(self._sent_at) / (now - self._sent_at[0])
+
+
+class RequestScheduler:
+    """
+    Sends queued requests at a per-method rate learned from FLOOD_WAIT errors.
+
+    Methods start unlimited. When one of them hits FLOOD_WAIT, only that method is paused for the requested
+    time and its rate is cut to a fraction of what was observed before the error. Each successful response
+    then raises the rate again (additive increase, multiplicative decrease), so bulk scans converge to the
+    highest rate Telegram tolerates.
+    """
+
+    MIN_RATE = 0.2
+    MAX_RATE = 100.0
+    BACKOFF_FACTOR = 0.5
+    RATE_INCREASE = 1.0
+    DEFAULT_FLOOD_RATE = 5.0
+
+    def __init__(self, send: Callable[[Dict], None]):
+        """
+        Initialize the RequestScheduler.
+
+        :param send: Callable that actually sends a query to TDLib.
+        """
+        self._send = send
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._queues: Dict[str, Deque[Dict]] = {}
+        self._condition = threading.Condition()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name="tdlib-scheduler", daemon=True)
+        self._thread.start()
+
+    def _bucket(self, method: str) -> TokenBucket:
+        bucket = self._buckets.get(method)
+        if bucket is None:
+            bucket = self._buckets[method] = TokenBucket()
+        return bucket
+
+    def submit(self, query: Dict) -> None:
+        """
+        Queue a query. It is sent as soon as the budget of its method allows.
+
+        :param query: The query to send.
+        """
+        with self._condition:
+            if self._stopped:
+                return
+            self._queues.setdefault(query["@type"], deque()).append(query)
+            self._condition.notify()
+
+    def on_flood_wait(self, method: str, wait_time: int) -> None:
+        """
+        Pause a method and lower its rate after a FLOOD_WAIT error.
+
+        :param method: The @type of the request that hit the limit.
+        :param wait_time: The number of seconds Telegram asked to wait.
+        """
+        with self._condition:
+            now = time.monotonic()
+            bucket = self._bucket(method)
+            current_rate = bucket.rate or bucket.observed_rate(now) or self.DEFAULT_FLOOD_RATE
+            bucket.rate = min(self.MAX_RATE, max(self.MIN_RATE, current_rate * self.BACKOFF_FACTOR))
+            bucket.tokens = 0.0
+            bucket.paused_until = max(bucket.paused_until, now + wait_time)
+            logger.warning(f"FLOOD_WAIT for {method}: pausing {wait_time} s, rate lowered to {bucket.rate:.2f}/s")
+            self._condition.notify()
+
+    def on_success(self, method: str) -> None:
+        """
+        Raise the rate of a limited method after a successful response.
+
+        :param method: The @type of the request.
+        """
+        with self._condition:
+            bucket = self._buckets.get(method)
+            if bucket is not None and bucket.rate is not None:
+                bucket.rate = min(self.MAX_RATE, bucket.rate + self.RATE_INCREASE / bucket.rate)
+
+    def get_delay(self, method: str) -> float:
+        """
+        Seconds until the next request of a method may be sent.
+
+        :param method: The @type of the request.
+        :return: The delay in seconds, 0 if the method is not limited right now.
+        """
+        with self._condition:
+            bucket = self._buckets.get(method)
+            return bucket.get_delay(time.monotonic()) if bucket is not None else 0.0
+
+    def budget(self) -> Dict[str, Dict[str, Optional[float]]]:
+        """
+        Current budget of every method seen so far.
+
+        :return: A mapping of method to its rate (requests/s, None if unlimited), available tokens,
+            remaining pause in seconds and number of queued requests.
+        """
+        with self._condition:
+            now = time.monotonic()
+            budget: Dict[str, Dict[str, Optional[float]]] = {}
+            for method in set(self._buckets) | set(self._queues):
+                bucket = self._bucket(method)
+                bucket.get_delay(now)
+                budget[method] = {
+                    "rate": bucket.rate,
+                    "tokens": bucket.tokens if bucket.rate is not None else None,
+                    "paused_for": max(0.0, bucket.paused_until - now),
+                    "queued": len(self._queues.get(method, ())),
+                }
+            return budget
+
+    def stop(self) -> None:
+        """
+        Stop the sender thread; queued queries are dropped and later ones are never sent.
+        """
+        with self._condition:
+            self._stopped = True
+            self._queues.clear()
+            self._condition.notify_all()
+        if self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                if self._stopped:
+                    return
+                ready = []
+                next_wake: Optional[float] = None
+                now = time.monotonic()
+                for method, queue in self._queues.items():
+                    bucket = self._bucket(method)
+                    while queue:
+                        delay = bucket.get_delay(now)
+                        if delay > 0:
+                            next_wake = delay if next_wake is None else min(next_wake, delay)
+                            break
+                        bucket.consume(now)
+                        ready.append(queue.popleft())
+                if not ready:
+                    self._condition.wait(timeout=next_wake)
+                    continue
+            for query in ready:
+                try:
+                    self._send(query)
+                except Exception:
+                    logger.exception(f"Failed to send {query.get('@type')}")
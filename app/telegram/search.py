@@ -0,0 +1,190 @@
+import threading
+import unicodedata
+from typing import Any, Dict, Iterable, List, Optional, Set
+
+import numpy as np
+
+# Ranks of a match, best first
+EXACT, PREFIX, WORD_PREFIX, SUBSTRING, FUZZY = range(5)
+
+
+def normalize(text: str) -> str:
+    """
+    Fold case, compatibility characters and whitespace, so that "ＡＢＣ  Chat" matches "abc chat".
+    """
+    return " ".join(unicodedata.normalize("NFKC", text).casefold().split())
+
+
+def word_trigrams(text: str, pad_end: bool = True) -> Set[str]:
+    """
+    Trigrams of every word padded with two spaces in front and one behind, as in PostgreSQL's pg_trgm.
+
+    :param text: Normalized text.
+    :param pad_end: Pad the end of the last word; disabled for queries, whose last word may still be typed.
+    :return: The set of trigrams.
+    """
+    words = text.split(" ")
+    result = set()
+    for index, word in enumerate(words):
+        if not word:
+            continue
+        padded = "  " + word + (" " if pad_end or index < len(words) - 1 else "")
+        result.update(padded[i : i + 3] for i in range(len(padded) - 2))
+    return result
+
+
+def short_grams(text: str) -> Set[str]:
+    """
+    Every substring of one or two characters, which answer the queries too short for trigrams.
+    """
+    return set(text) | {text[i : i + 2] for i in range(len(text) - 1)}
+
+
+def inner_trigrams(text: str) -> Set[str]:
+    """
+    Unpadded trigrams: every substring of the text contains all inner trigrams of the substring.
+    """
+    return {text[i : i + 3] for i in range(len(text) - 2)}
+
+
+class ChatIndex:
+    """
+    Search index over chat titles, filled page by page as the chat list loads.
+
+    Titles are indexed by their trigrams. A query matches the titles that contain it, ranked exact match first,
+    then title prefix, word prefix and substring, and the titles sharing at least half of its trigrams, which
+    tolerates typos. Queries of one or two characters, too short for trigrams, are looked up by the substrings
+    of one and two characters of the titles instead, and match no titles by similarity. Ties keep the order of
+    the chat list.
+    """
+
+    MIN_SIMILARITY = 0.5
+
+    def __init__(self):
+        self._chats: List[Dict[str, Any]] = []
+        self._names: List[str] = []
+        self._positions: Dict[int, int] = {}
+        self._postings: Dict[str, List[int]] = {}
+        self._inner_postings: Dict[str, List[int]] = {}
+        self._short_postings: Dict[str, List[int]] = {}
+        self._stale = False
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._chats)
+
+    def __contains__(self, chat_id: int) -> bool:
+        return chat_id in self._positions
+
+    def add(self, chats: Iterable[Dict[str, Any]]) -> None:
+        """
+        Add chats, or update the titles of chats already indexed.
+
+        :param chats: Dictionaries of the form {"id": int, "name": str}.
+        """
+        with self._lock:
+            for chat in chats:
+                position = self._positions.get(chat["id"])
+                if position is not None:
+                    if self._chats[position]["name"] != chat["name"]:
+                        self._chats[position] = chat
+                        self._names[position] = normalize(chat["name"])
+                        self._stale = True
+                    continue
+                position = self._positions[chat["id"]] = len(self._chats)
+                self._chats.append(chat)
+                self._names.append(normalize(chat["name"]))
+                self._index(position)
+
+    def rename(self, chat_id: int, name: str) -> None:
+        """
+        Update the title of an indexed chat; chats not indexed are ignored.
+
+        :param chat_id: The ID of the chat.
+        :param name: The new title.
+        """
+        with self._lock:
+            position = self._positions.get(chat_id)
+            if position is None or self._chats[position]["name"] == name:
+                return
+            self._chats[position] = {**self._chats[position], "name": name}
+            self._names[position] = normalize(name)
+            self._stale = True
+
+    def get(self, chat_id: int) -> Optional[Dict[str, Any]]:
+        position = self._positions.get(chat_id)
+        return self._chats[position] if position is not None else None
+
+    def search(self, query: str, limit: Optional[int] = None) -> List[int]:
+        """
+        Find chats by title.
+
+        :param query: The text typed by the user; an empty query matches every chat.
+        :param limit: The maximum number of results.
+        :return: The IDs of the matching chats, best match first.
+        """
+        query = normalize(query)
+        with self._lock:
+            if self._stale:
+                self._rebuild()
+            if not query:
+                return [chat["id"] for chat in self._chats[:limit]]
+            candidates = self._find_candidates(query)
+            ranked = sorted(
+                (rank, -similarity, position)
+                for position, similarity in candidates.items()
+                if (rank := self._rank(self._names[position], query, similarity)) is not None
+            )
+            return [self._chats[position]["id"] for *_, position in ranked[:limit]]
+
+    def _index(self, position: int) -> None:
+        name = self._names[position]
+        for trigram in word_trigrams(name):
+            self._postings.setdefault(trigram, []).append(position)
+        for trigram in inner_trigrams(name):
+            self._inner_postings.setdefault(trigram, []).append(position)
+        for gram in short_grams(name):
+            self._short_postings.setdefault(gram, []).append(position)
+
+    def _rebuild(self) -> None:
+        self._postings = {}
+        self._inner_postings = {}
+        self._short_postings = {}
+        for position in range(len(self._chats)):
+            self._index(position)
+        self._stale = False
+
+    def _count(self, postings: Dict[str, List[int]], trigrams: Set[str]) -> np.ndarray:
+        lists = [postings[trigram] for trigram in trigrams if trigram in postings]
+        if not lists:
+            return np.zeros(len(self._chats), dtype=np.int64)
+        return np.bincount(np.concatenate([np.asarray(positions) for positions in lists]), minlength=len(self._chats))
+
+    def _find_candidates(self, query: str) -> Dict[int, float]:
+        """
+        Chats that may match the query, with the share of the query's trigrams found in their title.
+        """
+        query_trigrams = word_trigrams(query, pad_end=False)
+        counts = self._count(self._postings, query_trigrams)
+        similarities = counts / len(query_trigrams)
+        if len(query) < 3:
+            matches = np.asarray(self._short_postings.get(query, []), dtype=np.int64)
+        else:
+            # A title containing the query contains all of its inner trigrams
+            inner = inner_trigrams(query)
+            substrings = self._count(self._inner_postings, inner) == len(inner)
+            matches = np.flatnonzero(substrings | (similarities >= self.MIN_SIMILARITY))
+        return {int(position): float(similarities[position]) for position in matches}
+
+    def _rank(self, name: str, query: str, similarity: float) -> Optional[int]:
+        if name == query:
+            return EXACT
+        if name.startswith(query):
+            return PREFIX
+        if (" " + name).find(" " + query) >= 0:
+            return WORD_PREFIX
+        if query in name:
+            return SUBSTRING
+        if len(query) >= 3 and similarity >= self.MIN_SIMILARITY:
+            return FUZZY
+        return None
@@ -0,0 +1,221 @@
+import os
+import shutil
+import tempfile
+import time
+from typing import Dict, List, Optional
+
+import numpy as np
+from dotenv import load_dotenv
+from loguru import logger
+
+from app.telegram.results import CommonChatsResult
+
+load_dotenv()
+
+
+class Snapshot:
+    """
+    A saved analysis result: one .npy file per column of its CommonChatsResult, rows sorted by user ID.
+
+    Columns are memory-mapped on first use, so listing snapshots reads no data and looking up a few users
+    reads only the pages holding them.
+    """
+
+    COLUMNS = ("user_ids", "counts", "name_offsets", "names")
+
+    def __init__(self, path: str, chat_id: int, created_at: float):
+        """
+        Initialize the Snapshot.
+
+        :param path: The directory of the column files.
+        :param chat_id: The ID of the analyzed chat.
+        :param created_at: The Unix time the analysis finished.
+        """
+        self.path = path
+        self.chat_id = chat_id
+        self.created_at = created_at
+        self._columns: Dict[str, np.ndarray] = {}
+
+    def _column(self, name: str) -> np.ndarray:
+        if name not in self._columns:
+            self._columns[name] = np.load(os.path.join(self.path, f"{name}.npy"), mmap_mode="r")
+        return self._columns[name]
+
+    @property
+    def user_ids(self) -> np.ndarray:
+        return self._column("user_ids")
+
+    @property
+    def counts(self) -> np.ndarray:
+        return self._column("counts")
+
+    def __len__(self) -> int:
+        return len(self.user_ids)
+
+    def __repr__(self) -> str:
+        return f"Snapshot(chat_id={self.chat_id}, created_at={self.created_at})"
+
+    def to_result(self) -> CommonChatsResult:
+        """
+        The saved result, backed by the memory-mapped columns.
+        """
+        return CommonChatsResult.from_columns(*(self._column(name) for name in self.COLUMNS))
+
+    def get_counts(self, user_ids: np.ndarray) -> np.ndarray:
+        """
+        Look up the common group counts of users.
+
+        :param user_ids: The IDs of the users.
+        :return: The count of every user, -1 for users who were not members.
+        """
+        user_ids = np.asarray(user_ids, dtype=np.int64)
+        if len(self) == 0:
+            return np.full(len(user_ids), -1, dtype=np.int64)
+        rows = np.minimum(np.searchsorted(self.user_ids, user_ids), len(self) - 1)
+        found = self.user_ids[rows] == user_ids
+        return np.where(found, self.counts[rows], -1).astype(np.int64)
+
+
+class SnapshotDiff:
+    """
+    Changes between two snapshots of a chat.
+    """
+
+    def __init__(
+        self,
+        joined: np.ndarray,
+        left: np.ndarray,
+        changed: np.ndarray,
+        previous_counts: np.ndarray,
+        counts: np.ndarray,
+    ):
+        """
+        Initialize the SnapshotDiff.
+
+        :param joined: The users who are members in the newer snapshot only.
+        :param left: The users who are members in the older snapshot only.
+        :param changed: The members of both whose common group count changed.
+        :param previous_counts: The counts of the changed members in the older snapshot.
+        :param counts: The counts of the changed members in the newer snapshot.
+        """
+        self.joined = joined
+        self.left = left
+        self.changed = changed
+        self.previous_counts = previous_counts
+        self.counts = counts
+
+
+class SnapshotStore:
+    """
+    Timestamped analysis results on disk, one directory per chat and one per snapshot.
+
+    A snapshot is written to a temporary directory and renamed into place, so a crash never leaves a partial
+    snapshot behind.
+    """
+
+    DEFAULT_DIR = os.getenv("SNAPSHOT_DIR", "snapshots")
+
+    def __init__(self, root: str = DEFAULT_DIR):
+        """
+        Initialize the SnapshotStore.
+
+        :param root: The directory snapshots are kept in, created if missing.
+        """
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def _chat_dir(self, chat_id: int) -> str:
+        return os.path.join(self.root, str(chat_id))
+
+    def save(self, chat_id: int, result: CommonChatsResult, created_at: Optional[float] = None) -> Snapshot:
+        """
+        Save an analysis result.
+
+        :param chat_id: The ID of the analyzed chat.
+        :param result: The result rows.
+        :param created_at: The Unix time of the analysis, now if omitted.
+        :return: The saved Snapshot.
+        """
+        created_at = time.time() if created_at is None else created_at
+        chat_dir = self._chat_dir(chat_id)
+        os.makedirs(chat_dir, exist_ok=True)
+        sorted_result = result.take(np.argsort(result.user_ids, kind="stable"))
+        temp_dir = tempfile.mkdtemp(prefix=".snapshot-", dir=chat_dir)
+        try:
+            for name, column in sorted_result.columns.items():
+                np.save(os.path.join(temp_dir, f"{name}.npy"), column)
+            # Snapshot directories are named by their time in milliseconds, so that they sort by time
+            timestamp = int(created_at * 1000)
+            while True:
+                path = os.path.join(chat_dir, str(timestamp))
+                try:
+                    os.rename(temp_dir, path)
+                    break
+                except OSError:
+                    if not os.path.exists(path):
+                        raise
+                    timestamp += 1
+        except Exception:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            raise
+        logger.info(f"Saved snapshot of {len(result)} members of chat {chat_id}")
+        return Snapshot(path, chat_id, timestamp / 1000)
+
+    def list(self, chat_id: int) -> List[Snapshot]:
+        """
+        The snapshots of a chat, oldest first; no column is read.
+        """
+        chat_dir = self._chat_dir(chat_id)
+        if not os.path.isdir(chat_dir):
+            return []
+        timestamps = sorted(int(name) for name in os.listdir(chat_dir) if name.isdigit())
+        return [Snapshot(os.path.join(chat_dir, str(timestamp)), chat_id, timestamp / 1000) for timestamp in timestamps]
+
+    def latest(self, chat_id: int) -> Optional[Snapshot]:
+        snapshots = self.list(chat_id)
+        return snapshots[-1] if snapshots else None
+
+    @staticmethod
+    def diff(old: Snapshot, new: Snapshot) -> SnapshotDiff:
+        """
+        Compare two snapshots of a chat.
+
+        :param old: The older snapshot.
+        :param new: The newer snapshot.
+        :return: The members who joined or left, and those whose common group count changed.
+        """
+        old_user_ids, new_user_ids = np.asarray(old.user_ids), np.asarray(new.user_ids)
+        common, old_rows, new_rows = np.intersect1d(old_user_ids, new_user_ids, return_indices=True)
+        old_counts, new_counts = np.asarray(old.counts)[old_rows], np.asarray(new.counts)[new_rows]
+        changed = old_counts != new_counts
+        return SnapshotDiff(
+            np.setdiff1d(new_user_ids, old_user_ids),
+            np.setdiff1d(old_user_ids, new_user_ids),
+            common[changed],
+            old_counts[changed],
+            new_counts[changed],
+        )
+
+    def trend(self, chat_id: int, user_ids: Optional[np.ndarray] = None) -> Dict[str, np.ndarray]:
+        """
+        Follow a chat across its snapshots.
+
+        :param chat_id: The ID of the chat.
+        :param user_ids: Users to follow; their counts are looked up without reading whole snapshots.
+        :return: Arrays with an entry per snapshot: "created_at", "members" and "mean_count", and with
+            user_ids, "user_counts" of shape (snapshots, users), -1 where a user was not a member.
+        """
+        snapshots = self.list(chat_id)
+        trend = {
+            "created_at": np.array([snapshot.created_at for snapshot in snapshots], dtype=np.float64),
+            "members": np.array([len(snapshot) for snapshot in snapshots], dtype=np.int64),
+            "mean_count": np.array(
+                [snapshot.counts.mean() if len(snapshot) else 0.0 for snapshot in snapshots], dtype=np.float64
+            ),
+        }
+        if user_ids is not None:
+            user_ids = np.asarray(user_ids, dtype=np.int64)
+            trend["user_counts"] = np.array(
+                [snapshot.get_counts(user_ids) for snapshot in snapshots], dtype=np.int64
+            ).reshape(len(snapshots), len(user_ids))
+        return trend
@@ -0,0 +1,143 @@
+import copy
+import threading
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Optional, Union
+
+if TYPE_CHECKING:
+    from app.telegram.async_client import AsyncTDLibClient
+    from app.telegram.client import TDLibClient
+
+    UpdateSource = Union[TDLibClient, AsyncTDLibClient]
+
+
+class EntityStore:
+    """
+    In-memory chats, users and groups, kept current by the updates TDLib pushes.
+
+    TDLib sends ``updateNewChat``/``updateUser``/``updateBasicGroup`` before any response that references the
+    entity, so after a member list has been fetched its users are usually already known here.
+    """
+
+    def __init__(self, td_client: Optional["UpdateSource"] = None):
+        """
+        Initialize the EntityStore.
+
+        :param td_client: A client to subscribe to; use attach to subscribe later.
+        """
+        self.chats: Dict[int, Dict[str, Any]] = {}
+        self.users: Dict[int, Dict[str, Any]] = {}
+        self.basic_groups: Dict[int, Dict[str, Any]] = {}
+        self.basic_group_full_infos: Dict[int, Dict[str, Any]] = {}
+        self.supergroups: Dict[int, Dict[str, Any]] = {}
+        self.main_list_orders: Dict[int, int] = {}
+        self._lock = threading.Lock()
+        if td_client is not None:
+            self.attach(td_client)
+
+    def attach(self, td_client: "UpdateSource") -> None:
+        """
+        Subscribe to the updates of a client.
+
+        :param td_client: A client exposing add_update_handler.
+        """
+        handlers: Dict[str, Callable[[Dict], None]] = {
+            "updateNewChat": self._on_new_chat,
+            "updateChatTitle": self._on_chat_title,
+            "updateChatPosition": self._on_chat_position,
+            "updateUser": self._on_user,
+            "updateUserStatus": self._on_user_status,
+            "updateBasicGroup": self._on_basic_group,
+            "updateBasicGroupFullInfo": self._on_basic_group_full_info,
+            "updateSupergroup": self._on_supergroup,
+        }
+        for update_type, handler in handlers.items():
+            td_client.add_update_handler(update_type, handler)
+
+    def _on_new_chat(self, update: Dict[str, Any]) -> None:
+        chat = update["chat"]
+        with self._lock:
+            self.chats[chat["id"]] = chat
+            for position in chat.get("positions", []):
+                self._set_main_list_order(chat["id"], position)
+
+    def _on_chat_title(self, update: Dict[str, Any]) -> None:
+        with self._lock:
+            chat = self.chats.get(update["chat_id"])
+            if chat is not None:
+                self.chats[update["chat_id"]] = {**chat, "title": update["title"]}
+
+    def _on_chat_position(self, update: Dict[str, Any]) -> None:
+        with self._lock:
+            self._set_main_list_order(update["chat_id"], update["position"])
+
+    def _set_main_list_order(self, chat_id: int, position: Dict[str, Any]) -> None:
+        if position["list"]["@type"] != "chatListMain":
+            return
+        order = int(position["order"])
+        if order == 0:
+            self.main_list_orders.pop(chat_id, None)
+        else:
+            self.main_list_orders[chat_id] = order
+
+    def _on_user(self, update: Dict[str, Any]) -> None:
+        user = update["user"]
+        with self._lock:
+            self.users[user["id"]] = user
+
+    def _on_user_status(self, update: Dict[str, Any]) -> None:
+        with self._lock:
+            user = self.users.get(update["user_id"])
+            if user is not None:
+                self.users[update["user_id"]] = {**user, "status": update["status"]}
+
+    def _on_basic_group(self, update: Dict[str, Any]) -> None:
+        basic_group = update["basic_group"]
+        with self._lock:
+            self.basic_groups[basic_group["id"]] = basic_group
+
+    def _on_basic_group_full_info(self, update: Dict[str, Any]) -> None:
+        with self._lock:
+            self.basic_group_full_infos[update["basic_group_id"]] = update["basic_group_full_info"]
+
+    def _on_supergroup(self, update: Dict[str, Any]) -> None:
+        supergroup = update["supergroup"]
+        with self._lock:
+            self.supergroups[supergroup["id"]] = supergroup
+
+    def get_chat(self, chat_id: int) -> Optional[Dict[str, Any]]:
+        return self.chats.get(chat_id)
+
+    def get_user(self, user_id: int) -> Optional[Dict[str, Any]]:
+        return self.users.get(user_id)
+
+    def get_main_chat_list(self) -> List[int]:
+        """
+        IDs of the chats in the main chat list, in the order Telegram shows them.
+
+        :return: The chat IDs, most recent first.
+        """
+        with self._lock:
+            return sorted(self.main_list_orders, key=self.main_list_orders.__getitem__, reverse=True)
+
+    def get_response(self, request_data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """
+        Answer a request from the store.
+
+        :param request_data: The request, e.g. {"@type": "getUser", "user_id": 1}.
+        :return: A copy of the entity the request would return, which the caller may modify, or None if it is not
+            known.
+        """
+        request_type = request_data["@type"]
+        if request_type == "getChat":
+            entity = self.chats.get(request_data["chat_id"])
+        elif request_type == "getUser":
+            entity = self.users.get(request_data["user_id"])
+        elif request_type == "getBasicGroup":
+            entity = self.basic_groups.get(request_data["basic_group_id"])
+        elif request_type == "getBasicGroupFullInfo":
+            entity = self.basic_group_full_infos.get(request_data["basic_group_id"])
+        elif request_type == "getSupergroup":
+            entity = self.supergroups.get(request_data["supergroup_id"])
+        else:
+            return None
+        # Like the responses of coalesced requests, every caller gets its own copy
+        return copy.deepcopy(entity) if entity is not None else None
@@ -0,0 +1,114 @@
+"""
+Throughput, latency and memory of the analysis against the in-process fake Telegram.
+
+Run from the repository root:
+
+    python -m benchmarks.analysis_benchmark --sizes 100 10000 100000 --latency 0.005
+"""
+
+import argparse
+import statistics
+import time
+import tracemalloc
+from typing import Callable, Dict, List, Tuple, TypeVar
+
+import app.telegram.functional as F
+from app.telegram.client import TDLibClient
+from app.telegram.fake import FakeTelegram
+from app.telegram.processor import ChatMemberService
+
+T = TypeVar("T")
+
+LATENCY_SAMPLES = 200
+
+
+def measure(function: Callable[[], T], trace_memory: bool) -> Tuple[T, float, int]:
+    """
+    Run a function once.
+
+    :return: Its result, the wall time in seconds and the peak of traced memory in bytes (0 if not traced).
+    """
+    if trace_memory:
+        tracemalloc.start()
+    started_at = time.perf_counter()
+    result = function()
+    elapsed = time.perf_counter() - started_at
+    peak = 0
+    if trace_memory:
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def measure_latency(td_client: TDLibClient) -> Tuple[float, float]:
+    """
+    Round trip of sequential getMe requests.
+
+    :return: The median and the 99th percentile in seconds.
+    """
+    samples = []
+    for _ in range(LATENCY_SAMPLES):
+        started_at = time.perf_counter()
+        td_client.send_request({"@type": "getMe"}).result()
+        samples.append(time.perf_counter() - started_at)
+    percentiles = statistics.quantiles(samples, n=100)
+    return statistics.median(samples), percentiles[98]
+
+
+def run(size: int, chats: int, latency: float, concurrency: int, trace_memory: bool) -> Dict[str, float]:
+    fake = FakeTelegram(group_sizes=[size] + [20] * chats, latency=latency)
+    F.set_backend(fake)
+    td_client = TDLibClient("1", "hash", warm_start=False)
+    service = ChatMemberService(td_client)
+
+    requests_before = fake.requests
+    loaded_chats, chats_time, chats_memory = measure(service.get_chats, trace_memory)
+    chats_requests = fake.requests - requests_before
+
+    chat_id = fake.groups[0].chat_id
+    requests_before = fake.requests
+    rows, analysis_time, analysis_memory = measure(
+        lambda: service.get_users_common_chats_count_for_chat(chat_id, concurrency=concurrency), trace_memory
+    )
+    analysis_requests = fake.requests - requests_before
+    assert loaded_chats is not None and len(loaded_chats) == chats + 1
+    assert rows is not None and len(rows) == size - 1
+
+    median_latency, p99_latency = measure_latency(td_client)
+    td_client.close()
+    return {
+        "members": size,
+        "get_chats_s": chats_time,
+        "get_chats_rps": chats_requests / chats_time,
+        "get_chats_mb": chats_memory / 1e6,
+        "analysis_s": analysis_time,
+        "analysis_rps": analysis_requests / analysis_time,
+        "analysis_mb": analysis_memory / 1e6,
+        "result_mb": rows.nbytes / 1e6,
+        "latency_p50_ms": median_latency * 1e3,
+        "latency_p99_ms": p99_latency * 1e3,
+    }
+
+
+def print_table(results: List[Dict[str, float]]) -> None:
+    columns = list(results[0])
+    print(" ".join(f"{column:>14}" for column in columns))
+    for result in results:
+        print(" ".join(f"{result[column]:>14.2f}" for column in columns))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 10000, 100000], help="members of the group")
+    parser.add_argument("--chats", type=int, default=200, help="number of other groups in the chat list")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds between a request and its response")
+    parser.add_argument("--concurrency", type=int, default=ChatMemberService.DEFAULT_CONCURRENCY)
+    parser.add_argument("--memory", action="store_true", help="trace memory (slows the run down)")
+    args = parser.parse_args()
+
+    results = [run(size, args.chats, args.latency, args.concurrency, args.memory) for size in args.sizes]
+    print_table(results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""
+Benchmark of the JSON codecs on the receive path of TDLibClient.
+
+Run from the repository root:
+
+    python -m benchmarks.codec_benchmark
+"""
+
+import json
+import random
+import timeit
+from typing import Any, Callable, Dict, List
+
+from app.telegram.codec import CODECS, get_codec, is_response, peek_type
+
+REPEAT = 5
+
+
+def make_basic_group_full_info(member_count: int) -> Dict[str, Any]:
+    return {
+        "@type": "basicGroupFullInfo",
+        "description": "",
+        "creator_user_id": 1,
+        "members": [
+            {
+                "@type": "chatMember",
+                "member_id": {"@type": "messageSenderUser", "user_id": 100000 + user_id},
+                "inviter_user_id": 1,
+                "joined_chat_date": 1700000000 + user_id,
+                "status": {"@type": "chatMemberStatusMember"},
+            }
+            for user_id in range(member_count)
+        ],
+        "@extra": "1",
+        "@client_id": 1,
+    }
+
+
+def make_update_flood(count: int) -> List[Dict[str, Any]]:
+    rng = random.Random(0)
+    return [
+        {
+            "@type": "updateNewMessage",
+            "message": {
+                "@type": "message",
+                "id": rng.getrandbits(40),
+                "sender_id": {"@type": "messageSenderUser", "user_id": rng.getrandbits(32)},
+                "chat_id": -rng.getrandbits(40),
+                "date": 1700000000 + index,
+                "content": {
+                    "@type": "messageText",
+                    "text": {"@type": "formattedText", "text": "Привет " * rng.randint(1, 40), "entities": []},
+                },
+            },
+            "@client_id": 1,
+        }
+        for index in range(count)
+    ]
+
+
+def best_of(function: Callable[[], Any], number: int) -> float:
+    return min(timeit.repeat(function, number=number, repeat=REPEAT)) / number
+
+
+def main():
+    full_info = json.dumps(make_basic_group_full_info(10000)).encode("utf-8")
+    flood = [json.dumps(update).encode("utf-8") for update in make_update_flood(10000)]
+    codecs = {}
+    for name in CODECS:
+        codec = get_codec(name)
+        if codec.name == name:
+            codecs[name] = codec.loads
+
+    print(f"basicGroupFullInfo with 10000 members, {len(full_info) / 1e6:.1f} MB")
+    baseline = None
+    for name, loads in codecs.items():
+        seconds = best_of(lambda: loads(full_info), number=5)
+        baseline = baseline or seconds
+        print(f"  {name:<30} {seconds * 1e3:8.2f} ms  x{baseline / seconds:.1f}")
+
+    print(f"Flood of {len(flood)} updateNewMessage events nobody handles")
+    baseline = None
+    for name, loads in codecs.items():
+        seconds = best_of(lambda: [loads(data) for data in flood], number=1)
+        baseline = baseline or seconds
+        print(f"  {name:<30} {seconds * 1e3:8.2f} ms  x{baseline / seconds:.1f}")
+    seconds = best_of(lambda: [is_response(data) or peek_type(data) for data in flood], number=1)
+    print(f"  {'skipped undecoded':<30} {seconds * 1e3:8.2f} ms  x{baseline / seconds:.1f}")
+
+
+if __name__ == "__main__":
+    main()
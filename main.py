@@ -1,67 +1,370 @@
 import os
+import time
+from typing import Dict, Optional
 
 import streamlit as st
 from dotenv import load_dotenv
 
+from app.telegram.cache import SQLiteCache
 from app.telegram.client import TDLibClient
+from app.telegram.graph import GroupGraph
+from app.telegram.history import ActivityStats, HistoryScanner, HistoryStore
+from app.telegram.jobs import AnalysisJob, JobManager
+from app.telegram.journal import RunJournal
+from app.telegram.live import LiveStats
+from app.telegram.membership import CoMembershipMatrix
+from app.telegram.metrics import (
+    COALESCED_REQUESTS,
+    DISCARDED_EVENTS,
+    FLOOD_WAIT_RETRIES,
+    LOCAL_RESPONSES,
+    request_summary,
+    start_http_server,
+)
+from app.telegram.pool import ClientPool
 from app.telegram.processor import ChatMemberService
+from app.telegram.results import CommonChatsResult
+from app.telegram.search import ChatIndex
+from app.telegram.snapshots import SnapshotStore
 
 load_dotenv()
 
+TDLIB_SESSIONS = int(os.getenv("TDLIB_SESSIONS", 1))
+METRICS_PORT = os.getenv("METRICS_PORT")
+ANALYSIS_WORKERS = int(os.getenv("ANALYSIS_WORKERS", JobManager.DEFAULT_WORKERS))
+
+TABLE_REFRESH_INTERVAL = 1.0
+TABLE_ROWS = 1000
+SEARCH_RESULTS = 500
+LIVE_REFRESH_INTERVAL = 2.0
+ACTIVITY_ROWS = 20
+GRAPH_EDGES = 200
+GRAPH_COLORS = 12
+WEEKDAYS = ("Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun")
+
 
 @st.cache_resource
 def init_services():
+    if METRICS_PORT:
+        start_http_server(int(METRICS_PORT))
     api_id = os.getenv("API_ID")
     api_hash = os.getenv("API_HASH")
-    tdlib_client = TDLibClient(api_id=api_id, api_hash=api_hash)
-    chat_member_service = ChatMemberService(tdlib_client)
+    if TDLIB_SESSIONS > 1:
+        database_directories = [TDLibClient.DATABASE_DIR] + [
+            f"{TDLibClient.DATABASE_DIR}_{index}" for index in range(1, TDLIB_SESSIONS)
+        ]
+        tdlib_client = ClientPool.create(api_id, api_hash, database_directories)
+    else:
+        tdlib_client = TDLibClient(api_id=api_id, api_hash=api_hash)
+    chat_member_service = ChatMemberService(tdlib_client, cache=SQLiteCache())
     return chat_member_service
 
 
+@st.cache_resource
+def init_job_manager():
+    return JobManager(
+        init_services(), max_workers=ANALYSIS_WORKERS, snapshot_store=SnapshotStore(), journal=RunJournal()
+    )
+
+
+@st.cache_resource
+def init_live_stats():
+    return LiveStats(init_services())
+
+
+@st.cache_resource
+def init_history_scanner():
+    return HistoryScanner(init_services(), HistoryStore())
+
+
+@st.cache_resource(max_entries=1)
+def build_group_graph(_matrix: CoMembershipMatrix, matrix_id: int) -> GroupGraph:
+    # The matrix is not hashable, its id tells a reloaded matrix apart
+    return GroupGraph.from_matrix(_matrix)
+
+
+def format_eta(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    return f"{minutes}:{seconds:02d}"
+
+
+def run_analysis(job_manager: JobManager, chat_id: int):
+    job = job_manager.submit(chat_id)
+    if job is None:
+        st.error("Failed to get stats.")
+        return
+    st.session_state.job_id = job.job_id
+
+
+@st.fragment(run_every=TABLE_REFRESH_INTERVAL)
+def render_job(job_manager: JobManager, job_id: int):
+    job = job_manager.get(job_id)
+    if job is None:
+        st.warning("The analysis is no longer available, run it again.")
+        return
+    if job.status == AnalysisJob.QUEUED:
+        st.progress(0.0, text="Waiting for other analyses to finish...")
+    elif job.status == AnalysisJob.RUNNING:
+        total = max(job.total, job.done, 1)
+        text = "Loading members..."
+        if job.resumed:
+            st.caption(f"Resumed an interrupted analysis after {job.resumed} members")
+        if job.done > job.resumed:
+            eta = (time.time() - job.started_at) / (job.done - job.resumed) * (total - job.done)
+            text = f"Analyzed {job.done} of {total} members, ETA {format_eta(eta)}"
+        st.progress(job.done / total, text=text)
+    elif job.status == AnalysisJob.FAILED:
+        st.error(f"Failed to get stats: {job.error}")
+        return
+    else:
+        st.success(f"Analyzed {job.done} members in {format_eta(job.finished_at - job.started_at)}")
+        if job.unlisted:
+            st.warning(
+                f"Telegram did not list {job.unlisted} members of this chat: only the first "
+                f"{ChatMemberService.MAX_MEMBERS_OFFSET} members of a supergroup and those found by name are listed."
+            )
+    render_stats(st.empty(), job.get_result())
+
+
+def render_snapshots(snapshot_store: SnapshotStore, chat_id: int):
+    snapshots = snapshot_store.list(chat_id)
+    if not snapshots:
+        return
+    with st.expander(f"Earlier analyses ({len(snapshots)})"):
+        if len(snapshots) > 1:
+            diff = snapshot_store.diff(snapshots[-2], snapshots[-1])
+            st.caption(
+                f"Since the previous analysis: {len(diff.joined)} joined, {len(diff.left)} left, "
+                f"{len(diff.changed)} changed their common group count"
+            )
+        trend = snapshot_store.trend(chat_id)
+        created_at = trend["created_at"].astype("datetime64[s]")
+        members, mean_count = st.columns(2)
+        members.caption("Members")
+        members.line_chart({"time": created_at, "members": trend["members"]}, x="time", y="members")
+        mean_count.caption("Average common groups")
+        mean_count.line_chart({"time": created_at, "mean_count": trend["mean_count"]}, x="time", y="mean_count")
+
+
+def render_jobs(job_manager: JobManager, chat_index: ChatIndex):
+    jobs = job_manager.jobs()
+    if not jobs:
+        return
+    active = sum(not job.finished for job in jobs)
+    with st.sidebar.expander(f"Analyses ({active} running)" if active else "Analyses"):
+        st.dataframe(
+            [
+                {"chat": format_chat(chat_index, job.chat_id), "status": job.status, "done": job.done}
+                for job in reversed(jobs)
+            ],
+            column_config={"chat": "Chat", "status": "Status", "done": "Members"},
+            hide_index=True,
+        )
+
+
+def watch_chat(live_stats: LiveStats, chat_id: int):
+    with st.spinner("Analyzing members..."):
+        watched = live_stats.watch(chat_id).result()
+    if not watched:
+        st.error("Failed to get stats.")
+        return
+    st.session_state.live_chat_id = chat_id
+
+
+@st.fragment(run_every=LIVE_REFRESH_INTERVAL)
+def render_live_stats(live_stats: LiveStats, chat_id: int):
+    stats = live_stats.get_stats(chat_id)
+    if stats is None:
+        return
+    st.caption(f"Live: {len(stats)} members, updated {live_stats.versions.get(chat_id, 0)} times")
+    render_stats(st.empty(), stats)
+
+
+def scan_history(history_scanner: HistoryScanner, chat_id: int):
+    progress_bar = st.progress(0.0, text="Reading messages...")
+
+    def on_progress(pages: int, counted: int):
+        # The length of the history is unknown until its beginning is reached
+        progress_bar.progress(pages % 100 / 100, text=f"Read {pages} pages, {counted} new messages")
+
+    stats = history_scanner.scan(chat_id, progress_callback=on_progress)
+    progress_bar.empty()
+    if stats is None:
+        st.error("Failed to get the message history.")
+        return
+    render_activity(history_scanner.service, stats)
+
+
+def render_activity(chat_member_service: ChatMemberService, stats: ActivityStats):
+    st.caption(f"{stats.total} messages from {len(stats.user_ids)} members")
+    st.dataframe(
+        [
+            {"name": chat_member_service.get_name_by_user_id(user_id), "messages": messages}
+            for user_id, messages in zip(
+                stats.user_ids[:ACTIVITY_ROWS].tolist(), stats.message_counts[:ACTIVITY_ROWS].tolist()
+            )
+        ],
+        column_config={"name": "Name", "messages": "Messages"},
+    )
+    hourly, weekly = st.columns(2)
+    hourly.caption("Messages per hour, UTC")
+    hourly.bar_chart(stats.hourly)
+    weekly.caption("Messages per weekday")
+    weekly.bar_chart({"weekday": WEEKDAYS, "messages": stats.weekly}, x="weekday", y="messages")
+
+
+def render_group_graph(matrix: CoMembershipMatrix, chat_index: ChatIndex):
+    graph = build_group_graph(matrix, id(matrix))
+    with st.expander(f"Group graph ({graph.community_count} communities)"):
+        edges = graph.edges(limit=GRAPH_EDGES)
+        if not edges:
+            st.caption("No groups share enough members.")
+            return
+        communities = dict(zip(graph.chat_ids.tolist(), graph.communities.tolist()))
+        chat_ids = sorted({chat_id for edge in edges for chat_id in (edge["source"], edge["target"])})
+        lines = ["graph {", "node [style=filled, shape=box];"]
+        for chat_id in chat_ids:
+            label = format_chat(chat_index, chat_id).replace("\\", "\\\\").replace('"', '\\"')
+            color = communities[chat_id] % GRAPH_COLORS + 1
+            lines.append(f'"{chat_id}" [label="{label}", fillcolor="/set312/{color}"];')
+        for edge in edges:
+            lines.append(f'"{edge["source"]}" -- "{edge["target"]}" [penwidth={1 + 4 * edge["similarity"]:.2f}];')
+        lines.append("}")
+        st.graphviz_chart("\n".join(lines))
+        if len(graph.sources) > GRAPH_EDGES:
+            st.caption(f"Strongest {GRAPH_EDGES} of {len(graph.sources)} links")
+
+
+def format_chat(chat_index: ChatIndex, chat_id: int) -> str:
+    chat = chat_index.get(chat_id)
+    return chat["name"] if chat is not None else str(chat_id)
+
+
+def render_startup_timings(timings: Dict[str, float]):
+    with st.sidebar.expander(f"Started in {timings.get('total', 0.0):.2f} s"):
+        for step, seconds in timings.items():
+            if step != "total":
+                st.text(f"{step}: {seconds:.2f} s")
+
+
+def render_diagnostics():
+    with st.sidebar.expander("Diagnostics"):
+        st.caption(
+            f"Answered locally: {LOCAL_RESPONSES.get():.0f}, "
+            f"shared with identical requests: {COALESCED_REQUESTS.get():.0f}, "
+            f"FLOOD_WAIT retries: {FLOOD_WAIT_RETRIES.get():.0f}, "
+            f"discarded events: {DISCARDED_EVENTS.get():.0f}"
+        )
+        st.dataframe(
+            request_summary(),
+            column_config={
+                "method": "Method",
+                "responses": "Responses",
+                "errors": "Errors",
+                "p50_ms": st.column_config.NumberColumn("p50, ms", format="%.1f"),
+                "p95_ms": st.column_config.NumberColumn("p95, ms", format="%.1f"),
+                "queue_ms": st.column_config.NumberColumn("Queued, ms", format="%.1f"),
+                "in_flight": "In flight",
+                "flood_wait_s": "FLOOD_WAIT, s",
+            },
+            hide_index=True,
+        )
+
+
+def load_co_membership(chat_member_service: ChatMemberService):
+    progress_bar = st.sidebar.progress(0.0, text="Loading group members...")
+
+    def on_progress(done: int, total: int, chat_id: int, error: Optional[str]):
+        progress_bar.progress(done / total, text=f"Loaded members of {done} of {total} groups")
+
+    matrix = chat_member_service.load_co_membership_matrix(progress_callback=on_progress)
+    progress_bar.empty()
+    st.sidebar.success(f"Indexed {matrix.shape[0]} members of {matrix.shape[1]} groups.")
+
+
+def render_stats(table, stats: CommonChatsResult):
+    top_stats = stats.top_k(TABLE_ROWS)
+    with table.container():
+        if len(stats) > TABLE_ROWS:
+            st.caption(f"Top {TABLE_ROWS} of {len(stats)} members")
+        st.dataframe(
+            top_stats.to_arrow(),
+            column_config={
+                "user_id": None,
+                "name": "Name",
+                "count": "Count",
+            },
+        )
+
+
 def main():
     st.title("Telegram Group Stats")
 
     chat_member_service = init_services()
+    render_startup_timings(chat_member_service.td_client.startup_timings)
+    render_diagnostics()
 
-    @st.cache_data
-    def load_chats():
-        return chat_member_service.get_chats()
+    if "chat_pages" not in st.session_state:
+        st.session_state.chat_pages = chat_member_service.iter_chat_pages()
+        st.session_state.chats = []
+        st.session_state.chats_loaded = False
 
-    chats = load_chats()
-    if chats is None or len(chats) == 0:
+    if not st.session_state.chats_loaded:
+        page = next(st.session_state.chat_pages, None)
+        if page is None:
+            st.session_state.chats_loaded = True
+        else:
+            st.session_state.chats.extend(page)
+
+    chats = st.session_state.chats
+    if not st.session_state.chats_loaded:
+        st.caption(f"Loaded {len(chats)} groups, loading more...")
+    elif len(chats) == 0:
         st.warning("No group chats found.")
         st.stop()
 
-    search_query = st.text_input("Search group by name:")
+    if st.session_state.chats_loaded and st.sidebar.button("Index all group members"):
+        load_co_membership(chat_member_service)
 
-    if search_query:
-        filtered_chats = [c for c in chats if search_query.lower() in c["name"].lower()]
-    else:
-        filtered_chats = chats
+    chat_index = chat_member_service.chat_index
+    if chat_member_service.co_membership is not None:
+        render_group_graph(chat_member_service.co_membership, chat_index)
+    search_query = st.text_input("Search group by name:")
+    chat_ids = chat_index.search(search_query, limit=SEARCH_RESULTS)
 
-    if not filtered_chats:
+    if not chat_ids:
+        if not st.session_state.chats_loaded:
+            st.rerun()
         st.warning("No groups match the search query.")
         st.stop()
 
-    selected_chat_name = st.selectbox("Select a group chat:", options=[chat["name"] for chat in filtered_chats])
-
-    selected_chat = next((c for c in filtered_chats if c["name"] == selected_chat_name), None)
-
-    if st.button("Run Analysis"):
-        with st.spinner("Analyzing..."):
-            stats = chat_member_service.get_users_common_chats_count_for_chat(selected_chat["id"])
-            if stats is None:
-                st.error("Failed to get stats.")
-                return
-            sorted_stats = sorted(stats, key=lambda x: x["count"], reverse=True)
-            st.success("Analysis completed!")
-            st.dataframe(
-                sorted_stats,
-                column_config={
-                    "name": "Name",
-                    "count": "Count",
-                },
-            )
+    # Options are chat IDs, so that groups with the same title stay distinct
+    selected_chat_id = st.selectbox(
+        "Select a group chat:", options=chat_ids, format_func=lambda chat_id: format_chat(chat_index, chat_id)
+    )
+    selected_chat = chat_index.get(selected_chat_id)
+
+    live_updates = st.sidebar.toggle("Live updates", help="Keep the stats current from membership updates")
+
+    job_manager = init_job_manager()
+    render_jobs(job_manager, chat_index)
+
+    run_clicked, activity_clicked = st.columns(2)
+    if activity_clicked.button("Message activity"):
+        scan_history(init_history_scanner(), selected_chat["id"])
+    if run_clicked.button("Run Analysis"):
+        if live_updates:
+            watch_chat(init_live_stats(), selected_chat["id"])
+        else:
+            run_analysis(job_manager, selected_chat["id"])
+    if live_updates and st.session_state.get("live_chat_id") == selected_chat["id"]:
+        render_live_stats(init_live_stats(), selected_chat["id"])
+    elif not live_updates and "job_id" in st.session_state:
+        render_job(job_manager, st.session_state.job_id)
+    render_snapshots(job_manager.snapshot_store, selected_chat["id"])
+
+    if not st.session_state.chats_loaded:
+        st.rerun()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,23 @@
+import os
+
+import pytest
+
+# Run the suite against the in-process fake Telegram instead of libtdjson.so
+os.environ.setdefault("TDLIB_BACKEND", "fake")
+
+
+@pytest.fixture
+def fake_telegram():
+    """
+    Installs a FakeTelegram as the tdjson backend for the duration of a test.
+    """
+    import app.telegram.functional as F
+    from app.telegram.fake import FakeTelegram
+
+    def install(**kwargs):
+        backend = FakeTelegram(**kwargs)
+        F.set_backend(backend)
+        return backend
+
+    yield install
+    F.set_backend(None)
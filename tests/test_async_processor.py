@@ -0,0 +1,188 @@
+import asyncio
+import threading
+
+from app.telegram.async_processor import AsyncChatMemberService
+from app.telegram.cache import SQLiteCache
+from app.telegram.membership import CoMembershipMatrix
+from app.telegram.processor import fingerprint_user_ids
+from app.telegram.results import CommonChatsRow
+from app.telegram.store import EntityStore
+
+SELF_USER_ID = 916542313
+USER_ID_2 = 642169077
+CHAT_ID_TEST = -1002401691915
+BASIC_GROUP_ID = -1002401691915
+
+
+class MockAsyncTDLibClient:
+    """
+    Answers every request immediately with a canned response.
+    """
+
+    def __init__(self, responses):
+        self.responses = responses
+        self.sent = []
+        self.store = EntityStore(self)
+
+    def add_update_handler(self, update_type, handler):
+        pass
+
+    def send_request(self, query):
+        self.sent.append(query)
+        future = asyncio.get_running_loop().create_future()
+        future.set_result(self.responses(query))
+        return future
+
+
+def respond(query):
+    if query["@type"] == "getMe":
+        return {"@type": "user", "id": SELF_USER_ID}
+    if query["@type"] == "getChat":
+        return {
+            "@type": "chat",
+            "id": query["chat_id"],
+            "title": "Test",
+            "type": {"@type": "chatTypeBasicGroup", "basic_group_id": BASIC_GROUP_ID},
+        }
+    if query["@type"] == "getBasicGroup":
+        return {"@type": "basicGroup", "id": BASIC_GROUP_ID, "member_count": 2}
+    if query["@type"] == "getBasicGroupFullInfo":
+        return {
+            "@type": "basicGroupFullInfo",
+            "members": [
+                {"member_id": {"@type": "messageSenderUser", "user_id": SELF_USER_ID}},
+                {"member_id": {"@type": "messageSenderUser", "user_id": USER_ID_2}},
+            ],
+        }
+    if query["@type"] == "getGroupsInCommon":
+        return {"@type": "chats", "chat_ids": [CHAT_ID_TEST]}
+    if query["@type"] == "getUser":
+        return {"@type": "user", "id": query["user_id"], "first_name": "Sofya", "last_name": "Salyaeva"}
+    return {"@type": "error", "code": 400, "message": "Unknown request"}
+
+
+def test_get_users_common_chats_count_for_chat():
+    async def run():
+        service = await AsyncChatMemberService.create(MockAsyncTDLibClient(respond))
+        return await service.get_users_common_chats_count_for_chat(CHAT_ID_TEST)
+
+    assert list(asyncio.run(run())) == [CommonChatsRow(USER_ID_2, "Sofya Salyaeva", 1)]
+
+
+def test_get_chat_id_by_username_error():
+    async def run():
+        service = AsyncChatMemberService(MockAsyncTDLibClient(respond))
+        return await service.get_chat_id_by_username("@unknown")
+
+    assert asyncio.run(run()) is None
+
+
+def test_get_chat_members_pages_supergroup():
+    def respond_supergroup(query):
+        if query["@type"] == "getChat":
+            return {
+                "@type": "chat",
+                "id": query["chat_id"],
+                "type": {"@type": "chatTypeSupergroup", "supergroup_id": 1},
+            }
+        if query["@type"] == "getSupergroupMembers":
+            user_ids = range(query["offset"], min(query["offset"] + query["limit"], 3))
+            members = [{"member_id": {"@type": "messageSenderUser", "user_id": user_id}} for user_id in user_ids]
+            return {"@type": "chatMembers", "total_count": 3, "members": members}
+        return respond(query)
+
+    client = MockAsyncTDLibClient(respond_supergroup)
+
+    async def run():
+        service = AsyncChatMemberService(client)
+        member_pages = await service.iter_chat_members(CHAT_ID_TEST, page_size=2)
+        return [[member["member_id"]["user_id"] for member in page] async for page in member_pages]
+
+    assert asyncio.run(run()) == [[0, 1], [2]]
+    assert [query["offset"] for query in client.sent if query["@type"] == "getSupergroupMembers"] == [0, 2]
+
+
+def test_cache_is_used_off_the_event_loop():
+    class ThreadRecordingCache(SQLiteCache):
+        def get_response(self, request_data):
+            threads.append(threading.current_thread())
+            return super().get_response(request_data)
+
+    threads = []
+    client = MockAsyncTDLibClient(respond)
+
+    async def run():
+        service = AsyncChatMemberService(client, my_user_id=SELF_USER_ID, cache=ThreadRecordingCache(":memory:"))
+        return [await service.get_name_by_user_id(USER_ID_2) for _ in range(2)]
+
+    assert asyncio.run(run()) == ["Sofya Salyaeva"] * 2
+    assert [query["@type"] for query in client.sent] == ["getUser"]
+    assert threads and threading.main_thread() not in threads
+
+
+def test_co_membership_and_skipped_members():
+    client = MockAsyncTDLibClient(respond)
+    other_chat_id = CHAT_ID_TEST - 1
+
+    async def run():
+        service = AsyncChatMemberService(client, my_user_id=SELF_USER_ID)
+        service.co_membership = CoMembershipMatrix.from_member_lists(
+            {CHAT_ID_TEST: [USER_ID_2, 7, 8], other_chat_id: [USER_ID_2, 8]}
+        )
+        rows = await service.get_users_common_chats_count_for_chat(CHAT_ID_TEST, skip_user_ids={7})
+        skipped = await service.get_users_common_chats_count_for_chat(other_chat_id - 1, skip_user_ids={USER_ID_2})
+        return rows, skipped
+
+    rows, skipped = asyncio.run(run())
+    assert sorted(row.user_id for row in rows) == [8, USER_ID_2]
+    assert {row.user_id: row.count for row in rows} == {8: 2, USER_ID_2: 2}
+    # The chat outside the matrix is looked up, and its only other member is skipped
+    assert len(skipped) == 0
+    assert [query["@type"] for query in client.sent].count("getGroupsInCommon") == 0
+
+
+def test_iter_chat_members_searches_past_the_listing_limit(monkeypatch):
+    names = {1: "alice", 2: "bob", 3: "anna", 4: "boris", 5: "ben", 6: "carl", 7: "_ghost"}
+
+    def respond_supergroup(query):
+        if query["@type"] == "getChat":
+            return {
+                "@type": "chat",
+                "id": query["chat_id"],
+                "type": {"@type": "chatTypeSupergroup", "supergroup_id": 1},
+            }
+        if query["@type"] == "getSupergroupMembers":
+            prefix = query["filter"].get("query", "")
+            user_ids = [user_id for user_id, name in names.items() if name.startswith(prefix)]
+            # Like Telegram, list no member past the limit
+            page = user_ids[query["offset"] : min(query["offset"] + query["limit"], 3)]
+            members = [{"member_id": {"@type": "messageSenderUser", "user_id": user_id}} for user_id in page]
+            return {"@type": "chatMembers", "total_count": len(user_ids), "members": members}
+        return respond(query)
+
+    monkeypatch.setattr(AsyncChatMemberService, "MAX_MEMBERS_OFFSET", 3)
+    monkeypatch.setattr(AsyncChatMemberService, "MEMBER_SEARCH_QUERIES", ("a", "b", "c"))
+    client = MockAsyncTDLibClient(respond_supergroup)
+
+    async def run():
+        service = AsyncChatMemberService(client)
+        member_pages = await service.iter_chat_members(CHAT_ID_TEST, page_size=2)
+        user_ids = [member["member_id"]["user_id"] async for page in member_pages for member in page]
+        return user_ids, service.unlisted_member_counts
+
+    user_ids, unlisted_member_counts = asyncio.run(run())
+    assert sorted(user_ids) == [1, 2, 3, 4, 5, 6]
+    queries = [query["filter"].get("query") for query in client.sent if query["@type"] == "getSupergroupMembers"]
+    assert queries == [None, None, "a", "b", "b", "c"]
+    assert unlisted_member_counts == {CHAT_ID_TEST: 1}
+
+
+def test_members_fingerprint_matches_the_sync_service():
+    async def run():
+        service = AsyncChatMemberService(MockAsyncTDLibClient(respond), my_user_id=SELF_USER_ID)
+        fingerprint = await service.get_members_fingerprint(CHAT_ID_TEST)
+        service.co_membership = CoMembershipMatrix.from_member_lists({CHAT_ID_TEST: [USER_ID_2, SELF_USER_ID]})
+        return fingerprint, await service.get_members_fingerprint(CHAT_ID_TEST)
+
+    fingerprint, matrix_fingerprint = asyncio.run(run())
+    assert fingerprint == matrix_fingerprint == fingerprint_user_ids([SELF_USER_ID, USER_ID_2])
@@ -0,0 +1,69 @@
+from app.telegram.cache import SQLiteCache
+
+
+def test_get_response_returns_stored_response():
+    cache = SQLiteCache(":memory:")
+    request = {"@type": "getUser", "user_id": 1}
+    assert cache.get_response(request) is None
+
+    cache.store_response(request, {"@type": "user", "id": 1, "first_name": "Max", "@extra": "7", "@client_id": 1})
+    assert cache.get_response(request) == {"@type": "user", "id": 1, "first_name": "Max"}
+    assert cache.get_response({"@type": "getUser", "user_id": 2}) is None
+
+
+def test_errors_and_uncacheable_requests_are_not_stored():
+    cache = SQLiteCache(":memory:")
+    cache.store_response({"@type": "getUser", "user_id": 1}, {"@type": "error", "code": 400, "message": "Not found"})
+    cache.store_response({"@type": "getMe"}, {"@type": "user", "id": 1})
+    assert len(cache) == 0
+
+
+def test_expired_entries_are_dropped():
+    cache = SQLiteCache(":memory:", ttls={"common_groups": 0.01})
+    cache.set("common_groups", 1, {"@type": "chats", "chat_ids": [1]})
+    cache._connection.execute("UPDATE entries SET expires_at = 0")
+    assert cache.get("common_groups", 1) is None
+    assert len(cache) == 0
+
+
+def test_least_recently_used_entries_are_evicted():
+    cache = SQLiteCache(":memory:", max_entries=2)
+    cache.EVICTION_INTERVAL = 1
+    cache.set("user", 1, {"id": 1})
+    cache.set("user", 2, {"id": 2})
+    cache._connection.execute("UPDATE entries SET accessed_at = 0 WHERE key = '1'")
+    cache.set("user", 3, {"id": 3})
+    assert cache.get("user", 1) is None
+    assert cache.get("user", 2) == {"id": 2}
+    assert cache.get("user", 3) == {"id": 3}
+
+
+def test_common_groups_are_cached_per_page():
+    cache = SQLiteCache(":memory:")
+    request = {"@type": "getGroupsInCommon", "user_id": 1, "offset_chat_id": 0, "limit": 100}
+    cache.store_response(request, {"@type": "chats", "chat_ids": [5]})
+    assert cache.get_response(dict(request))["chat_ids"] == [5]
+    assert cache.get_response({**request, "offset_chat_id": 5}) is None
+    assert cache.get_response({**request, "limit": 1}) is None
+
+
+def test_access_times_are_written_in_batches():
+    cache = SQLiteCache(":memory:", max_entries=2)
+    cache.ACCESS_FLUSH_SIZE = 2
+    cache.set("user", 1, {"id": 1})
+    cache.set("user", 2, {"id": 2})
+    cache._connection.execute("UPDATE entries SET accessed_at = 0")
+    assert cache.get("user", 1) == {"id": 1}
+    assert cache._connection.execute("SELECT MAX(accessed_at) FROM entries").fetchone()[0] == 0
+    assert cache.get("user", 1) == {"id": 1}
+    cache.flush()
+    assert cache._connection.execute("SELECT key FROM entries WHERE accessed_at > 0").fetchall() == [("1",)]
+
+    # A buffered hit still counts for eviction
+    cache.ACCESS_FLUSH_SIZE = 1000
+    cache.EVICTION_INTERVAL = 1
+    cache._connection.execute("UPDATE entries SET accessed_at = 0")
+    assert cache.get("user", 1) == {"id": 1}
+    cache.set("user", 3, {"id": 3})
+    assert cache.get("user", 2) is None
+    assert cache.get("user", 1) == {"id": 1}
@@ -1,7 +1,13 @@
 import json
+import queue
+import threading
+import time
 from unittest.mock import patch
 
-from app.telegram.client import TDLibClient
+import pytest
+
+from app.telegram.client import TDLibClient, _receive_loop, _ReceiveLoop
+from app.telegram.metrics import DISCARDED_EVENTS
 
 
 def test_execute_returns_json():
@@ -9,3 +15,196 @@ def test_execute_returns_json():
         mock_execute.return_value = json.dumps({"@type": "someType"}).encode("utf-8")
         result = TDLibClient.execute({"@type": "testQuery"})
         assert result["@type"] == "someType"
+
+
+class ImmediateScheduler:
+    """
+    Sends queries synchronously and records flood waits.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.flood_waits = []
+
+    def submit(self, query):
+        self.client.send(query)
+
+    def on_flood_wait(self, method, wait_time):
+        self.flood_waits.append((method, wait_time))
+
+    def on_success(self, method):
+        pass
+
+    def stop(self):
+        pass
+
+
+def make_client():
+    client = TDLibClient.__new__(TDLibClient)
+    client._client_id = 1
+    client._request_ids = iter(range(1, 10))
+    client._pending = {}
+    client._pending_lock = threading.Lock()
+    client._coalesced = {}
+    client._closed = False
+    client.scheduler = ImmediateScheduler(client)
+    client._update_handlers = {}
+    client._update_markers = {}
+    client._auth_states = queue.Queue()
+    return client
+
+
+def test_send_request_resolves_future_by_extra():
+    client = make_client()
+    with patch("app.telegram.functional.send") as mock_send:
+        first = client.send_request({"@type": "getUser", "user_id": 1})
+        second = client.send_request({"@type": "getUser", "user_id": 2})
+        sent = json.loads(mock_send.call_args.args[1].decode("utf-8"))
+    assert sent == {"@type": "getUser", "user_id": 2, "@extra": "2"}
+
+    client._dispatch({"@type": "user", "id": 2, "@extra": "2"})
+    client._dispatch({"@type": "user", "id": 1, "@extra": "1"})
+    assert first.result(timeout=1)["id"] == 1
+    assert second.result(timeout=1)["id"] == 2
+
+
+def test_identical_requests_in_flight_are_coalesced():
+    client = make_client()
+    with patch("app.telegram.functional.send") as mock_send:
+        futures = [client.send_request({"@type": "getUser", "user_id": 1}) for _ in range(3)]
+        other = client.send_request({"@type": "getUser", "user_id": 2})
+        assert mock_send.call_count == 2
+
+        # A caller giving up does not cancel the shared request
+        futures[0].cancel()
+        client._dispatch({"@type": "user", "id": 1, "usernames": {"active_usernames": ["one"]}, "@extra": "1"})
+        assert [future.result(timeout=1)["id"] for future in futures[1:]] == [1, 1]
+        # Every caller may modify its response, nested objects included
+        futures[1].result()["usernames"]["active_usernames"].append("changed")
+        assert futures[2].result()["usernames"] == {"active_usernames": ["one"]}
+        assert not other.done()
+
+        # Once answered, the same request is sent again
+        client.send_request({"@type": "getUser", "user_id": 1})
+        assert mock_send.call_count == 3
+
+
+def test_close_fails_pending_requests():
+    client = make_client()
+    with patch("app.telegram.functional.send"):
+        futures = [client.send_request({"@type": "getUser", "user_id": 1}) for _ in range(2)]
+        other = client.send_request({"@type": "getChats", "limit": 1})
+        client.close()
+        late = client.send_request({"@type": "getUser", "user_id": 2})
+    for future in futures + [other, late]:
+        with pytest.raises(ConnectionError):
+            future.result(timeout=1)
+    assert client._pending == {} and client._coalesced == {}
+
+
+def test_dispatch_routes_updates_to_handlers():
+    client = make_client()
+    received = []
+    client.add_update_handler("updateUser", received.append)
+    client._dispatch({"@type": "updateUser", "user": {"id": 1}})
+    client._dispatch({"@type": "updateNewChat", "chat": {"id": 2}})
+    assert received == [{"@type": "updateUser", "user": {"id": 1}}]
+
+
+def test_flood_wait_response_is_retried():
+    client = make_client()
+    with patch("app.telegram.functional.send") as mock_send:
+        future = client.send_request({"@type": "getGroupsInCommon", "user_id": 1})
+        client._dispatch({"@type": "error", "code": 420, "message": "FLOOD_WAIT_3", "@extra": "1"})
+        assert not future.done()
+        assert mock_send.call_count == 2
+    assert client.scheduler.flood_waits == [("getGroupsInCommon", 3)]
+
+    client._dispatch({"@type": "chats", "chat_ids": [], "@extra": "1"})
+    assert future.result(timeout=1)["@type"] == "chats"
+
+
+def test_receive_loop_skips_unhandled_updates():
+    client = make_client()
+    client.add_update_handler("updateUser", lambda event: None)
+    receive_loop = _ReceiveLoop()
+    receive_loop._clients[1] = client
+
+    assert receive_loop._is_wanted(b'{"@type":"updateUser","user":{},"@client_id":1}')
+    assert receive_loop._is_wanted(b'{"@type":"updateAuthorizationState","@client_id":1}')
+    assert receive_loop._is_wanted(b'{"@type":"ok","@extra":"3","@client_id":1}')
+    assert not receive_loop._is_wanted(b'{"@type":"updateNewMessage","message":{},"@client_id":1}')
+
+    # Only the messages containing a marker are decoded for a handler with markers
+    def handler(event):
+        pass
+
+    client.add_update_handler("updateNewMessage", handler, markers=["messageChatAddMembers"])
+    service_message = b'{"@type":"updateNewMessage","message":{"content":{"@type":"messageChatAddMembers"}}}'
+    assert receive_loop._is_wanted(service_message)
+    assert not receive_loop._is_wanted(b'{"@type":"updateNewMessage","message":{"content":{"@type":"messageText"}}}')
+    client.remove_update_handler("updateNewMessage", handler)
+    assert not receive_loop._is_wanted(service_message)
+
+
+def test_receive_loop_survives_invalid_events():
+    class Stop(BaseException):
+        pass
+
+    client = make_client()
+    received = []
+    client.add_update_handler("updateUser", received.append)
+    receive_loop = _ReceiveLoop()
+    receive_loop._clients[1] = client
+    events = iter([b'{"@type":"updateUser","user":{', b'{"@type":"updateUser","user":{},"@client_id":1}'])
+
+    def mock_receive(timeout):
+        # The process-wide receiver thread may be running too, it must not take the events
+        if threading.current_thread() is not test_thread:
+            time.sleep(timeout)
+            return None
+        try:
+            return next(events)
+        except StopIteration:
+            raise Stop
+
+    test_thread = threading.current_thread()
+    invalid_before = DISCARDED_EVENTS.get(reason="invalid")
+    with patch("app.telegram.functional.receive", mock_receive):
+        with pytest.raises(Stop):
+            receive_loop._run()
+    assert DISCARDED_EVENTS.get(reason="invalid") == invalid_before + 1
+    assert received == [{"@type": "updateUser", "user": {}, "@client_id": 1}]
+
+
+def test_warm_start_finishes_on_ready():
+    sent = []
+
+    def mock_send(client_id, data):
+        query = json.loads(data)
+        sent.append(query)
+        states = {
+            "getAuthorizationState": "authorizationStateWaitTdlibParameters",
+            "setTdlibParameters": "authorizationStateReady",
+        }
+        if query["@type"] in states:
+            state = {"@type": states[query["@type"]]}
+            _receive_loop._clients[client_id]._dispatch(
+                {"@type": "updateAuthorizationState", "authorization_state": state}
+            )
+
+    with (
+        patch("app.telegram.functional.send", side_effect=mock_send),
+        patch("app.telegram.functional.create_client_id", return_value=99),
+        patch("app.telegram.functional.execute", return_value=None),
+    ):
+        started_at = time.monotonic()
+        client = TDLibClient("1", "hash", database_directory="warm", warm_start=True)
+        elapsed = time.monotonic() - started_at
+        client.close()
+
+    assert elapsed < TDLibClient.AUTHORIZE_LOOP_TIMEOUT
+    parameters = next(query for query in sent if query["@type"] == "setTdlibParameters")
+    assert parameters["database_directory"] == "warm"
+    assert parameters["use_message_database"] and parameters["use_chat_info_database"]
+    assert {"create_client_id", "authorizationStateReady", "total"} <= set(client.startup_timings)
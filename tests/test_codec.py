@@ -0,0 +1,23 @@
+import pytest
+
+from app.telegram.codec import CODECS, JsonCodec, get_codec, is_response, peek_type
+
+
+@pytest.mark.parametrize("name", list(CODECS))
+def test_codec_round_trip(name):
+    codec = get_codec(name)
+    query = {"@type": "sendMessage", "text": "Привет", "chat_id": -1001234567890, "@extra": "1"}
+    assert codec.loads(codec.dumps(query)) == query
+
+
+def test_unknown_codec_falls_back_to_json():
+    assert isinstance(get_codec("yaml"), JsonCodec)
+
+
+def test_peek_type_and_is_response():
+    update = b'{"@type":"updateNewMessage","message":{"@type":"message"},"@client_id":1}'
+    response = b'{"@type":"user","id":1,"@extra":"7","@client_id":1}'
+    assert peek_type(update) == "updateNewMessage"
+    assert peek_type(b'{"id":1,"@type":"user"}') is None
+    assert not is_response(update)
+    assert is_response(response)
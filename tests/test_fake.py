@@ -0,0 +1,77 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from app.telegram.client import TDLibClient
+from app.telegram.metrics import COALESCED_REQUESTS, FLOOD_WAIT_SECONDS, REQUESTS
+from app.telegram.processor import ChatMemberService
+
+
+def test_analysis_against_fake_telegram(fake_telegram):
+    fake = fake_telegram(group_sizes=(5, 40, 450), latency=0.001)
+    service = ChatMemberService(TDLibClient("1", "hash", warm_start=False))
+
+    chats = service.get_chats()
+    assert [chat["name"] for chat in chats] == ["Group 0", "Group 1", "Group 2"]
+    fake.rename_chat(fake.groups[1].chat_id, "Renamed")
+    deadline = time.monotonic() + 5
+    while service.chat_index.search("renamed") != [fake.groups[1].chat_id]:
+        assert time.monotonic() < deadline, "the chat index missed the new title"
+        time.sleep(0.01)
+
+    supergroup = fake.groups[2]
+    responses_before = REQUESTS.get(method="getGroupsInCommon", result="ok")
+    rows = service.get_users_common_chats_count_for_chat(supergroup.chat_id)
+    assert len(rows) == 449
+    assert REQUESTS.get(method="getGroupsInCommon", result="ok") - responses_before == 449
+    expected = sorted(fake.get_common_chats_count(user_id) for user_id in supergroup.members[1:])
+    assert sorted(rows.counts.tolist()) == expected
+    service.td_client.close()
+
+
+def test_flood_wait_is_retried(fake_telegram):
+    fake = fake_telegram(group_sizes=(25,), flood_limits={"getGroupsInCommon": 20}, flood_wait=1)
+    service = ChatMemberService(TDLibClient("1", "hash", warm_start=False))
+    service.get_chats()
+
+    rows = service.get_users_common_chats_count_for_chat(fake.groups[0].chat_id)
+    assert len(rows) == 24
+    assert (rows.counts == 1).all()
+    assert fake.flood_errors > 0
+    assert FLOOD_WAIT_SECONDS.get(method="getGroupsInCommon") > 0
+    service.td_client.close()
+
+
+def test_concurrent_analyses_share_lookups(fake_telegram):
+    fake = fake_telegram(group_sizes=(60, 5), latency=0.01)
+    service = ChatMemberService(TDLibClient("1", "hash", warm_start=False))
+    service.get_chats()
+    chat_id = fake.groups[0].chat_id
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        first, second = executor.map(lambda _: service.get_users_common_chats_count_for_chat(chat_id), range(2))
+
+    assert sorted(first.counts.tolist()) == sorted(second.counts.tolist())
+    assert sorted(first.user_ids.tolist()) == sorted(fake.groups[0].members[1:])
+    assert COALESCED_REQUESTS.get(method="getGroupsInCommon") > 0
+    service.td_client.close()
+
+
+def test_members_past_the_listing_limit_are_searched(fake_telegram):
+    fake = fake_telegram(group_sizes=(12000,))
+    service = ChatMemberService(TDLibClient("1", "hash", warm_start=False))
+    service.get_chats()
+    group = fake.groups[0]
+
+    requests_before = fake.requests
+    members = service.get_chat_members(group.chat_id)
+    assert sorted(members.user_ids.tolist()) == sorted(group.members)
+    assert group.chat_id not in service.unlisted_member_counts
+    # 50 pages of recent members, then 12000 / 26 members found by every letter, in 3 pages
+    assert fake.requests - requests_before <= 50 + 3 * 26 + 2
+
+    # Without search requests left, the rest is reported as unlisted
+    service.MAX_MEMBER_SEARCH_REQUESTS = 0
+    members = service.get_chat_members(group.chat_id)
+    assert len(members) == ChatMemberService.MAX_MEMBERS_OFFSET
+    assert service.unlisted_member_counts[group.chat_id] == 2000
+    service.td_client.close()
@@ -0,0 +1,47 @@
+import itertools
+
+import numpy as np
+
+from app.telegram.graph import GroupGraph
+from app.telegram.membership import CoMembershipMatrix
+
+
+def test_overlaps_match_pairwise_intersections():
+    rng = np.random.default_rng(0)
+    members = {chat_id: rng.choice(60, size=rng.integers(1, 20), replace=False).tolist() for chat_id in range(40)}
+    graph = GroupGraph.from_matrix(CoMembershipMatrix.from_member_lists(members), min_similarity=0, max_neighbors=None)
+
+    edges = {(edge["source"], edge["target"]): edge for edge in graph.edges()}
+    expected = {
+        (first, second): len(set(members[first]) & set(members[second]))
+        for first, second in itertools.combinations(members, 2)
+    }
+    assert {pair: edge["overlap"] for pair, edge in edges.items()} == {
+        pair: overlap for pair, overlap in expected.items() if overlap
+    }
+    for (first, second), edge in edges.items():
+        union = len(set(members[first]) | set(members[second]))
+        assert edge["similarity"] == edge["overlap"] / union
+    assert [edge["similarity"] for edge in edges.values()] == sorted(graph.similarities.tolist(), reverse=True)
+
+
+def test_communities_and_pruning():
+    # Two cliques of four groups with nearly identical members, joined by one weak edge
+    members = {chat_id: list(range(100)) + [1000 + chat_id] for chat_id in range(4)}
+    members.update({chat_id: list(range(200, 300)) + [1000 + chat_id] for chat_id in range(4, 8)})
+    members[0].extend(range(200, 210))
+    graph = GroupGraph.from_matrix(CoMembershipMatrix.from_member_lists(members), max_neighbors=2)
+
+    assert graph.community_count == 2
+    assert sorted(graph.get_community(1).tolist()) == [0, 1, 2, 3]
+    assert sorted(graph.get_community(5).tolist()) == [4, 5, 6, 7]
+    assert graph.get_community(100) is None
+    # Every group keeps its two strongest edges, the weak edges between the cliques are dropped
+    assert len(graph.sources) < 12
+    assert all((edge["source"] < 4) == (edge["target"] < 4) for edge in graph.edges())
+
+
+def test_empty_graph():
+    graph = GroupGraph.from_matrix(CoMembershipMatrix.from_member_lists({1: [5], 2: [6]}))
+    assert graph.edges() == []
+    assert graph.community_count == 2
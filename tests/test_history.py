@@ -0,0 +1,96 @@
+from collections import Counter
+
+from app.telegram.client import TDLibClient
+from app.telegram.history import HistoryScanner, HistoryStore, aggregate
+from app.telegram.processor import ChatMemberService
+
+
+def expected_counts(group):
+    return Counter(message["sender_id"]["user_id"] for message in group.messages)
+
+
+def activity(stats):
+    return dict(zip(stats.user_ids.tolist(), stats.message_counts.tolist()))
+
+
+def test_scan_counts_history_and_rescans_only_new_messages(fake_telegram, tmp_path):
+    fake = fake_telegram(group_sizes=(10,), messages_per_group=450)
+    service = ChatMemberService(TDLibClient("1", "hash", warm_start=False))
+    service.get_chats()
+    group = fake.groups[0]
+    scanner = HistoryScanner(service, HistoryStore(str(tmp_path / "history.sqlite3")))
+
+    requests_before = fake.requests
+    stats = scanner.scan(group.chat_id)
+    # Five pages of messages and the empty page marking the beginning of the history
+    assert fake.requests - requests_before == 6
+    assert stats.complete
+    assert stats.total == 450
+    assert activity(stats) == expected_counts(group)
+    assert stats.message_counts.tolist() == sorted(stats.message_counts.tolist(), reverse=True)
+
+    for user_id in group.members[:3]:
+        fake.post_message(group.chat_id, user_id)
+    requests_before = fake.requests
+    stats = scanner.scan(group.chat_id)
+    assert fake.requests - requests_before == 1
+    assert stats.total == 453
+    assert activity(stats) == expected_counts(group)
+
+    # Aggregates outlive the scanner
+    stats = HistoryScanner(service, HistoryStore(str(tmp_path / "history.sqlite3"))).scan(group.chat_id)
+    assert stats.total == 453
+    service.td_client.close()
+
+
+def test_interrupted_scan_resumes_without_counting_twice(fake_telegram):
+    fake = fake_telegram(group_sizes=(10,), messages_per_group=450)
+    service = ChatMemberService(TDLibClient("1", "hash", warm_start=False))
+    service.get_chats()
+    group = fake.groups[0]
+    store = HistoryStore(":memory:")
+    scanner = HistoryScanner(service, store)
+
+    progress = []
+    stats = scanner.scan(group.chat_id, progress_callback=lambda *args: progress.append(args), max_pages=2)
+    # Pages start at the oldest message of the previous page, which is not counted again
+    assert progress == [(1, 100), (2, 199)]
+    assert not stats.complete
+    assert stats.total == 199
+
+    # New messages arrive before the scan resumes: they are counted, and so is the rest of the history
+    fake.post_message(group.chat_id, group.members[1])
+    requests_before = fake.requests
+    stats = scanner.scan(group.chat_id)
+    assert stats.complete
+    assert stats.total == 451
+    assert activity(stats) == expected_counts(group)
+    # The page with the new message, the three remaining pages and the empty one
+    assert fake.requests - requests_before == 5
+    assert store.get_ranges(group.chat_id) == [(0, group.messages[-1]["id"])]
+    service.td_client.close()
+
+
+def test_aggregate_skips_service_messages():
+    def message(content_type, date, sender_type="messageSenderUser"):
+        return {
+            "id": 1,
+            "sender_id": {"@type": sender_type, "user_id": 7, "chat_id": -1},
+            "date": date,
+            "content": {"@type": content_type},
+        }
+
+    # Monday 5 January 1970, 10:30 UTC
+    monday = 4 * 86400 + 10 * 3600 + 1800
+    user_activity, histogram = aggregate(
+        [
+            message("messageText", monday),
+            message("messagePhoto", monday + 86400),
+            message("messageChatAddMembers", monday),
+            message("messageText", monday, sender_type="messageSenderChat"),
+        ]
+    )
+    assert user_activity == {7: (2, monday + 86400)}
+    assert histogram.sum() == 2
+    assert histogram[0, 10] == 1
+    assert histogram[1, 10] == 1
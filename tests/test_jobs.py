@@ -0,0 +1,77 @@
+import time
+
+from app.telegram.client import TDLibClient
+from app.telegram.jobs import AnalysisJob, JobManager
+from app.telegram.processor import ChatMemberService
+
+
+def test_jobs_are_shared_until_members_change(fake_telegram):
+    fake = fake_telegram(group_sizes=(30,), latency=0.001)
+    service = ChatMemberService(TDLibClient("1", "hash", warm_start=False))
+    service.get_chats()
+    chat_id = fake.groups[0].chat_id
+    manager = JobManager(service, max_workers=2)
+
+    job = manager.submit(chat_id)
+    assert manager.submit(chat_id) is job
+    result = job.wait(timeout=10)
+    assert job.status == AnalysisJob.DONE
+    assert len(result) == 29
+    assert job.done == job.total == 29
+
+    # A finished job is reused without analyzing the chat again
+    lookups = fake.requests
+    assert manager.submit(chat_id) is job
+    assert fake.requests - lookups <= 1
+
+    # A new member changes the fingerprint and starts a new job
+    fake.add_member(chat_id, 1000)
+    new_job = manager.submit(chat_id)
+    assert new_job is not job
+    assert len(new_job.wait(timeout=10)) == 30
+    assert [job.job_id for job in manager.jobs()] == [job.job_id, new_job.job_id]
+
+    manager.close()
+    service.td_client.close()
+
+
+def test_finished_jobs_are_evicted(fake_telegram):
+    fake = fake_telegram(group_sizes=(5, 6, 7))
+    service = ChatMemberService(TDLibClient("1", "hash", warm_start=False))
+    service.get_chats()
+    manager = JobManager(service, max_workers=1, max_results=2)
+
+    jobs = [manager.submit(group.chat_id) for group in fake.groups]
+    for job in jobs:
+        job.wait(timeout=10)
+    manager.submit(fake.groups[0].chat_id).wait(timeout=10)
+
+    assert [job.chat_id for job in manager.jobs()] == [fake.groups[2].chat_id, fake.groups[0].chat_id]
+    assert manager.get(jobs[0].job_id) is None
+    manager.close()
+    service.td_client.close()
+
+
+def test_member_count_fingerprinted_jobs_expire(fake_telegram, monkeypatch):
+    fake = fake_telegram(group_sizes=(250,))
+    service = ChatMemberService(TDLibClient("1", "hash", warm_start=False))
+    service.get_chats()
+    chat_id = fake.groups[0].chat_id
+    manager = JobManager(service)
+
+    job = manager.submit(chat_id)
+    job.wait(timeout=10)
+    # A member replaced by another leaves the member count unchanged
+    fake.remove_member(chat_id, fake.groups[0].members[-1])
+    fake.add_member(chat_id, 1000)
+    assert manager.submit(chat_id) is job
+
+    monkeypatch.setattr(ChatMemberService, "MEMBER_COUNT_FINGERPRINT_MAX_AGE", 0)
+    time.sleep(0.01)
+    new_job = manager.submit(chat_id)
+    assert new_job is not job and new_job.fingerprint == job.fingerprint
+    assert 1000 in {row.user_id for row in new_job.wait(timeout=10)}
+    assert manager.get(job.job_id) is None
+
+    manager.close()
+    service.td_client.close()
@@ -0,0 +1,137 @@
+import itertools
+import time
+
+from app.telegram.client import TDLibClient
+from app.telegram.jobs import AnalysisJob, JobManager
+from app.telegram.journal import RunJournal
+from app.telegram.processor import ChatMemberService
+from app.telegram.results import CommonChatsRow
+
+
+def test_unfinished_run_is_recovered(tmp_path):
+    journal = RunJournal(str(tmp_path))
+    run = journal.open(-5)
+    run.append(CommonChatsRow(7, "Ёжик", 3))
+    run.append(CommonChatsRow(8, None, 1))
+    run.close()
+    # A crash in the middle of a write leaves an incomplete last line
+    with open(run.path, "ab") as file:
+        file.write(b'{"user_id": 9, "na')
+
+    resumed = journal.open(-5)
+    assert resumed.run_id == run.run_id
+    assert list(resumed.rows) == [CommonChatsRow(7, "Ёжик", 3), CommonChatsRow(8, None, 1)]
+    assert resumed.user_ids == {7, 8}
+    # A run that is open is not resumed twice
+    other = journal.open(-5)
+    assert other.run_id != run.run_id and other.resumed == 0
+
+    resumed.append(CommonChatsRow(9, "User9", 2))
+    resumed.close()
+    assert [row.user_id for row in journal.open(-5).rows] == [7, 8, 9]
+
+    other.finish()
+    assert journal.unfinished_runs(-5) == [run.run_id]
+    journal.discard(-5)
+    assert journal.unfinished_runs(-5) == [run.run_id]  # still open
+    assert journal.unfinished_runs(-6) == []
+
+
+def test_stale_runs_are_discarded(tmp_path):
+    journal = RunJournal(str(tmp_path), max_age=60)
+    run = journal.open(-5, "members:a")
+    run.append(CommonChatsRow(7, "User7", 3))
+    run.close()
+
+    # Members joined or left since: the run is not resumed, and its journal is deleted
+    other = journal.open(-5, "members:b")
+    assert other.resumed == 0
+    assert journal.unfinished_runs(-5) == [other.run_id]
+    other.append(CommonChatsRow(8, "User8", 1))
+    other.close()
+    resumed = journal.open(-5, "members:b")
+    assert resumed.user_ids == {8}
+    resumed.close()
+
+    # A run older than max_age is not resumed either
+    journal.max_age = 0
+    time.sleep(0.01)
+    assert journal.open(-5, "members:b").resumed == 0
+    assert len(journal.unfinished_runs(-5)) == 1
+
+
+def test_count_fingerprinted_runs_expire_when_idle(tmp_path):
+    journal = RunJournal(str(tmp_path))
+    run = journal.open(-5, "count:2")
+    run.append(CommonChatsRow(7, "User7", 3))
+    run.close()
+    resumed = journal.open(-5, "count:2", idle_max_age=60)
+    assert resumed.user_ids == {7}
+    resumed.close()
+
+    # The member count may hide a member replaced by another since the run was last written
+    time.sleep(0.01)
+    assert journal.open(-5, "count:2", idle_max_age=0).resumed == 0
+    assert len(journal.unfinished_runs(-5)) == 1
+
+
+def test_failed_analysis_resumes_without_repeating_lookups(fake_telegram, tmp_path):
+    fake = fake_telegram(group_sizes=(30,))
+    service = ChatMemberService(TDLibClient("1", "hash", warm_start=False))
+    service.get_chats()
+    chat_id = fake.groups[0].chat_id
+    journal = RunJournal(str(tmp_path))
+    manager = JobManager(service, journal=journal)
+
+    # The first analysis dies after 10 members
+    iter_rows = service.iter_users_common_chats_count_for_chat
+
+    def failing_iter_rows(*args, **kwargs):
+        rows = iter_rows(*args, **kwargs)
+        yield from itertools.islice(rows, 10)
+        raise ConnectionError("connection lost")
+
+    service.iter_users_common_chats_count_for_chat = failing_iter_rows
+    job = manager.submit(chat_id)
+    job.wait(timeout=10)
+    assert job.status == AnalysisJob.FAILED
+    assert len(journal.unfinished_runs(chat_id)) == 1
+
+    service.iter_users_common_chats_count_for_chat = iter_rows
+    lookups = fake.requests
+    job = manager.submit(chat_id)
+    result = job.wait(timeout=10)
+    assert job.status == AnalysisJob.DONE
+    assert job.resumed == 10
+    assert job.done == job.total == len(result) == 29
+    assert sorted(row.user_id for row in result) == sorted(fake.groups[0].members[1:])
+    # getGroupsInCommon and getUser of the 19 remaining members only, besides the fingerprint and member list
+    assert fake.requests - lookups <= 2 * 19 + 5
+    assert journal.unfinished_runs(chat_id) == []
+    manager.close()
+
+
+def test_analysis_fails_when_the_journal_cannot_be_opened(fake_telegram, tmp_path):
+    fake = fake_telegram(group_sizes=(10,))
+    service = ChatMemberService(TDLibClient("1", "hash", warm_start=False))
+    service.get_chats()
+    chat_id = fake.groups[0].chat_id
+    journal = RunJournal(str(tmp_path))
+    manager = JobManager(service, journal=journal)
+
+    def open_full_disk(*args):
+        raise OSError(28, "No space left on device")
+
+    journal.open = open_full_disk
+    job = manager.submit(chat_id)
+    job.wait(timeout=10)
+    assert job.status == AnalysisJob.FAILED
+    assert "No space left" in job.error
+
+    # The failed job is not reused
+    del journal.open
+    retry = manager.submit(chat_id)
+    assert retry is not job
+    retry.wait(timeout=10)
+    assert retry.status == AnalysisJob.DONE
+    manager.close()
@@ -0,0 +1,101 @@
+import time
+
+from app.telegram.client import TDLibClient
+from app.telegram.live import LiveStats
+from app.telegram.metrics import DISCARDED_EVENTS
+from app.telegram.processor import ChatMemberService
+
+
+def wait_for(predicate, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "condition not reached in time"
+        time.sleep(0.01)
+
+
+def counts(live, chat_id):
+    return {row.name.strip(): row.count for row in live.get_stats(chat_id)}
+
+
+def test_live_stats_follow_membership_updates(fake_telegram):
+    fake = fake_telegram(group_sizes=(10, 20), user_count=25)
+    service = ChatMemberService(TDLibClient("1", "hash", warm_start=False))
+    service.get_chats()
+    small, watched = fake.groups
+    live = LiveStats(service)
+    assert live.watch(watched.chat_id).result() is True
+
+    expected = {
+        fake.get_user_name(user_id).strip(): fake.get_common_chats_count(user_id) for user_id in watched.members[1:]
+    }
+    assert counts(live, watched.chat_id) == expected
+
+    # A new member of the watched chat costs a single lookup
+    requests_before = fake.requests
+    fake.add_member(watched.chat_id, 1000)
+    new_member = fake.get_user_name(1000).strip()
+    wait_for(lambda: new_member in counts(live, watched.chat_id))
+    assert counts(live, watched.chat_id)[new_member] == 1
+    assert fake.requests - requests_before <= 2
+
+    # A tracked member joining another group is applied without any request
+    outsider = next(user_id for user_id in watched.members[1:] if user_id not in small.members)
+    requests_before = fake.requests
+    fake.add_member(small.chat_id, outsider)
+    wait_for(lambda: counts(live, watched.chat_id)[fake.get_user_name(outsider).strip()] == 2)
+    assert fake.requests == requests_before
+
+    # Leaving a group decreases the counts of everyone who shared it
+    version = live.versions[watched.chat_id]
+    fake.leave_chat(small.chat_id)
+    wait_for(lambda: live.versions[watched.chat_id] > version)
+    expected = {
+        fake.get_user_name(user_id).strip(): fake.get_common_chats_count(user_id) for user_id in watched.members[1:]
+    }
+    assert counts(live, watched.chat_id) == expected
+
+    live.close()
+    service.td_client.close()
+
+
+def test_first_basic_group_full_info_is_compared_with_the_scan(fake_telegram):
+    fake = fake_telegram(group_sizes=(10, 20), user_count=25)
+    service = ChatMemberService(TDLibClient("1", "hash", warm_start=False))
+    service.get_chats()
+    watched, other = fake.groups
+    live = LiveStats(service)
+    assert live.watch(watched.chat_id).result() is True
+
+    # Like TDLib, announce the new member list of a known user without a service message
+    assert service.get_chat_members(other.chat_id) is not None
+    joining = next(user_id for user_id in other.members[1:] if user_id not in watched.members)
+    watched.members.append(joining)
+    fake.user_chats[joining].append(watched.chat_id)
+    members = [{"member_id": {"@type": "messageSenderUser", "user_id": user_id}} for user_id in watched.members]
+    live._on_basic_group_full_info(
+        {
+            "@type": "updateBasicGroupFullInfo",
+            "basic_group_id": watched.group_id,
+            "basic_group_full_info": {"members": members},
+        }
+    )
+    wait_for(lambda: counts(live, watched.chat_id).get(fake.get_user_name(joining).strip()) == 2)
+
+    live.close()
+    service.td_client.close()
+
+
+def test_only_membership_messages_are_decoded(fake_telegram):
+    fake = fake_telegram(group_sizes=(10,), user_count=25)
+    service = ChatMemberService(TDLibClient("1", "hash", warm_start=False))
+    service.get_chats()
+    (watched,) = fake.groups
+    live = LiveStats(service)
+    assert live.watch(watched.chat_id).result() is True
+
+    unhandled = DISCARDED_EVENTS.get(reason="unhandled")
+    fake.post_message(watched.chat_id, watched.members[1])
+    wait_for(lambda: DISCARDED_EVENTS.get(reason="unhandled") > unhandled)
+
+    live.close()
+    service.td_client.close()
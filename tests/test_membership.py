@@ -0,0 +1,30 @@
+import numpy as np
+
+from app.telegram.membership import CoMembershipMatrix
+
+
+def make_matrix():
+    return CoMembershipMatrix.from_member_lists({10: [1, 2, 3], 20: [2, 3, 3], 30: [3, 4]})
+
+
+def test_common_chats_counts():
+    matrix = make_matrix()
+    assert matrix.shape == (4, 3)
+    user_ids, counts = matrix.get_common_chats_counts(10)
+    assert dict(zip(user_ids.tolist(), counts.tolist())) == {1: 1, 2: 2, 3: 3}
+    assert matrix.get_common_chats_counts(40) is None
+    assert 20 in matrix and 40 not in matrix
+
+
+def test_members_and_common_chats():
+    matrix = make_matrix()
+    assert matrix.get_members(20).tolist() == [2, 3]
+    assert sorted(matrix.get_common_chats(3).tolist()) == [10, 20, 30]
+    assert matrix.get_common_chats(4).tolist() == [30]
+    assert matrix.get_common_chats(5).size == 0
+
+
+def test_empty_matrix():
+    matrix = CoMembershipMatrix.from_member_lists({})
+    assert matrix.shape == (0, 0)
+    assert isinstance(matrix.get_common_chats(1), np.ndarray)
@@ -0,0 +1,32 @@
+import urllib.request
+
+from app.telegram.metrics import Counter, Histogram, Registry, start_http_server
+
+
+def test_histogram_quantile_and_render():
+    registry = Registry()
+    histogram = registry.register(Histogram("latency_seconds", "Latency.", ("method",), buckets=(0.1, 1.0)))
+    for value in (0.05, 0.05, 0.5, 5.0):
+        histogram.observe(value, method="getUser")
+
+    assert histogram.get_count(method="getUser") == 4
+    assert histogram.quantile(0.5, method="getUser") == 0.1
+    assert histogram.quantile(0.5, method="getChat") is None
+    rendered = registry.render()
+    assert "# TYPE latency_seconds histogram" in rendered
+    assert 'latency_seconds_bucket{method="getUser",le="1"} 3' in rendered
+    assert 'latency_seconds_bucket{method="getUser",le="+Inf"} 4' in rendered
+    assert 'latency_seconds_count{method="getUser"} 4' in rendered
+
+
+def test_metrics_endpoint():
+    registry = Registry()
+    counter = registry.register(Counter("events_total", "Events.", ("reason",)))
+    counter.inc(reason='say "hi"')
+    server = start_http_server(0, registry)
+    try:
+        with urllib.request.urlopen(f"http://127.0.0.1:{server.server_port}/metrics") as response:
+            body = response.read().decode("utf-8")
+    finally:
+        server.shutdown()
+    assert 'events_total{reason="say \\"hi\\""} 1' in body
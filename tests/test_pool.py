@@ -0,0 +1,112 @@
+from collections import Counter
+from concurrent.futures import Future
+
+from app.telegram.pool import ClientPool
+
+
+class MockScheduler:
+    def __init__(self, delay=0.0):
+        self.delay = delay
+
+    def get_delay(self, method):
+        return self.delay
+
+    def budget(self):
+        return {"getGroupsInCommon": {"rate": 2.0, "tokens": 1.0, "paused_for": self.delay, "queued": 3}}
+
+
+class MockClient:
+    def __init__(self, name, error=None):
+        self.name = name
+        self.error = error
+        self.sent = []
+        self.store = object()
+        self.scheduler = MockScheduler()
+
+    def send_request(self, query):
+        self.sent.append(query)
+        future = Future()
+        if self.error is not None:
+            future.set_result({"@type": "error", "code": self.error, "message": "User not found"})
+        elif query["@type"] == "getSupergroupMembers":
+            user_ids = range(query["offset"], query["offset"] + query["limit"])
+            members = [{"member_id": {"@type": "messageSenderUser", "user_id": user_id}} for user_id in user_ids]
+            future.set_result({"@type": "chatMembers", "members": members, "session": self.name})
+        else:
+            future.set_result({"@type": "chats", "session": self.name})
+        return future
+
+
+def test_user_requests_are_sharded_consistently():
+    clients = [MockClient(index) for index in range(4)]
+    pool = ClientPool(clients)
+    owners = {user_id: pool.get_client(user_id) for user_id in range(1000)}
+
+    assert all(pool.get_client(user_id) is client for user_id, client in owners.items())
+    load = Counter(client.name for client in owners.values())
+    assert len(load) == 4 and min(load.values()) > 150
+
+    grown = ClientPool(clients + [MockClient(4)])
+    moved = [user_id for user_id in owners if grown.get_client(user_id) is not owners[user_id]]
+    assert all(grown.get_client(user_id).name == 4 for user_id in moved)
+    assert len(moved) < 350
+
+
+def test_send_request_routing():
+    clients = [MockClient(index) for index in range(3)]
+    pool = ClientPool(clients)
+
+    user_id = next(user_id for user_id in range(100) if pool.get_client(user_id).name == 2)
+    response = pool.send_request({"@type": "getGroupsInCommon", "user_id": user_id}).result()
+    assert response["session"] == 2
+
+    pool.send_request({"@type": "getChat", "chat_id": 1})
+    assert all(client.sent[-1]["@type"] == "getChat" for client in clients)
+
+    pool.send_request({"@type": "getMe"})
+    pool.send_request({"@type": "loadChats", "limit": 100})
+    assert [len(client.sent) for client in clients] == [3, 1, 2]
+
+
+def test_member_pages_are_sent_to_one_session_which_looks_the_members_up():
+    clients = [MockClient(index) for index in range(3)]
+    pool = ClientPool(clients)
+
+    sessions = set()
+    for offset in range(0, 1000, 100):
+        query = {"@type": "getSupergroupMembers", "supergroup_id": 1, "filter": {}, "offset": offset, "limit": 100}
+        response = pool.send_request(query).result()
+        sessions.add(response["session"])
+        assert all(pool.get_client(user_id).name == response["session"] for user_id in range(offset, offset + 100))
+    assert sessions == {0, 1, 2}
+    assert sum(len(client.sent) for client in clients) == 10
+
+    user_id = next(user_id for user_id in range(1000) if pool.get_client(user_id).name == 1)
+    assert pool.send_request({"@type": "getGroupsInCommon", "user_id": user_id}).result()["session"] == 1
+
+
+def test_member_pages_unknown_to_a_session_fall_back_to_primary():
+    pool = ClientPool([MockClient(0), MockClient(1, error=400)])
+    query = {"@type": "getSupergroupMembers", "supergroup_id": 1, "filter": {}, "offset": 0, "limit": 100}
+    offset = next(offset for offset in range(0, 10000, 100) if pool._get_ring_client(f"1:None:{offset}").name == 1)
+
+    response = pool.send_request({**query, "offset": offset}).result()
+    assert response["session"] == 0
+    assert pool.get_client(offset).name == 0
+
+
+def test_unknown_user_falls_back_to_primary():
+    pool = ClientPool([MockClient(0), MockClient(1, error=400)])
+    user_id = next(user_id for user_id in range(100) if pool.get_client(user_id).name == 1)
+
+    response = pool.send_request({"@type": "getUser", "user_id": user_id}).result()
+    assert response["session"] == 0
+
+
+def test_pool_scheduler():
+    clients = [MockClient(0), MockClient(1)]
+    clients[1].scheduler.delay = 3.0
+    pool = ClientPool(clients)
+
+    assert pool.scheduler.get_delay("getGroupsInCommon") == 3.0
+    assert pool.scheduler.budget()["getGroupsInCommon"] == {"rate": 4.0, "tokens": 2.0, "paused_for": 3.0, "queued": 6}
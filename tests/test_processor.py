@@ -1,6 +1,12 @@
+import threading
+from concurrent.futures import Future
+
 import pytest
 
+from app.telegram.cache import SQLiteCache
 from app.telegram.processor import ChatMemberService
+from app.telegram.results import ChatMember, CommonChatsRow
+from app.telegram.store import EntityStore
 
 """
 BE AWARE: THESE TESTS ARE NOT SUITABLE FOR EVERY USER. EVERY USER MUST HAVE A TEST USER ACCOUNT.
@@ -31,11 +37,17 @@ def mock_td_client():
     """
 
     class MockTDLibClient:
+        def __init__(self):
+            self.store = EntityStore(self)
+
         def send(self, query):
             pass
 
-        def receive(self):
-            return None
+        def send_request(self, query):
+            return Future()
+
+        def add_update_handler(self, update_type, handler):
+            pass
 
     return MockTDLibClient()
 
@@ -45,13 +57,12 @@ def service(mock_td_client, monkeypatch):
     """
     Provides a ChatMemberService instance with the _send_and_wait_for_response method mocked.
     """
-    instance = ChatMemberService(mock_td_client)
 
     def mock_wait_for_response(self, request_data, success_condition):
         return None
 
     monkeypatch.setattr(ChatMemberService, "_send_and_wait_for_response", mock_wait_for_response)
-    return instance
+    return ChatMemberService(mock_td_client)
 
 
 def test_get_my_user_id(service, monkeypatch):
@@ -107,44 +118,68 @@ def test_get_chat_info_by_id(service, monkeypatch):
     assert result["title"] == CHAT_USERNAME
 
 
-def test_get_chats_no_info(service, monkeypatch):
+def load_chats_pages(service, pages):
     """
-    Tests that get_chats returns an empty list if no detailed info for chats is available.
+    Makes every loadChats request push the next page of chats into the store, and 404 when none are left.
     """
 
-    def mock_wait_for_response_chats(self, request_data, success_condition):
-        if request_data["@type"] == "getChats":
-            return {"@type": "chats", "chat_ids": []}
-        return None
+    def send_request(query):
+        assert query["@type"] == "loadChats"
+        future = Future()
+        if not pages:
+            future.set_result({"@type": "error", "code": 404, "message": "Not Found"})
+            return future
+        for order, chat in pages.pop(0):
+            position = {"@type": "chatPosition", "list": {"@type": "chatListMain"}, "order": str(order)}
+            service.store._on_new_chat({"@type": "updateNewChat", "chat": {**chat, "positions": [position]}})
+        future.set_result({"@type": "ok"})
+        return future
+
+    service.td_client.send_request = send_request
+
 
-    monkeypatch.setattr(ChatMemberService, "_send_and_wait_for_response", mock_wait_for_response_chats)
+def test_get_chats_no_info(service):
+    """
+    Tests that get_chats returns an empty list if the chat list is empty.
+    """
+    load_chats_pages(service, [])
     result = service.get_chats()
     assert result == []
 
 
-def test_get_chats_success(service, monkeypatch):
+def test_get_chats_success(service):
     """
     Tests that get_chats returns a list of chats with correct IDs and titles when info is available.
     """
-
-    def mock_wait_for_response_detailed(self, request_data, success_condition):
-        if request_data["@type"] == "getChats":
-            return {"@type": "chats", "chat_ids": [CHAT_ID_BASIC]}
-        if request_data["@type"] == "getChat":
-            return {
-                "@type": "chat",
-                "id": CHAT_ID_BASIC,
-                "title": CHAT_USERNAME,
-                "type": {"@type": "chatTypeBasicGroup", "basic_group_id": BASIC_GROUP_ID},
-            }
-
-    monkeypatch.setattr(ChatMemberService, "_send_and_wait_for_response", mock_wait_for_response_detailed)
+    basic_group = {
+        "@type": "chat",
+        "id": CHAT_ID_BASIC,
+        "title": CHAT_USERNAME,
+        "type": {"@type": "chatTypeBasicGroup", "basic_group_id": BASIC_GROUP_ID},
+    }
+    private_chat = {"@type": "chat", "id": USER_ID_2, "title": "Private", "type": {"@type": "chatTypePrivate"}}
+    load_chats_pages(service, [[(2, basic_group), (1, private_chat)]])
     result = service.get_chats()
     assert len(result) == 1
     assert result[0]["id"] == CHAT_ID_BASIC
     assert result[0]["name"] == CHAT_USERNAME
 
 
+def test_iter_chat_pages_yields_each_page(service):
+    """
+    Tests that chats are yielded page by page, as soon as each page has been loaded.
+    """
+    pages = [
+        [(10 - i, {"@type": "chat", "id": i, "title": f"Group {i}", "type": {"@type": "chatTypeBasicGroup"}})]
+        for i in range(3)
+    ]
+    load_chats_pages(service, pages)
+    chat_pages = service.iter_chat_pages(page_size=1)
+    assert next(chat_pages) == [{"id": 0, "name": "Group 0"}]
+    assert len(pages) == 2
+    assert list(chat_pages) == [[{"id": 1, "name": "Group 1"}], [{"id": 2, "name": "Group 2"}]]
+
+
 def test_get_chat_members(service, monkeypatch):
     """
     Tests that get_chat_members returns the correct member data for a basic group chat.
@@ -162,16 +197,100 @@ def test_get_chat_members(service, monkeypatch):
             return {
                 "@type": "basicGroupFullInfo",
                 "members": [
-                    {"@type": "chatMember", "member_id": {"@type": "messageSenderUser", "user_id": USER_ID_1}},
+                    {
+                        "@type": "chatMember",
+                        "member_id": {"@type": "messageSenderUser", "user_id": USER_ID_1},
+                        "status": {"@type": "chatMemberStatusCreator"},
+                    },
                     {"@type": "chatMember", "member_id": {"@type": "messageSenderUser", "user_id": USER_ID_2}},
+                    {"@type": "chatMember", "member_id": {"@type": "messageSenderChat", "chat_id": CHAT_ID_TEST}},
                 ],
             }
 
     monkeypatch.setattr(ChatMemberService, "_send_and_wait_for_response", mock_wait_for_response_members)
     result = service.get_chat_members(CHAT_ID_TEST)
-    assert len(result) == 2
-    assert result[0]["member_id"]["user_id"] == USER_ID_1
-    assert result[1]["member_id"]["user_id"] == USER_ID_2
+    assert result.user_ids.tolist() == [USER_ID_1, USER_ID_2]
+    assert list(result) == [
+        ChatMember(USER_ID_1, "chatMemberStatusCreator"),
+        ChatMember(USER_ID_2, "chatMemberStatusMember"),
+    ]
+
+
+def test_iter_chat_members_pages_supergroup(service, monkeypatch):
+    """
+    Tests that supergroup members are requested lazily, one getSupergroupMembers page at a time.
+    """
+    total_count = 5
+    requests = []
+
+    def mock_wait_for_response(self, request_data, success_condition):
+        requests.append(request_data)
+        if request_data["@type"] == "getChat":
+            return {
+                "@type": "chat",
+                "id": CHAT_ID_TEST,
+                "title": CHAT_USERNAME,
+                "type": {"@type": "chatTypeSupergroup", "supergroup_id": BASIC_GROUP_ID, "is_channel": False},
+            }
+        if request_data["@type"] == "getSupergroupMembers":
+            offset, limit = request_data["offset"], request_data["limit"]
+            return {
+                "@type": "chatMembers",
+                "total_count": total_count,
+                "members": [
+                    {"member_id": {"@type": "messageSenderUser", "user_id": user_id}}
+                    for user_id in range(offset, min(offset + limit, total_count))
+                ],
+            }
+
+    monkeypatch.setattr(ChatMemberService, "_send_and_wait_for_response", mock_wait_for_response)
+    pages = service.iter_chat_members(CHAT_ID_TEST, page_size=2)
+    assert [request["@type"] for request in requests] == ["getChat", "getSupergroupMembers"]
+
+    first_page = next(pages)
+    assert [member["member_id"]["user_id"] for member in first_page] == [0, 1]
+    assert len(requests) == 2
+
+    remaining = [[member["member_id"]["user_id"] for member in page] for page in pages]
+    assert remaining == [[2, 3], [4]]
+    assert [request["offset"] for request in requests[1:]] == [0, 2, 4]
+
+
+def test_iter_chat_members_searches_past_the_listing_limit(service, monkeypatch):
+    """
+    Tests that members past the listing limit are searched by name, and that those no search finds are counted.
+    """
+    names = {1: "alice", 2: "bob", 3: "anna", 4: "boris", 5: "ben", 6: "carl", 7: "_ghost"}
+    queries = []
+
+    def mock_wait_for_response(self, request_data, success_condition):
+        if request_data["@type"] == "getChat":
+            return {
+                "@type": "chat",
+                "id": CHAT_ID_TEST,
+                "title": CHAT_USERNAME,
+                "type": {"@type": "chatTypeSupergroup", "supergroup_id": BASIC_GROUP_ID, "is_channel": False},
+            }
+        member_filter = request_data["filter"]
+        queries.append(member_filter.get("query"))
+        user_ids = [user_id for user_id, name in names.items() if name.startswith(member_filter.get("query", ""))]
+        offset, limit = request_data["offset"], request_data["limit"]
+        # Like Telegram, list no member past the limit
+        page = user_ids[offset : min(offset + limit, ChatMemberService.MAX_MEMBERS_OFFSET)]
+        return {
+            "@type": "chatMembers",
+            "total_count": len(user_ids),
+            "members": [{"member_id": {"@type": "messageSenderUser", "user_id": user_id}} for user_id in page],
+        }
+
+    monkeypatch.setattr(ChatMemberService, "_send_and_wait_for_response", mock_wait_for_response)
+    monkeypatch.setattr(ChatMemberService, "MAX_MEMBERS_OFFSET", 3)
+    monkeypatch.setattr(ChatMemberService, "MEMBER_SEARCH_QUERIES", ("a", "b", "c"))
+    pages = service.iter_chat_members(CHAT_ID_TEST, page_size=2)
+    user_ids = [member["member_id"]["user_id"] for page in pages for member in page]
+    assert sorted(user_ids) == [1, 2, 3, 4, 5, 6]
+    assert queries == [None, None, "a", "b", "b", "c"]
+    assert service.unlisted_member_counts == {CHAT_ID_TEST: 1}
 
 
 def test_get_users_common_chats_count_for_chat(service, monkeypatch):
@@ -179,27 +298,265 @@ def test_get_users_common_chats_count_for_chat(service, monkeypatch):
     Tests that get_users_common_chats_count_for_chat returns correct counts for each user and skips the self user.
     """
 
-    def mock_get_chat_members(self, chat_id):
-        return [
-            {"member_id": {"@type": "messageSenderUser", "user_id": service._ChatMemberService__my_user_id}},
-        ]
+    my_user_id = service._ChatMemberService__my_user_id = SELF_USER_ID
+    common_groups = {USER_ID_2: {"@type": "chats", "chat_ids": [CHAT_ID_TEST]}}
 
-    def mock_get_common_groups_with_user(self, user_id):
-        if user_id == USER_ID_2:
-            return {"@type": "chats", "chat_ids": [CHAT_ID_TEST]}
-        return None
+    def mock_iter_chat_members(self, chat_id):
+        return iter(
+            [[{"member_id": {"@type": "messageSenderUser", "user_id": user_id}} for user_id in (my_user_id, USER_ID_2)]]
+        )
 
-    monkeypatch.setattr(ChatMemberService, "get_chat_members", mock_get_chat_members)
-    monkeypatch.setattr(ChatMemberService, "get_common_groups_with_user", mock_get_common_groups_with_user)
+    def send_request(query):
+        future = Future()
+        if query["@type"] == "getGroupsInCommon":
+            future.set_result(
+                common_groups.get(query["user_id"], {"@type": "error", "code": 400, "message": "Not found"})
+            )
+        else:
+            future.set_result({"@type": "user", "first_name": "Sofya", "last_name": "Salyaeva"})
+        return future
+
+    monkeypatch.setattr(ChatMemberService, "iter_chat_members", mock_iter_chat_members)
+    monkeypatch.setattr(ChatMemberService, "get_chat_member_count", lambda self, chat_id: 2)
+    service.td_client.send_request = send_request
+
+    result = service.get_users_common_chats_count_for_chat(CHAT_ID_TEST)
+    assert list(result) == [CommonChatsRow(USER_ID_2, "Sofya Salyaeva", 1)]
 
+    common_groups.clear()
     result = service.get_users_common_chats_count_for_chat(CHAT_ID_TEST)
-    assert result == [
-        {"user_id": USER_ID_2, "count_of_common_chats": 1},
+    assert len(result) == 0
+
+
+def test_send_and_wait_for_responses_keeps_request_order(service):
+    """
+    Tests that every request gets its own response and that failed requests yield None.
+    """
+    responses = {
+        USER_ID_1: {"@type": "user", "id": USER_ID_1},
+        USER_ID_2: {"@type": "user", "id": USER_ID_2},
+        0: {"@type": "error", "code": 400, "message": "Not found"},
+    }
+
+    def send_request(query):
+        future = Future()
+        future.set_result(responses[query["user_id"]])
+        return future
+
+    service.td_client.send_request = send_request
+    requests = [{"@type": "getUser", "user_id": user_id} for user_id in (USER_ID_1, 0, USER_ID_2)]
+    result = service._send_and_wait_for_responses(requests, success_condition="user")
+    assert result[0]["id"] == USER_ID_1
+    assert result[1] is None
+    assert result[2]["id"] == USER_ID_2
+
+
+def test_get_users_common_chats_count_for_chat_fan_out(service, monkeypatch):
+    """
+    Tests that member lookups stay within the concurrency window and that progress is reported per member.
+    """
+    user_ids = [USER_ID_2 + i for i in range(6)]
+    in_flight = set()
+    max_in_flight = []
+    lock = threading.Lock()
+
+    def mock_iter_chat_members(self, chat_id):
+        return iter([[{"member_id": {"@type": "messageSenderUser", "user_id": user_id}} for user_id in user_ids]])
+
+    def respond(query, future):
+        with lock:
+            in_flight.discard((query["@type"], query["user_id"]))
+        if query["user_id"] == user_ids[0]:
+            future.set_result({"@type": "error", "code": 400, "message": "USER_ID_INVALID"})
+        elif query["@type"] == "getGroupsInCommon":
+            future.set_result({"@type": "chats", "chat_ids": [CHAT_ID_TEST]})
+        else:
+            future.set_result({"@type": "user", "first_name": "User", "last_name": str(query["user_id"])})
+
+    def send_request(query):
+        future = Future()
+        with lock:
+            in_flight.add((query["@type"], query["user_id"]))
+            max_in_flight.append(len({user_id for _, user_id in in_flight}))
+        threading.Timer(0.01, respond, args=(query, future)).start()
+        return future
+
+    progress = []
+
+    def progress_callback(done, total, user_id, error):
+        progress.append((done, total, user_id, error))
+
+    monkeypatch.setattr(ChatMemberService, "iter_chat_members", mock_iter_chat_members)
+    monkeypatch.setattr(ChatMemberService, "get_chat_member_count", lambda self, chat_id: len(user_ids))
+    service.td_client.send_request = send_request
+
+    result = service.get_users_common_chats_count_for_chat(
+        CHAT_ID_TEST, concurrency=2, progress_callback=progress_callback
+    )
+    assert sorted(result.names) == [f"User {user_id}" for user_id in user_ids[1:]]
+    assert (result.counts == 1).all()
+    assert max(max_in_flight) == 2
+    assert [done for done, *_ in progress] == [1, 2, 3, 4, 5, 6]
+    assert (len(user_ids), user_ids[0], "getGroupsInCommon failed") in [
+        (total, user_id, error) for _, total, user_id, error in progress
     ]
 
-    def mock_get_common_groups_with_user_none(self, user_id):
-        return None
 
-    monkeypatch.setattr(ChatMemberService, "get_common_groups_with_user", mock_get_common_groups_with_user_none)
-    result = service.get_users_common_chats_count_for_chat(CHAT_ID_TEST)
-    assert result == []
+def test_common_groups_lookups_do_not_spin_on_half_done_members(service, monkeypatch):
+    """
+    Tests that a member whose getUser is answered at once does not wake the wait loop until getGroupsInCommon is.
+    """
+    import app.telegram.processor as processor
+
+    user_ids = [USER_ID_2 + i for i in range(3)]
+    wait_calls = []
+    original_wait = processor.wait
+
+    def counting_wait(*args, **kwargs):
+        wait_calls.append(1)
+        return original_wait(*args, **kwargs)
+
+    def send_request(query):
+        future = Future()
+        if query["@type"] == "getUser":
+            future.set_result({"@type": "user", "first_name": "User", "last_name": str(query["user_id"])})
+        else:
+            response = {"@type": "chats", "chat_ids": [CHAT_ID_TEST]}
+            threading.Timer(0.2, future.set_result, args=(response,)).start()
+        return future
+
+    monkeypatch.setattr(processor, "wait", counting_wait)
+    service.td_client.send_request = send_request
+    rows = list(service._iter_common_chats_counts(iter(user_ids), len(user_ids), 3, None))
+    assert sorted(row.user_id for row in rows) == user_ids
+    assert len(wait_calls) <= 2 * len(user_ids)
+
+
+def test_common_groups_lookups_completing_before_the_wait_do_not_time_out(service):
+    """
+    Tests that lookups completing between the check for done members and the wait are not taken for timeouts.
+    """
+    user_ids = [USER_ID_2 + i for i in range(3)]
+    checks = []
+
+    class LateFuture(Future):
+        # Not done when the loop first checks for done members, done when it collects the futures to wait for
+        def done(self):
+            checks.append(1)
+            return len(checks) > len(user_ids) and super().done()
+
+    def send_request(query):
+        future = LateFuture()
+        if query["@type"] == "getUser":
+            future.set_result({"@type": "user", "first_name": "User", "last_name": str(query["user_id"])})
+        else:
+            future.set_result({"@type": "chats", "chat_ids": [CHAT_ID_TEST]})
+        return future
+
+    service.td_client.send_request = send_request
+    rows = list(service._iter_common_chats_counts(iter(user_ids), len(user_ids), 3, None))
+    assert sorted(row.user_id for row in rows) == user_ids
+
+
+def test_get_chat_info_by_id_uses_cache(mock_td_client):
+    """
+    Tests that a cached chat is served without sending a request.
+    """
+    sent = []
+
+    def send_request(query):
+        sent.append(query)
+        future = Future()
+        if query["@type"] == "getMe":
+            future.set_result({"@type": "user", "id": SELF_USER_ID})
+        else:
+            future.set_result({"@type": "chat", "id": CHAT_ID_TEST, "title": CHAT_USERNAME})
+        return future
+
+    mock_td_client.send_request = send_request
+    service = ChatMemberService(mock_td_client, cache=SQLiteCache(":memory:"))
+    assert service.get_chat_info_by_id(CHAT_ID_TEST)["title"] == CHAT_USERNAME
+    assert service.get_chat_info_by_id(CHAT_ID_TEST)["title"] == CHAT_USERNAME
+    assert [query["@type"] for query in sent] == ["getMe", "getChat"]
+
+
+def test_get_name_by_user_id_uses_store(mock_td_client):
+    """
+    Tests that users pushed through updateUser are resolved without sending a request.
+    """
+    sent = []
+
+    def send_request(query):
+        sent.append(query)
+        future = Future()
+        future.set_result({"@type": "user", "id": SELF_USER_ID})
+        return future
+
+    mock_td_client.send_request = send_request
+    service = ChatMemberService(mock_td_client)
+    service.store.users[USER_ID_2] = {"@type": "user", "id": USER_ID_2, "first_name": "Sofya", "last_name": "Salyaeva"}
+    assert service.get_name_by_user_id(USER_ID_2) == "Sofya Salyaeva"
+    assert [query["@type"] for query in sent] == ["getMe"]
+
+
+def test_iter_users_common_chats_count_for_chat_streams_rows(service, monkeypatch):
+    """
+    Tests that result rows are yielded before the lookups of later members have been sent.
+    """
+    sent = []
+
+    def mock_iter_chat_members(self, chat_id):
+        return iter([[{"member_id": {"@type": "messageSenderUser", "user_id": user_id}} for user_id in range(1, 4)]])
+
+    def send_request(query):
+        sent.append(query)
+        future = Future()
+        if query["@type"] == "getGroupsInCommon":
+            future.set_result({"@type": "chats", "chat_ids": list(range(query["user_id"]))})
+        else:
+            future.set_result({"@type": "user", "first_name": "User", "last_name": str(query["user_id"])})
+        return future
+
+    monkeypatch.setattr(ChatMemberService, "iter_chat_members", mock_iter_chat_members)
+    monkeypatch.setattr(ChatMemberService, "get_chat_member_count", lambda self, chat_id: 3)
+    service.td_client.send_request = send_request
+
+    rows = service.iter_users_common_chats_count_for_chat(CHAT_ID_TEST, concurrency=1)
+    assert next(rows) == CommonChatsRow(1, "User 1", 1)
+    assert {query["user_id"] for query in sent} == {1}
+    assert list(rows) == [CommonChatsRow(2, "User 2", 2), CommonChatsRow(3, "User 3", 3)]
+
+
+def test_co_membership_matrix_replaces_common_groups_requests(service, monkeypatch):
+    """
+    Tests that chats in a loaded co-membership matrix are analyzed without getGroupsInCommon requests.
+    """
+    members = {10: [1, 2], 20: [2, 3]}
+
+    def mock_iter_chat_members(self, chat_id):
+        return iter(
+            [[{"member_id": {"@type": "messageSenderUser", "user_id": user_id}} for user_id in members[chat_id]]]
+        )
+
+    sent = []
+
+    def mock_send_request(query):
+        sent.append(query["@type"])
+        future = Future()
+        future.set_result({"@type": "user", "first_name": "User", "last_name": str(query["user_id"])})
+        return future
+
+    monkeypatch.setattr(ChatMemberService, "get_chats", lambda self: [{"id": 10, "name": "A"}, {"id": 20, "name": "B"}])
+    monkeypatch.setattr(ChatMemberService, "iter_chat_members", mock_iter_chat_members)
+    service.td_client.send_request = mock_send_request
+
+    matrix = service.load_co_membership_matrix()
+    assert matrix.shape == (3, 2)
+
+    progress = []
+    rows = service.get_users_common_chats_count_for_chat(
+        20, progress_callback=lambda done, total, user_id, error: progress.append((done, total))
+    )
+    assert list(rows) == [CommonChatsRow(2, "User 2", 2), CommonChatsRow(3, "User 3", 1)]
+    assert progress == [(1, 2), (2, 2)]
+    assert "getGroupsInCommon" not in sent
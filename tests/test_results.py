@@ -0,0 +1,64 @@
+import sys
+
+import numpy as np
+import pytest
+
+from app.telegram.results import ChatMember, CommonChatsResult, CommonChatsRow, MemberList
+
+
+def build_result(counts):
+    return CommonChatsResult.from_rows(
+        CommonChatsRow(user_id, f"Пользователь {user_id}", count) for user_id, count in enumerate(counts)
+    )
+
+
+def test_result_round_trips_rows():
+    rows = [CommonChatsRow(1, "Sofya Salyaeva", 3), CommonChatsRow(2, None, 1), CommonChatsRow(3, "Ёж", 2)]
+    result = CommonChatsResult.from_rows(rows)
+    assert len(result) == 3
+    assert list(result) == rows
+    assert result[-1] == rows[-1]
+    assert result.user_ids.tolist() == [1, 2, 3]
+    assert result.counts.tolist() == [3, 1, 2]
+
+
+def test_top_k_returns_largest_counts_in_order():
+    counts = np.random.default_rng(0).integers(0, 1000, size=5000)
+    result = build_result(counts)
+    top = result.top_k(10)
+    assert top.counts.tolist() == sorted(counts.tolist(), reverse=True)[:10]
+    assert [row.name for row in top] == [f"Пользователь {user_id}" for user_id in top.user_ids.tolist()]
+    assert len(result.top_k(10000)) == 5000
+    assert len(result.top_k(0)) == 0
+
+
+def test_to_arrow_shares_memory():
+    result = build_result([2, 5, 1])
+    table = result.to_arrow()
+    assert table.column("name").to_pylist() == ["Пользователь 0", "Пользователь 1", "Пользователь 2"]
+    assert table.column("count").to_pylist() == [2, 5, 1]
+    assert np.shares_memory(table.column("user_id").chunk(0).to_numpy(), result.user_ids)
+
+
+def test_member_list_keeps_users_only():
+    members = MemberList.from_pages(
+        [
+            [
+                {
+                    "member_id": {"@type": "messageSenderUser", "user_id": 5},
+                    "status": {"@type": "chatMemberStatusLeft"},
+                },
+                {"member_id": {"@type": "messageSenderChat", "chat_id": -100}},
+            ],
+            [{"member_id": {"@type": "messageSenderUser", "user_id": 7}}],
+        ]
+    )
+    assert len(members) == 2
+    assert members.user_ids.tolist() == [5, 7]
+    assert list(members) == [ChatMember(5, "chatMemberStatusLeft"), ChatMember(7, "chatMemberStatusMember")]
+
+
+def test_to_arrow_without_pyarrow(monkeypatch):
+    monkeypatch.setitem(sys.modules, "pyarrow", None)
+    with pytest.raises(ImportError, match="arrow"):
+        build_result([1]).to_arrow()
@@ -0,0 +1,72 @@
+import threading
+import time
+
+from app.telegram.scheduler import RequestScheduler, parse_flood_wait
+
+
+def make_scheduler():
+    sent = []
+    event = threading.Event()
+
+    def send(query):
+        sent.append((time.monotonic(), query))
+        event.set()
+
+    return RequestScheduler(send), sent, event
+
+
+def test_parse_flood_wait():
+    assert parse_flood_wait({"@type": "error", "code": 420, "message": "FLOOD_WAIT_17"}) == 17
+    assert parse_flood_wait({"@type": "error", "code": 429, "message": "Too Many Requests: retry after 4"}) == 4
+    assert parse_flood_wait({"@type": "error", "code": 400, "message": "USER_ID_INVALID"}) is None
+    assert parse_flood_wait({"@type": "chats", "chat_ids": []}) is None
+
+
+def test_unlimited_methods_are_sent_immediately():
+    scheduler, sent, _ = make_scheduler()
+    for user_id in range(20):
+        scheduler.submit({"@type": "getUser", "user_id": user_id})
+    deadline = time.monotonic() + 1
+    while len(sent) < 20 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert [query["user_id"] for _, query in sent] == list(range(20))
+    assert scheduler.budget()["getUser"]["rate"] is None
+
+
+def test_flood_wait_pauses_only_the_affected_method():
+    scheduler, sent, event = make_scheduler()
+    scheduler.on_flood_wait("getGroupsInCommon", 1)
+    budget = scheduler.budget()["getGroupsInCommon"]
+    assert budget["rate"] == RequestScheduler.DEFAULT_FLOOD_RATE * RequestScheduler.BACKOFF_FACTOR
+    assert budget["paused_for"] > 0.5
+
+    submitted_at = time.monotonic()
+    scheduler.submit({"@type": "getGroupsInCommon", "user_id": 1})
+    scheduler.submit({"@type": "getUser", "user_id": 1})
+    assert event.wait(timeout=1)
+    assert sent[0][1]["@type"] == "getUser"
+
+    deadline = time.monotonic() + 3
+    while len(sent) < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert sent[1][1]["@type"] == "getGroupsInCommon"
+    assert sent[1][0] - submitted_at >= 0.9
+
+
+def test_success_raises_learned_rate():
+    scheduler, _, _ = make_scheduler()
+    scheduler.on_flood_wait("getGroupsInCommon", 0)
+    rate = scheduler.budget()["getGroupsInCommon"]["rate"]
+    scheduler.on_success("getGroupsInCommon")
+    assert scheduler.budget()["getGroupsInCommon"]["rate"] > rate
+
+
+def test_stop_ends_the_sender_thread():
+    scheduler, sent, _ = make_scheduler()
+    scheduler.on_flood_wait("getGroupsInCommon", 60)
+    scheduler.submit({"@type": "getGroupsInCommon", "user_id": 1})
+    scheduler.stop()
+    assert not scheduler._thread.is_alive()
+    scheduler.submit({"@type": "getUser", "user_id": 1})
+    time.sleep(0.05)
+    assert sent == []
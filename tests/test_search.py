@@ -0,0 +1,70 @@
+import time
+
+from app.telegram.search import ChatIndex, normalize
+
+
+def build_index(names):
+    index = ChatIndex()
+    index.add({"id": chat_id, "name": name} for chat_id, name in enumerate(names))
+    return index
+
+
+def test_normalize_folds_case_width_and_spaces():
+    assert normalize("  ＰＹＴＨＯＮ   Chat ") == "python chat"
+
+
+def test_search_ranks_exact_prefix_word_and_substring_matches():
+    index = build_index(["Python Moscow", "Learn Python", "python", "CPython internals", "Rust", "Pythonistas"])
+    assert index.search("python") == [2, 0, 5, 1, 3]
+    assert index.search("PYTH")[:3] == [0, 2, 5]
+    assert index.search("") == [0, 1, 2, 3, 4, 5]
+    assert index.search("python", limit=2) == [2, 0]
+
+
+def test_short_queries_match_substrings():
+    index = build_index(["Rust", "Trust fund", "Go meetup", "Ruby", "Big data"])
+    assert index.search("ru") == [0, 3, 1]
+    assert index.search("g") == [2, 4]
+    assert index.search("zz") == []
+
+
+def test_search_tolerates_typos():
+    index = build_index(["Telegram developers", "Team lead club", "Photography"])
+    assert index.search("telegarm devel") == [0]
+    assert index.search("photograpy") == [2]
+
+
+def test_chats_with_the_same_title_stay_distinct():
+    index = ChatIndex()
+    index.add([{"id": 10, "name": "Family"}, {"id": 20, "name": "Family"}])
+    index.add([{"id": 10, "name": "Family"}])
+    assert index.search("family") == [10, 20]
+    assert len(index) == 2
+
+
+def test_renamed_chats_are_found_by_their_new_title():
+    index = build_index(["Old name", "Other"])
+    index.add([{"id": 0, "name": "Brand new"}])
+    assert index.search("old") == []
+    assert index.search("brand") == [0]
+    assert index.get(0)["name"] == "Brand new"
+
+    index.rename(1, "Renamed")
+    index.rename(7, "Not indexed")
+    assert index.search("renamed") == [1]
+    assert index.search("other") == []
+    assert 7 not in index
+
+
+def test_search_is_fast_on_large_chat_lists():
+    index = build_index(f"Group {i} of city {i % 997} chat" for i in range(50000))
+    started_at = time.perf_counter()
+    results = index.search("city 99", limit=100)
+    assert time.perf_counter() - started_at < 0.5
+    assert len(results) == 100
+    assert all(" city 99" in index.get(chat_id)["name"].lower() for chat_id in results)
+
+    started_at = time.perf_counter()
+    results = index.search("9", limit=100)
+    assert time.perf_counter() - started_at < 0.5
+    assert len(results) == 100
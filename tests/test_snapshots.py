@@ -0,0 +1,62 @@
+import numpy as np
+
+from app.telegram.client import TDLibClient
+from app.telegram.jobs import JobManager
+from app.telegram.processor import ChatMemberService
+from app.telegram.results import CommonChatsResult, CommonChatsRow
+from app.telegram.snapshots import SnapshotStore
+
+
+def build_result(counts):
+    return CommonChatsResult.from_rows(
+        CommonChatsRow(user_id, f"Участник {user_id}" if user_id % 3 else None, count)
+        for user_id, count in counts.items()
+    )
+
+
+def test_snapshots_round_trip_and_diff(tmp_path):
+    store = SnapshotStore(str(tmp_path))
+    old = store.save(-5, build_result({7: 2, 3: 1, 5: 4}), created_at=1000.0)
+    new = store.save(-5, build_result({5: 6, 3: 1, 9: 1}), created_at=2000.0)
+    # Two snapshots in the same millisecond are both kept
+    store.save(-5, build_result({}), created_at=2000.0)
+
+    snapshots = store.list(-5)
+    assert [snapshot.created_at for snapshot in snapshots] == [1000.0, 2000.0, 2000.001]
+    assert store.list(-6) == []
+    assert isinstance(snapshots[0].user_ids, np.memmap)
+    assert snapshots[0].user_ids.tolist() == [3, 5, 7]
+    assert list(snapshots[0].to_result()) == [
+        CommonChatsRow(3, None, 1),
+        CommonChatsRow(5, "Участник 5", 4),
+        CommonChatsRow(7, "Участник 7", 2),
+    ]
+    assert snapshots[0].to_result().top_k(1)[0] == CommonChatsRow(5, "Участник 5", 4)
+
+    diff = store.diff(old, new)
+    assert diff.joined.tolist() == [9]
+    assert diff.left.tolist() == [7]
+    assert diff.changed.tolist() == [5]
+    assert diff.previous_counts.tolist() == [4]
+    assert diff.counts.tolist() == [6]
+
+    trend = store.trend(-5, user_ids=[5, 7])
+    assert trend["members"].tolist() == [3, 3, 0]
+    assert trend["mean_count"].tolist() == [7 / 3, 8 / 3, 0.0]
+    assert trend["user_counts"].tolist() == [[4, 2], [6, -1], [-1, -1]]
+    assert not any(path.name.startswith(".") for path in (tmp_path / "-5").iterdir())
+
+
+def test_finished_jobs_are_saved(fake_telegram, tmp_path):
+    fake = fake_telegram(group_sizes=(20,))
+    service = ChatMemberService(TDLibClient("1", "hash", warm_start=False))
+    service.get_chats()
+    chat_id = fake.groups[0].chat_id
+    store = SnapshotStore(str(tmp_path))
+    manager = JobManager(service, snapshot_store=store)
+
+    result = manager.submit(chat_id).wait(timeout=10)
+    snapshot = store.latest(chat_id)
+    assert len(snapshot) == len(result) == 19
+    assert sorted(snapshot.to_result(), key=lambda row: row.user_id) == sorted(result, key=lambda row: row.user_id)
+    manager.close()
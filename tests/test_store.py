@@ -0,0 +1,49 @@
+from app.telegram.store import EntityStore
+
+
+class MockUpdateSource:
+    def __init__(self):
+        self.handlers = {}
+
+    def add_update_handler(self, update_type, handler):
+        self.handlers.setdefault(update_type, []).append(handler)
+
+    def push(self, update):
+        for handler in self.handlers.get(update["@type"], []):
+            handler(update)
+
+
+def test_store_follows_updates():
+    source = MockUpdateSource()
+    store = EntityStore(source)
+    source.push({"@type": "updateNewChat", "chat": {"@type": "chat", "id": 1, "title": "Old"}})
+    source.push({"@type": "updateChatTitle", "chat_id": 1, "title": "New"})
+    source.push({"@type": "updateUser", "user": {"@type": "user", "id": 2, "first_name": "Max"}})
+
+    assert store.get_response({"@type": "getChat", "chat_id": 1})["title"] == "New"
+    assert store.get_response({"@type": "getUser", "user_id": 2})["first_name"] == "Max"
+    assert store.get_response({"@type": "getUser", "user_id": 3}) is None
+    assert store.get_response({"@type": "getGroupsInCommon", "user_id": 2}) is None
+
+
+def test_basic_group_full_info_update():
+    source = MockUpdateSource()
+    store = EntityStore(source)
+    full_info = {"@type": "basicGroupFullInfo", "members": []}
+    source.push({"@type": "updateBasicGroupFullInfo", "basic_group_id": 5, "basic_group_full_info": full_info})
+    assert store.get_response({"@type": "getBasicGroupFullInfo", "basic_group_id": 5}) == full_info
+
+
+def test_get_response_returns_copies():
+    source = MockUpdateSource()
+    store = EntityStore(source)
+    source.push({"@type": "updateUser", "user": {"@type": "user", "id": 2, "usernames": {"active_usernames": ["max"]}}})
+
+    user = store.get_response({"@type": "getUser", "user_id": 2})
+    user["usernames"]["active_usernames"].append("changed")
+    user["first_name"] = "Changed"
+    assert store.get_response({"@type": "getUser", "user_id": 2}) == {
+        "@type": "user",
+        "id": 2,
+        "usernames": {"active_usernames": ["max"]},
+    }